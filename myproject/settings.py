@@ -53,8 +53,9 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'stock_manager.middleware.SessionTimeoutMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'stock_manager.middleware.SessionTimeoutMiddleware',
+    'stock_manager.middleware.AuditUserMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     
 ]
@@ -89,17 +90,79 @@ ALLOWED_HOSTS = config("ALLOWED_HOSTS", default="").split(",")
 
 ENVIRONMENT = config('ENVIRONMENT', default='local')
 
-DATABASES = {
+# DATABASE_URL (e.g. sqlite:///bench.sqlite3 for local benchmarks) takes
+# precedence over the individual DB_* settings.
+DATABASE_URL = config('DATABASE_URL', default='')
+
+if DATABASE_URL:
+    DATABASES = {'default': dj_database_url.parse(DATABASE_URL)}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': config('DB_NAME'),
+            'USER': config('DB_USER'),
+            'PASSWORD': config('DB_PASSWORD'),
+            'HOST': config('DB_HOST'),
+            'PORT': config('DB_PORT', default='5432'),
+        }
+    }
+
+
+# Cache
+# Dashboard snapshots live in the default cache.  Local memory is per process;
+# use CACHE_BACKEND=file or CACHE_BACKEND=db (after `manage.py createcachetable`)
+# to share snapshots and their invalidations between gunicorn workers.
+
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'stock-manager'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', os.path.join(BASE_DIR, 'cache')),
+    'db': ('django.core.cache.backends.db.DatabaseCache', 'stock_manager_cache'),
+}
+CACHE_BACKEND = config('CACHE_BACKEND', default='locmem')
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': config('DB_NAME'),
-        'USER': config('DB_USER'),
-        'PASSWORD': config('DB_PASSWORD'),
-        'HOST': config('DB_HOST'),
-        'PORT': config('DB_PORT', default='5432'),
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND][0],
+        'LOCATION': config('CACHE_LOCATION', default=CACHE_BACKENDS[CACHE_BACKEND][1]),
     }
 }
 
+DASHBOARD_CACHE_ALIAS = 'default'
+DASHBOARD_CACHE_TIMEOUT = config('DASHBOARD_CACHE_TIMEOUT', default=3600, cast=int)  # seconds
+
+
+# Audit log
+# Rows are queued in-process and written by a background thread in batches of
+# AUDIT_BATCH_SIZE, or AUDIT_FLUSH_INTERVAL seconds after the first one is
+# queued.  AUDIT_ASYNC = False writes them as soon as the transaction commits.
+AUDIT_ASYNC = config('AUDIT_ASYNC', default=True, cast=bool)
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 2.0  # seconds
+AUDIT_QUEUE_SIZE = 10000
+
+# `manage.py archive_audit_log` moves rows older than this into monthly
+# JSONL.gz files under AUDIT_ARCHIVE_DIR; `read_audit_archive` searches them.
+AUDIT_RETENTION_DAYS = config('AUDIT_RETENTION_DAYS', default=365, cast=int)
+AUDIT_ARCHIVE_DIR = config('AUDIT_ARCHIVE_DIR', default=os.path.join(BASE_DIR, 'audit_archive'))
+
+
+# Inventory costing
+# Stock on hand is valued at cost by this method, 'fifo' or 'average' (moving
+# weighted average).  After changing it, run `manage.py rebuild_cost_layers`.
+INVENTORY_COSTING_METHOD = config('INVENTORY_COSTING_METHOD', default='fifo')
+
+
+# Document numbering
+# Defaults used when a DocumentSequence row is first created; afterwards the
+# prefix and format can be changed in the admin.  Purchases only draw from
+# their sequence when no supplier document number is entered.
+
+DOCUMENT_SEQUENCES = {
+    'sale': {'prefix': 'SAL-', 'format': '{prefix}{number:06d}'},
+    'purchase': {'prefix': 'PUR-', 'format': '{prefix}{number:06d}'},
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -144,13 +207,23 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+# Covering-index columns (Index.include) only apply on PostgreSQL; on SQLite
+# the key columns are still indexed, so the warning is noise for local runs.
+SILENCED_SYSTEM_CHECKS = ['models.W040']
 
-# Automatically log out users after 30 minutes of inactivity
-SESSION_COOKIE_AGE = 900  # seconds (30 minutes)
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
-# Reset the timer on every request
-SESSION_SAVE_EVERY_REQUEST = True
+# Sessions
+# db keeps sessions in the database.  cached_db reads them from the cache and
+# writes through to the database; use it only with a cache shared by every
+# worker (CACHE_BACKEND=file or db), or a worker can serve a stale session.
+# signed_cookies keeps the session in the browser and writes nothing here.
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_ENGINE = SESSION_ENGINES[config('SESSION_BACKEND', default='db')]
 
 # Optional: Make session expire when browser closes
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
@@ -158,4 +231,17 @@ SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 # Custom idle timeout (tracked via middleware)
 SESSION_IDLE_TIMEOUT = 900  # 900 seconds = 15 minutes
 
-SESSION_WARNING_TIME = 120   # warn 1 minute before logout
\ No newline at end of file
+# SessionTimeoutMiddleware stores the time of the last request at most once
+# per this many seconds, so most requests do not write the session back; 0
+# stores it on every request.  Nobody stays signed in past
+# SESSION_IDLE_TIMEOUT of inactivity; a user may be logged out up to this much
+# before it.
+SESSION_ACTIVITY_GRANULARITY = config('SESSION_ACTIVITY_GRANULARITY', default=60, cast=int)  # seconds
+
+SESSION_COOKIE_AGE = SESSION_IDLE_TIMEOUT
+
+SESSION_WARNING_TIME = 120   # warn 1 minute before logout
+
+# Longest the session-timeout script waits before telling the server about
+# activity; pings go to the ping_session view, at most one per interval
+SESSION_KEEPALIVE_INTERVAL = 60  # seconds
@@ -0,0 +1,174 @@
+"""
+Maintenance of the StockCountAdjustment table.
+
+A count's system quantity depends on the SKU's previous count and on the
+purchases and sales since, and its value on the latest purchase price, so a
+movement or count on day D can change the adjustment of every count of that
+SKU dated D or later.  refresh_adjustments() recomputes exactly those, for
+any number of SKUs at once: the counts to redo, the count before them, the
+cumulative purchase and sale totals at their dates and their prices (from the
+StockPrice history, so it must be refreshed first) are each read with one
+query per batch of SKUs.
+"""
+import heapq
+from decimal import Decimal
+from itertools import groupby
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+
+from .ledger import cumulative_movements, prior_counts
+from .models import Purchase, Sale, StockCountAdjustment, StockCountEntry, StockPrice
+
+ZERO = Decimal('0')
+
+# SKUs per round of queries when refreshing adjustments
+ADJUSTMENT_BATCH_SIZE = 500
+
+
+def _adjustment(model, entry_id, stock_id, day, counted, system_qty, price):
+    variance = counted - system_qty
+    return model(
+        entry_id=entry_id,
+        stock_code_id=stock_id,
+        date=day,
+        system_quantity=system_qty,
+        variance_quantity=variance,
+        unit_price=price,
+        variance_value=variance * price,
+    )
+
+
+def refresh_adjustments(keys):
+    """
+    Recompute the adjustments affected by movements or counts at ``keys``,
+    ``(stock_id, day)`` pairs: every count of the SKU dated on or after the
+    earliest of its days.
+    """
+    first_days = {}
+    for stock_id, day in keys:
+        first_days[stock_id] = min(day, first_days.get(stock_id, day))
+    stock_ids = sorted(first_days)
+
+    with transaction.atomic():
+        for i in range(0, len(stock_ids), ADJUSTMENT_BATCH_SIZE):
+            batch = stock_ids[i:i + ADJUSTMENT_BATCH_SIZE]
+            _refresh({stock_id: first_days[stock_id] for stock_id in batch})
+
+
+def _refresh(first_days):
+    stock_ids = list(first_days)
+    latest_price = Subquery(
+        StockPrice.objects.filter(stock_code=OuterRef('stock_code'), date__lte=OuterRef('session__date'))
+        .order_by('-date').values('price')[:1]
+    )
+    entries = [
+        entry for entry in StockCountEntry.objects.filter(
+            stock_code__in=stock_ids,
+            session__date__gte=min(first_days.values()),
+        ).annotate(count_date=F('session__date'), price=latest_price).order_by(
+            'stock_code', 'count_date', 'id'
+        ).values_list('id', 'stock_code', 'count_date', 'quantity_counted', 'price')
+        if entry[2] >= first_days[entry[1]]
+    ]
+    if not entries:
+        return
+
+    counted_ids = {entry[1] for entry in entries}
+    previous = prior_counts({stock_id: first_days[stock_id] for stock_id in counted_ids})
+    breakpoints = {entry[2] for entry in entries}
+    breakpoints.update(count_date for count_date, _ in previous.values())
+    purchases = cumulative_movements(Purchase, breakpoints, list(counted_ids))
+    sales = cumulative_movements(Sale, breakpoints, list(counted_ids))
+
+    adjustments = []
+    for stock_id, stock_entries in groupby(entries, key=lambda entry: entry[1]):
+        bought = purchases.get(stock_id, {})
+        sold = sales.get(stock_id, {})
+        prior_date, prior_qty = previous.get(stock_id, (None, ZERO))
+        for day, day_entries in groupby(stock_entries, key=lambda entry: entry[2]):
+            day_entries = list(day_entries)
+            system_qty = (
+                prior_qty
+                + bought.get(day, ZERO) - bought.get(prior_date, ZERO)
+                - sold.get(day, ZERO) + sold.get(prior_date, ZERO)
+            )
+            for entry_id, _, _, counted, price in day_entries:
+                adjustments.append(
+                    _adjustment(StockCountAdjustment, entry_id, stock_id, day, counted, system_qty, price or ZERO)
+                )
+            # The latest entry of the day is the next count's baseline, as in balances.py
+            prior_date, prior_qty = day, day_entries[-1][3]
+
+    entry_ids = [entry[0] for entry in entries]
+    for i in range(0, len(entry_ids), 500):
+        StockCountAdjustment.objects.filter(entry__in=entry_ids[i:i + 500]).delete()
+    StockCountAdjustment.objects.bulk_create(adjustments, batch_size=500)
+
+
+def rebuild_adjustments(batch_size=2000):
+    """
+    Rebuild the whole table from Purchase, Sale and StockCountEntry.
+
+    Streams purchases, daily sale totals and count entries ordered by
+    (stock, day) and merges them, so memory stays flat regardless of history
+    length.  Returns the number of rows written.
+    """
+    def purchases():
+        # Every line, oldest first, so the last one seen on a day sets the price
+        qs = Purchase.objects.values_list(
+            'stock_code', 'transaction_date', 'quantity', 'price_per_unit'
+        ).order_by('stock_code', 'transaction_date', 'id')
+        for stock_id, day, qty, price in qs.iterator(chunk_size=batch_size):
+            yield stock_id, day, 0, (qty, price)
+
+    def sales():
+        qs = Sale.objects.values_list('stock_code', 'transaction_date').annotate(
+            total=Sum('quantity')
+        ).order_by('stock_code', 'transaction_date')
+        for stock_id, day, total in qs.iterator(chunk_size=batch_size):
+            yield stock_id, day, 1, total
+
+    def counts():
+        qs = StockCountEntry.objects.values_list(
+            'id', 'stock_code', 'session__date', 'quantity_counted'
+        ).order_by('stock_code', 'session__date', 'id')
+        for entry_id, stock_id, day, counted in qs.iterator(chunk_size=batch_size):
+            yield stock_id, day, 2, (entry_id, counted)
+
+    # Within a day: purchases, then sales, then counts
+    merged = heapq.merge(purchases(), sales(), counts(), key=lambda item: (item[0], item[1], item[2]))
+
+    written = 0
+    with transaction.atomic():
+        StockCountAdjustment.objects.all().delete()
+
+        batch = []
+        current_stock, on_hand, price = None, ZERO, ZERO
+        for (stock_id, day), items in groupby(merged, key=lambda item: (item[0], item[1])):
+            if stock_id != current_stock:
+                current_stock, on_hand, price = stock_id, ZERO, ZERO
+
+            counted_today = None
+            for _, _, kind, value in items:
+                if kind == 0:
+                    on_hand += value[0]
+                    price = value[1] or ZERO
+                elif kind == 1:
+                    on_hand -= value
+                else:
+                    entry_id, counted_today = value
+                    batch.append(_adjustment(StockCountAdjustment, entry_id, stock_id, day, counted_today, on_hand, price))
+            if counted_today is not None:
+                on_hand = counted_today
+
+            if len(batch) >= batch_size:
+                StockCountAdjustment.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+
+        if batch:
+            StockCountAdjustment.objects.bulk_create(batch)
+            written += len(batch)
+
+    return written
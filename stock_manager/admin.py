@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Purchase, AuditLog
+from .models import Purchase, PurchaseDocument, Sale, SaleDocument, AuditLog, DocumentSequence
 
 @admin.register(AuditLog)
 class AuditLogAdmin(admin.ModelAdmin):
@@ -8,10 +8,56 @@ class AuditLogAdmin(admin.ModelAdmin):
     search_fields = ('description', 'user__username')
 
 admin.site.register(Purchase)
+admin.site.register(Sale)
 
     # ✅ Allow editing movement_type directly in the list view
 
 
+class PurchaseLineInline(admin.TabularInline):
+    # Lines are posted through services; edit them one by one from the Purchase admin
+    model = Purchase
+    fields = ('stock_code', 'quantity', 'price_per_unit')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(PurchaseDocument)
+class PurchaseDocumentAdmin(admin.ModelAdmin):
+    list_display = ('document_number', 'transaction_date', 'supplier_name', 'total_quantity', 'total_value')
+    search_fields = ('document_number', 'supplier_name')
+    readonly_fields = ('document_number', 'transaction_date', 'total_quantity', 'total_value')
+    inlines = [PurchaseLineInline]
+
+
+class SaleLineInline(admin.TabularInline):
+    # Lines are posted through services; edit them one by one from the Sale admin
+    model = Sale
+    fields = ('stock_code', 'quantity', 'price_per_unit')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(SaleDocument)
+class SaleDocumentAdmin(admin.ModelAdmin):
+    list_display = ('document_number', 'transaction_date', 'customer_name', 'total_quantity', 'total_value')
+    search_fields = ('document_number', 'customer_name')
+    readonly_fields = ('document_number', 'transaction_date', 'total_quantity', 'total_value')
+    inlines = [SaleLineInline]
+
+
+@admin.register(DocumentSequence)
+class DocumentSequenceAdmin(admin.ModelAdmin):
+    list_display = ('name', 'prefix', 'number_format', 'next_number')
+
+
 
 
 
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class StockManagerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'stock_manager'
+
+    def ready(self):
+        from . import signals  # noqa: F401
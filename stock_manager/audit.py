@@ -0,0 +1,225 @@
+"""
+Audit trail of creates, updates and deletes on the stock models.
+
+Signal receivers (see signals.py) and the bulk writers turn each write into
+an unsaved AuditLog row once the surrounding transaction commits.  Rows are
+not inserted on the request path: they go onto an in-process queue that a
+background thread drains, writing a batch with bulk_create() whenever
+AUDIT_BATCH_SIZE rows are waiting or AUDIT_FLUSH_INTERVAL seconds have passed
+since the first of them.  The queue is flushed at interpreter exit; rows still
+queued when a process is killed outright are lost.
+
+The queue holds at most AUDIT_QUEUE_SIZE rows.  When the writer falls that far
+behind, recording blocks until there is room again, so bursts slow down
+rather than drop entries.  With AUDIT_ASYNC = False rows are written straight
+away, which is what tests want.
+
+The user is taken from AuditUserMiddleware for the current request.
+"""
+import atexit
+import contextvars
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+
+from .models import AuditLog, Purchase, Sale, StockCountEntry, StockCountSession, StockTransaction
+from .stock_cache import stock_code_for
+
+logger = logging.getLogger(__name__)
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+# model_name values of the models signals.py audits
+AUDITED_MODEL_NAMES = tuple(model._meta.model_name for model in (
+    StockTransaction, Purchase, Sale, StockCountSession, StockCountEntry,
+))
+
+_current_user = contextvars.ContextVar('audit_user', default=None)
+_STOP = object()
+_FLUSH = object()
+
+
+def set_current_user(user):
+    """
+    Attribute rows recorded from now on in this context to ``user`` (which may
+    be request.user, still lazy: it is only resolved if something is audited).
+    Returns a token for reset_current_user().
+    """
+    return _current_user.set(user)
+
+
+def reset_current_user(token):
+    _current_user.reset(token)
+
+
+def _current_user_id():
+    user = _current_user.get()
+    if user is None or not user.is_authenticated:
+        return None
+    return user.pk
+
+
+class AuditWriter:
+    def __init__(self, batch_size, flush_interval, queue_size):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # A thread started before a fork (e.g. gunicorn --preload) does not
+        # exist in the child, so each process starts its own.
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def put(self, entries):
+        self._ensure_started()
+        for entry in entries:
+            self._queue.put(entry)
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = None
+            stopping = entry is _STOP
+            flushing = entry is _FLUSH
+            if entry is not None and not stopping and not flushing:
+                pending.append(entry)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if pending and (stopping or flushing or len(pending) >= self.batch_size
+                            or time.monotonic() >= deadline):
+                self._write(pending)
+                for _ in pending:
+                    self._queue.task_done()
+                pending = []
+                deadline = None
+            if flushing:
+                self._queue.task_done()
+            if stopping:
+                self._queue.task_done()
+                return
+
+    def _write(self, entries):
+        close_old_connections()
+        try:
+            AuditLog.objects.bulk_create(entries, batch_size=self.batch_size)
+        except DatabaseError:
+            # One bad row (say, a user deleted meanwhile) must not cost the batch
+            for entry in entries:
+                try:
+                    entry.save()
+                except DatabaseError:
+                    logger.exception("Could not write audit log entry: %s", entry.description)
+
+    def flush(self):
+        """Write every row queued so far, full batch or not, and block until it is."""
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    def stop(self, timeout=10):
+        """Write what is queued and stop the thread."""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+
+writer = AuditWriter(
+    batch_size=getattr(settings, 'AUDIT_BATCH_SIZE', 500),
+    flush_interval=getattr(settings, 'AUDIT_FLUSH_INTERVAL', 2.0),
+    queue_size=getattr(settings, 'AUDIT_QUEUE_SIZE', 10000),
+)
+atexit.register(writer.stop)
+
+
+def _write_now(entries):
+    AuditLog.objects.bulk_create(entries)
+
+
+def record_entries(entries):
+    """Queue AuditLog rows to be written after the current transaction commits."""
+    entries = list(entries)
+    if not entries:
+        return
+    if getattr(settings, 'AUDIT_ASYNC', True):
+        transaction.on_commit(lambda: writer.put(entries))
+    else:
+        transaction.on_commit(lambda: _write_now(entries))
+
+
+def audit_entry(action, instance, description, session_id=None):
+    """Unsaved AuditLog row for ``action`` on ``instance``, stamped now."""
+    return AuditLog(
+        timestamp=timezone.now(),
+        user_id=_current_user_id(),
+        action=action,
+        model_name=instance._meta.model_name,
+        object_id=instance.pk,
+        description=description,
+        session_id=session_id,
+    )
+
+
+def _stock_code(instance):
+    if type(instance).stock_code.is_cached(instance):
+        return instance.stock_code.stock_code
+    return stock_code_for(instance.stock_code_id) or f"#{instance.stock_code_id}"
+
+
+def describe(instance):
+    """One-line description of an audited row, built without queries where possible."""
+    if isinstance(instance, StockTransaction):
+        return f"{instance.stock_code} - {instance.stock_description} ({instance.uom})"
+    if isinstance(instance, (Purchase, Sale)):
+        return (f"{instance.document_number}: {instance.quantity} x {_stock_code(instance)} "
+                f"@ {instance.price_per_unit} on {instance.transaction_date}")
+    if isinstance(instance, StockCountSession):
+        return f"Stock count session on {instance.date}"
+    if isinstance(instance, StockCountEntry):
+        return f"{_stock_code(instance)} counted {instance.quantity_counted} in session #{instance.session_id}"
+    return str(instance)
+
+
+def record(action, instance):
+    """
+    Audit one write.  Deletes are not linked to a count session, since the
+    session may be going away in the same delete.
+    """
+    session_id = None
+    if action != DELETE:
+        if isinstance(instance, StockCountSession):
+            session_id = instance.pk
+        elif isinstance(instance, StockCountEntry):
+            session_id = instance.session_id
+    record_entries([audit_entry(action, instance, describe(instance), session_id)])
+
+
+def record_created(objects):
+    """Audit rows written with bulk_create(); those the backend returned no id for are skipped."""
+    record_entries(audit_entry(CREATE, obj, describe(obj)) for obj in objects if obj.pk is not None)
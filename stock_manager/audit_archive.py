@@ -0,0 +1,130 @@
+"""
+Retention for the audit log: old rows move to monthly archive files.
+
+archive_audit_log() walks the rows older than a cutoff in (timestamp, id)
+order, ``batch_size`` at a time.  Each batch is appended to one gzip-compressed
+JSON-lines file per calendar month (UTC), ``audit-YYYY-MM.jsonl.gz``, synced
+to disk, and only then deleted from the table in its own short transaction,
+so no transaction or lock spans the whole run and a failure loses nothing.
+
+Every batch is a separate gzip member appended to the file, which gzip
+readers treat as one stream.  A run that stops between writing a batch and
+deleting it leaves those rows in both places; the next run archives them
+again and read_archive() skips the repeats, since rows are always written in
+ascending (timestamp, id) order within a file.
+
+read_archive() streams matching rows straight from the files, so archived
+history can be searched without loading it back into the database.
+"""
+import gzip
+import json
+import os
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from .models import AuditLog
+
+ARCHIVE_FIELDS = ('id', 'timestamp', 'user_id', 'action', 'model_name', 'object_id', 'description', 'session_id')
+ARCHIVE_NAME = 'audit-{:%Y-%m}.jsonl.gz'
+ARCHIVE_PATTERN = re.compile(r'^audit-(\d{4})-(\d{2})\.jsonl\.gz$')
+DEFAULT_BATCH_SIZE = 5000
+
+
+def archive_path(directory, month):
+    return os.path.join(directory, ARCHIVE_NAME.format(month))
+
+
+def _row(values):
+    row = dict(zip(ARCHIVE_FIELDS, values))
+    row['timestamp'] = row['timestamp'].astimezone(dt_timezone.utc).isoformat()
+    return row
+
+
+def _append(directory, rows):
+    """Append ``rows`` to their monthly files and sync them to disk."""
+    by_month = {}
+    for row in rows:
+        month = parse_datetime(row['timestamp']).date().replace(day=1)
+        by_month.setdefault(month, []).append(row)
+
+    for month, month_rows in by_month.items():
+        path = archive_path(directory, month)
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(filename='', mode='wb', fileobj=raw) as archive:
+                for row in month_rows:
+                    archive.write(json.dumps(row, separators=(',', ':')).encode() + b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+
+
+def archive_audit_log(cutoff, directory, batch_size=DEFAULT_BATCH_SIZE, dry_run=False):
+    """
+    Move AuditLog rows with a timestamp before ``cutoff`` (an aware datetime)
+    into the monthly archives in ``directory``.  Returns the number of rows
+    archived (with ``dry_run``, the number that would be).
+    """
+    old_rows = AuditLog.objects.filter(timestamp__lt=cutoff)
+    if dry_run:
+        return old_rows.count()
+
+    os.makedirs(directory, exist_ok=True)
+    archived = 0
+    while True:
+        # Always the oldest remaining batch: each one is deleted before the next
+        batch = list(old_rows.order_by('timestamp', 'id').values_list(*ARCHIVE_FIELDS)[:batch_size])
+        if not batch:
+            return archived
+        _append(directory, [_row(values) for values in batch])
+        with transaction.atomic():
+            AuditLog.objects.filter(pk__in=[values[0] for values in batch]).delete()
+        archived += len(batch)
+
+
+def archive_months(directory):
+    """``{month (first day): path}`` of the archive files in ``directory``."""
+    months = {}
+    if not os.path.isdir(directory):
+        return months
+    for name in os.listdir(directory):
+        match = ARCHIVE_PATTERN.match(name)
+        if match:
+            month = datetime(int(match[1]), int(match[2]), 1).date()
+            months[month] = os.path.join(directory, name)
+    return dict(sorted(months.items()))
+
+
+def read_archive(directory, start=None, end=None, user_id=None, action=None, model_name=None, object_id=None):
+    """
+    Archived rows as dicts, oldest first, with timestamps between the aware
+    datetimes ``start`` (inclusive) and ``end`` (exclusive) and matching the
+    other filters given.  Only the files for months in range are opened.
+    """
+    wanted = {
+        name: value for name, value in (
+            ('user_id', user_id), ('action', action), ('model_name', model_name), ('object_id', object_id),
+        ) if value is not None
+    }
+    first_month = start.astimezone(dt_timezone.utc).date().replace(day=1) if start else None
+    last_month = (end - timedelta(microseconds=1)).astimezone(dt_timezone.utc).date().replace(day=1) if end else None
+
+    for month, path in archive_months(directory).items():
+        if (first_month and month < first_month) or (last_month and month > last_month):
+            continue
+        last_key = None
+        with gzip.open(path, 'rt', encoding='utf-8') as archive:
+            for line in archive:
+                row = json.loads(line)
+                row['timestamp'] = parse_datetime(row['timestamp'])
+                key = (row['timestamp'], row['id'])
+                if last_key is not None and key <= last_key:
+                    continue  # archived again after an interrupted run
+                last_key = key
+                if start and row['timestamp'] < start:
+                    continue
+                if end and row['timestamp'] >= end:
+                    continue
+                if all(row[name] == value for name, value in wanted.items()):
+                    yield row
@@ -0,0 +1,362 @@
+"""
+Maintenance and lookups for the StockDailyBalance table.
+
+Every Purchase, Sale and StockCountEntry write refreshes the (stock, day) row
+it touches and shifts the closing quantity of the later rows up to the next
+count, which resets the baseline.  Backdated entries therefore roll forward
+without replaying history, and "on hand as of X" is a single indexed lookup.
+"""
+import heapq
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from itertools import groupby
+
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, Max, Min, Q, Sum, Value, When, Window
+from django.db.models.functions import RowNumber
+
+from .models import Purchase, Sale, StockCountEntry, StockDailyBalance, StockTransaction
+
+ZERO = Decimal('0')
+
+# SKUs per locking/UPDATE round when applying movements in bulk
+BALANCE_BATCH_SIZE = 200
+
+
+def on_hand(stock, as_of):
+    """Quantity on hand for one SKU at the end of ``as_of``."""
+    closing = StockDailyBalance.objects.filter(
+        stock_code=stock,
+        date__lte=as_of
+    ).order_by('-date').values_list('closing_quantity', flat=True).first()
+    return closing if closing is not None else ZERO
+
+
+def closing_balances(as_of, stock_ids=None):
+    """
+    Quantity on hand at the end of ``as_of`` for many SKUs in one query.
+
+    ``stock_ids`` may be None (every SKU), a list of pks or a pk queryset.
+    Returns ``{stock_id: qty}``; SKUs without any balance row are omitted.
+    """
+    qs = StockDailyBalance.objects.filter(date__lte=as_of)
+    if stock_ids is not None:
+        qs = qs.filter(stock_code__in=stock_ids)
+    qs = qs.annotate(
+        rank=Window(
+            RowNumber(),
+            partition_by=[F('stock_code')],
+            order_by=[F('date').desc()],
+        )
+    ).filter(rank=1)
+    return dict(qs.values_list('stock_code', 'closing_quantity'))
+
+
+def refresh_balance(stock_id, day):
+    """
+    Recompute the balance row of one SKU for one day from the source tables
+    and roll the change in closing quantity forward to the next count.
+    """
+    with transaction.atomic():
+        # Serialise balance maintenance per SKU
+        StockTransaction.objects.select_for_update().filter(pk=stock_id).first()
+
+        quantity_in = Purchase.objects.filter(
+            stock_code_id=stock_id,
+            transaction_date=day
+        ).aggregate(total=Sum('quantity'))['total'] or ZERO
+        quantity_out = Sale.objects.filter(
+            stock_code_id=stock_id,
+            transaction_date=day
+        ).aggregate(total=Sum('quantity'))['total'] or ZERO
+        quantity_counted = StockCountEntry.objects.filter(
+            stock_code_id=stock_id,
+            session__date=day
+        ).order_by('-id').values_list('quantity_counted', flat=True).first()
+
+        opening = on_hand(stock_id, day - timedelta(days=1))
+        if quantity_counted is not None:
+            closing = quantity_counted
+        else:
+            closing = opening + quantity_in - quantity_out
+
+        row = StockDailyBalance.objects.filter(stock_code_id=stock_id, date=day).first()
+        previous_closing = row.closing_quantity if row else opening
+
+        if not quantity_in and not quantity_out and quantity_counted is None:
+            if row:
+                row.delete()
+        else:
+            if row is None:
+                row = StockDailyBalance(stock_code_id=stock_id, date=day)
+            row.quantity_in = quantity_in
+            row.quantity_out = quantity_out
+            row.quantity_counted = quantity_counted
+            row.closing_quantity = closing
+            row.save()
+
+        _roll_forward(stock_id, day, closing - previous_closing)
+
+
+def refresh_balances(keys):
+    """Refresh several ``(stock_id, day)`` pairs, oldest first."""
+    with transaction.atomic():
+        for stock_id, day in sorted(set(keys)):
+            refresh_balance(stock_id, day)
+
+
+def apply_movements(day, quantities_in=None, quantities_out=None):
+    """
+    Bulk counterpart of refresh_balance() for freshly inserted movements that
+    all fall on ``day``, e.g. the lines of one document.
+
+    ``quantities_in`` and ``quantities_out`` map stock ids to the quantity
+    added.  See apply_movement_batch().
+    """
+    quantities_in = quantities_in or {}
+    quantities_out = quantities_out or {}
+    apply_movement_batch({
+        (stock_id, day): (quantities_in.get(stock_id, ZERO), quantities_out.get(stock_id, ZERO))
+        for stock_id in set(quantities_in) | set(quantities_out)
+    })
+
+
+def apply_movement_batch(movements, counts=None):
+    """
+    Update the balances for freshly inserted movements on any number of days.
+
+    ``movements`` maps ``(stock_id, day)`` to the ``(quantity_in,
+    quantity_out)`` added; ``counts`` maps ``(stock_id, day)`` to the quantity
+    of that day's latest count entry, for freshly written counts.  For each SKU the rows from its first to its last
+    affected day are recomputed in Python and the changed ones rewritten, and
+    every later row up to the next count is shifted in one UPDATE per
+    ``BALANCE_BATCH_SIZE`` SKUs, so the cost does not grow with the number of
+    days involved.
+    """
+    by_stock = defaultdict(dict)
+    for (stock_id, day), (quantity_in, quantity_out) in movements.items():
+        by_stock[stock_id][day] = (quantity_in, quantity_out, None)
+    for (stock_id, day), counted in (counts or {}).items():
+        quantity_in, quantity_out, _ = by_stock[stock_id].get(day, (ZERO, ZERO, None))
+        by_stock[stock_id][day] = (quantity_in, quantity_out, counted)
+    stock_ids = sorted(by_stock)
+
+    with transaction.atomic():
+        for i in range(0, len(stock_ids), BALANCE_BATCH_SIZE):
+            batch = stock_ids[i:i + BALANCE_BATCH_SIZE]
+            _apply_stock_movements({stock_id: by_stock[stock_id] for stock_id in batch})
+
+
+def _apply_stock_movements(changes):
+    stock_ids = list(changes)
+    list(StockTransaction.objects.select_for_update().filter(pk__in=stock_ids).values_list('pk'))
+
+    # One range over the whole batch rather than a per-SKU OR of ranges,
+    # which the planners handle badly; the rows each SKU needs are picked
+    # out below
+    spans = {stock_id: (min(days), max(days)) for stock_id, days in changes.items()}
+    first_day = min(first for first, _ in spans.values())
+    last_day = max(last for _, last in spans.values())
+
+    existing = defaultdict(list)
+    for row in StockDailyBalance.objects.filter(
+        stock_code__in=stock_ids,
+        date__gte=first_day,
+        date__lte=last_day
+    ).order_by('date'):
+        existing[row.stock_code_id].append(row)
+    opening = closing_balances(first_day - timedelta(days=1), stock_ids)
+
+    replaced = []
+    new_rows = []
+    shifts = {}
+    for stock_id, days in changes.items():
+        first, last = spans[stock_id]
+        closing = opening.get(stock_id, ZERO)
+        rows = {}
+        for row in existing[stock_id]:
+            if row.date < first:
+                closing = row.closing_quantity
+            elif row.date <= last:
+                rows[row.date] = row
+        old_closing = closing
+
+        for day in sorted(set(rows) | set(days)):
+            added_in, added_out, counted = days.get(day, (ZERO, ZERO, None))
+            row = rows.get(day)
+            if row is None:
+                row = StockDailyBalance(stock_code_id=stock_id, date=day, quantity_in=ZERO, quantity_out=ZERO)
+            else:
+                old_closing = row.closing_quantity
+
+            quantity_in = row.quantity_in + added_in
+            quantity_out = row.quantity_out + added_out
+            quantity_counted = row.quantity_counted if counted is None else counted
+            if quantity_counted is not None:
+                closing = quantity_counted
+            else:
+                closing = closing + quantity_in - quantity_out
+
+            if row.pk is not None:
+                if (quantity_in, quantity_out, quantity_counted, closing) == (
+                    row.quantity_in, row.quantity_out, row.quantity_counted, row.closing_quantity
+                ):
+                    continue
+                replaced.append(row.pk)
+            new_rows.append(StockDailyBalance(
+                stock_code_id=stock_id,
+                date=day,
+                quantity_in=quantity_in,
+                quantity_out=quantity_out,
+                quantity_counted=quantity_counted,
+                closing_quantity=closing,
+            ))
+
+        shifts[stock_id] = (last, closing - old_closing)
+
+    # Replacing is cheaper than a per-row UPDATE through bulk_update()
+    for i in range(0, len(replaced), 500):
+        StockDailyBalance.objects.filter(pk__in=replaced[i:i + 500]).delete()
+    StockDailyBalance.objects.bulk_create(new_rows, batch_size=500)
+    _shift_later_rows(shifts)
+
+
+def _shift_later_rows(shifts):
+    """
+    Add ``delta`` to the closing quantity of every row after ``day`` up to the
+    next count, for each ``stock_id: (day, delta)`` in ``shifts``.
+    """
+    shifts = {stock_id: shift for stock_id, shift in shifts.items() if shift[1]}
+    if not shifts:
+        return
+
+    first_day = min(day for day, _ in shifts.values())
+    later = StockDailyBalance.objects.filter(stock_code__in=list(shifts), date__gt=first_day)
+
+    # Most SKUs in a chronological batch have nothing after it to shift
+    last_dates = dict(later.values_list('stock_code').annotate(last_date=Max('date')).order_by())
+    shifts = {
+        stock_id: (day, delta) for stock_id, (day, delta) in shifts.items()
+        if last_dates.get(stock_id) and last_dates[stock_id] > day
+    }
+    if not shifts:
+        return
+    later = later.filter(stock_code__in=list(shifts))
+
+    next_counts = {}
+    for stock_id, count_date in later.filter(quantity_counted__isnull=False).order_by('date').values_list(
+        'stock_code', 'date'
+    ):
+        if count_date > shifts[stock_id][0]:
+            next_counts.setdefault(stock_id, count_date)
+
+    whens = []
+    for stock_id, (day, delta) in shifts.items():
+        bounds = Q(stock_code_id=stock_id, date__gt=day)
+        if stock_id in next_counts:
+            bounds &= Q(date__lt=next_counts[stock_id])
+        whens.append(When(bounds, then=Value(delta)))
+
+    later.filter(quantity_counted__isnull=True).update(
+        closing_quantity=F('closing_quantity') + Case(
+            *whens,
+            default=Value(ZERO),
+            output_field=DecimalField(max_digits=14, decimal_places=2),
+        )
+    )
+
+
+def _roll_forward(stock_id, day, delta):
+    if not delta:
+        return
+
+    later = StockDailyBalance.objects.filter(stock_code_id=stock_id, date__gt=day)
+    next_count_date = later.filter(
+        quantity_counted__isnull=False
+    ).aggregate(next_date=Min('date'))['next_date']
+    if next_count_date:
+        later = later.filter(date__lt=next_count_date)
+
+    later.update(closing_quantity=F('closing_quantity') + delta)
+
+
+def rebuild_daily_balances(batch_size=2000):
+    """
+    Rebuild the whole table from Purchase, Sale and StockCountEntry.
+
+    Streams per-day totals ordered by (stock, day) from the three sources and
+    merges them, so memory stays flat regardless of history length.
+    Returns the number of rows written.
+    """
+    def daily_totals(model, kind):
+        qs = (
+            model.objects.values_list('stock_code', 'transaction_date')
+            .annotate(total=Sum('quantity'))
+            .order_by('stock_code', 'transaction_date')
+        )
+        for stock_id, day, total in qs.iterator(chunk_size=batch_size):
+            yield stock_id, day, kind, total
+
+    def daily_counts():
+        # Latest entry per (stock, day) wins, as in refresh_balance()
+        qs = (
+            StockCountEntry.objects.annotate(
+                count_date=F('session__date'),
+                rank=Window(
+                    RowNumber(),
+                    partition_by=[F('stock_code'), F('session__date')],
+                    order_by=[F('id').desc()],
+                ),
+            )
+            .filter(rank=1)
+            .values_list('stock_code', 'count_date', 'quantity_counted')
+            .order_by('stock_code', 'count_date')
+        )
+        for stock_id, day, qty in qs.iterator(chunk_size=batch_size):
+            yield stock_id, day, 'counted', qty
+
+    merged = heapq.merge(
+        daily_totals(Purchase, 'in'),
+        daily_totals(Sale, 'out'),
+        daily_counts(),
+        key=lambda item: (item[0], item[1]),
+    )
+
+    written = 0
+    with transaction.atomic():
+        StockDailyBalance.objects.all().delete()
+
+        batch = []
+        current_stock, closing = None, ZERO
+        for (stock_id, day), items in groupby(merged, key=lambda item: (item[0], item[1])):
+            if stock_id != current_stock:
+                current_stock, closing = stock_id, ZERO
+
+            totals = {'in': ZERO, 'out': ZERO, 'counted': None}
+            for _, _, kind, value in items:
+                totals[kind] = value
+
+            if totals['counted'] is not None:
+                closing = totals['counted']
+            else:
+                closing = closing + totals['in'] - totals['out']
+
+            batch.append(StockDailyBalance(
+                stock_code_id=stock_id,
+                date=day,
+                quantity_in=totals['in'],
+                quantity_out=totals['out'],
+                quantity_counted=totals['counted'],
+                closing_quantity=closing,
+            ))
+            if len(batch) >= batch_size:
+                StockDailyBalance.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+
+        if batch:
+            StockDailyBalance.objects.bulk_create(batch)
+            written += len(batch)
+
+    return written
@@ -7,4 +7,5 @@ def session_timeout_settings(request):
     return {
         'SESSION_IDLE_TIMEOUT': getattr(settings, 'SESSION_IDLE_TIMEOUT', 900),
         'SESSION_WARNING_TIME': getattr(settings, 'SESSION_WARNING_TIME', 120),
+        'SESSION_KEEPALIVE_INTERVAL': getattr(settings, 'SESSION_KEEPALIVE_INTERVAL', 60),
     }
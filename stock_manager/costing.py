@@ -0,0 +1,366 @@
+"""
+Inventory costing: what the stock on hand cost, first in first out or at a
+moving weighted average.
+
+The cost position of each SKU is kept per day in StockCostBalance, next to
+its StockDailyBalance row, so the cost of stock as of any date is one indexed
+lookup.  FIFO also needs the receipts not yet issued, which it keeps as
+CostLayer rows.  Positions come from replaying a SKU's days in order: the day's
+purchases are received at their price, its sales issued, and on a count day
+the quantity is brought to the counted one, a shortage issued like a sale and
+a surplus received at the current unit cost.  The quantity is therefore
+always the daily balance's closing quantity.
+
+A write on day D changes positions from D on only.  refresh_costs() restarts
+each SKU from its last position before D (with, for FIFO, the layers still
+open then) and replays just the days since, for any number of SKUs in a fixed
+number of queries per batch.  It reads the daily balances, so those must be
+refreshed first.  rebuild_costs() replays the whole history, streamed.
+
+A method is a CostingMethod subclass registered in COSTING_METHODS; the
+INVENTORY_COSTING_METHOD setting picks the one that is maintained and read.
+"""
+import heapq
+from collections import defaultdict, deque
+from decimal import Decimal
+from itertools import groupby
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.db.models import DecimalField, F, Min, OuterRef, Q, Subquery, Sum, Value, Window
+from django.db.models.functions import Coalesce, RowNumber
+
+from .models import CostLayer, Purchase, StockCostBalance, StockDailyBalance
+
+ZERO = Decimal('0')
+COST_PLACES = Decimal('0.0001')
+
+# SKUs per round of queries when refreshing cost positions
+COSTING_BATCH_SIZE = 500
+
+
+class CostingMethod:
+    """
+    Running cost position of one SKU, started from a stored position
+    ``(quantity, unit_cost, value, received_total, issued_total)`` and, for
+    methods that keep layers, the ``(quantity, unit_cost,
+    cumulative_quantity)`` of its open layers.  Subclasses work out
+    ``unit_cost`` and ``value`` as stock is received and issued.
+    """
+    name = None
+    keeps_layers = False
+
+    def __init__(self, position=None, open_layers=()):
+        self.quantity, self.unit_cost, self.value, self.received_total, self.issued_total = (
+            position or (ZERO, ZERO, ZERO, ZERO, ZERO)
+        )
+        # (date, quantity, unit_cost, cumulative_quantity) received since the start
+        self.received = []
+
+    def receive(self, day, quantity, unit_cost):
+        self.quantity += quantity
+        self.received_total += quantity
+        self.received.append((day, quantity, unit_cost, self.received_total))
+
+    def issue(self, quantity):
+        self.quantity -= quantity
+        self.issued_total += quantity
+
+    def count(self, day, counted):
+        """Bring the quantity to ``counted``."""
+        difference = counted - self.quantity
+        if difference > 0:
+            self.receive(day, difference, self.unit_cost)
+        elif difference < 0:
+            self.issue(-difference)
+
+    def position(self):
+        return (
+            self.quantity, self.unit_cost.quantize(COST_PLACES), self.value.quantize(COST_PLACES),
+            self.received_total, self.issued_total,
+        )
+
+
+class FifoCost(CostingMethod):
+    """
+    First in, first out: issues use up the oldest layers first, so the stock
+    on hand is the latest receipts.  Stock issued beyond what was received is
+    valued at the latest receipt's cost until a receipt covers it.
+    """
+    name = 'fifo'
+    keeps_layers = True
+
+    def __init__(self, position=None, open_layers=()):
+        super().__init__(position)
+        # [quantity left, unit_cost] of the open layers, oldest first
+        self.open = deque()
+        self.open_value = ZERO
+        for quantity, unit_cost, cumulative in open_layers:
+            self._open(min(quantity, cumulative - self.issued_total), unit_cost)
+        self._revalue()
+
+    def _open(self, quantity, unit_cost):
+        if quantity > 0:
+            self.open.append([quantity, unit_cost])
+            self.open_value += quantity * unit_cost
+
+    def _revalue(self):
+        self.value = self.open_value if self.quantity > 0 else self.quantity * self.unit_cost
+
+    def receive(self, day, quantity, unit_cost):
+        super().receive(day, quantity, unit_cost)
+        self.unit_cost = unit_cost
+        # Anything issued short is taken from this layer straight away
+        self._open(min(quantity, self.received_total - self.issued_total), unit_cost)
+        self._revalue()
+
+    def issue(self, quantity):
+        super().issue(quantity)
+        while quantity > 0 and self.open:
+            layer = self.open[0]
+            taken = min(layer[0], quantity)
+            layer[0] -= taken
+            quantity -= taken
+            self.open_value -= taken * layer[1]
+            if not layer[0]:
+                self.open.popleft()
+        self._revalue()
+
+
+class AverageCost(CostingMethod):
+    """
+    Moving weighted average: each receipt is averaged into the cost of the
+    stock already on hand, and issues go out at that average.
+    """
+    name = 'average'
+
+    def receive(self, day, quantity, unit_cost):
+        if self.quantity > 0:
+            total = self.value + quantity * unit_cost
+            self.unit_cost = (total / (self.quantity + quantity)).quantize(COST_PLACES)
+        else:
+            # Nothing on hand to average with
+            self.unit_cost = unit_cost
+        super().receive(day, quantity, unit_cost)
+        self.value = (self.quantity * self.unit_cost).quantize(COST_PLACES)
+
+    def issue(self, quantity):
+        super().issue(quantity)
+        self.value = (self.quantity * self.unit_cost).quantize(COST_PLACES)
+
+
+COSTING_METHODS = {method.name: method for method in (FifoCost, AverageCost)}
+
+
+def costing_method(name=None):
+    """The CostingMethod subclass called ``name``, by default the configured one."""
+    name = name or getattr(settings, 'INVENTORY_COSTING_METHOD', 'fifo')
+    try:
+        return COSTING_METHODS[name]
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"Unknown inventory costing method {name!r}; expected one of {', '.join(COSTING_METHODS)}."
+        )
+
+
+def _close_day(costing, stock_id, day, receipts, quantity_out, quantity_counted, balance_model, layer_model):
+    """
+    Apply one day of a SKU to ``costing`` and return its balance row and the
+    layers it received, unsaved.
+    """
+    for quantity, unit_cost in receipts:
+        costing.receive(day, quantity, unit_cost)
+    if quantity_out:
+        costing.issue(quantity_out)
+    if quantity_counted is not None:
+        costing.count(day, quantity_counted)
+
+    quantity, unit_cost, value, received_total, issued_total = costing.position()
+    balance = balance_model(
+        stock_code_id=stock_id, method=costing.name, date=day, quantity=quantity, unit_cost=unit_cost,
+        value=value, received_total=received_total, issued_total=issued_total,
+    )
+    layers = [
+        layer_model(
+            stock_code_id=stock_id, method=costing.name, date=received_on, quantity=quantity,
+            unit_cost=unit_cost, cumulative_quantity=cumulative,
+        )
+        for received_on, quantity, unit_cost, cumulative in costing.received
+    ] if costing.keeps_layers else []
+    costing.received = []
+    return balance, layers
+
+
+def _daily_receipts(purchases):
+    """Purchases summed per (stock, day, price), in order of each group's first line."""
+    return purchases.values('stock_code', 'transaction_date', 'price_per_unit').annotate(
+        total=Sum('quantity'), first_id=Min('id'),
+    ).order_by('stock_code', 'transaction_date', 'first_id').values_list(
+        'stock_code', 'transaction_date', 'total', 'price_per_unit'
+    )
+
+
+def _from_own_date(field, dates):
+    """Q for rows of each SKU in ``dates`` (``{stock_id: date}``) dated on or after that SKU's own date."""
+    by_date = defaultdict(list)
+    for stock_id, day in dates.items():
+        by_date[day].append(stock_id)
+    condition = Q(pk__in=[])
+    for day, stock_ids in by_date.items():
+        condition |= Q(stock_code__in=stock_ids, **{f'{field}__gte': day})
+    return condition
+
+
+def refresh_costs(keys, method=None):
+    """
+    Recompute the cost positions affected by movements or counts at
+    ``keys``, ``(stock_id, day)`` pairs: every position of the SKU from the
+    earliest of its days on, under ``method`` (the configured one by default).
+    """
+    first_days = {}
+    for stock_id, day in keys:
+        first_days[stock_id] = min(day, first_days.get(stock_id, day))
+    stock_ids = sorted(first_days)
+    costing = costing_method(method)
+
+    with transaction.atomic():
+        for i in range(0, len(stock_ids), COSTING_BATCH_SIZE):
+            batch = stock_ids[i:i + COSTING_BATCH_SIZE]
+            _refresh(costing, {stock_id: first_days[stock_id] for stock_id in batch})
+
+
+def _refresh(costing, first_days):
+    stock_ids = list(first_days)
+    balances = StockCostBalance.objects.filter(method=costing.name)
+    layers = CostLayer.objects.filter(method=costing.name)
+    balances.filter(_from_own_date('date', first_days)).delete()
+    layers.filter(_from_own_date('date', first_days)).delete()
+
+    # What is left of each SKU ends before its first day: start from there
+    previous = {
+        stock_id: position
+        for stock_id, *position in balances.filter(stock_code__in=stock_ids).annotate(
+            rank=Window(RowNumber(), partition_by=[F('stock_code')], order_by=[F('date').desc()]),
+        ).filter(rank=1).values_list('stock_code', 'quantity', 'unit_cost', 'value', 'received_total', 'issued_total')
+    }
+    open_layers = defaultdict(list)
+    if costing.keeps_layers:
+        issued = Coalesce(
+            Subquery(balances.filter(stock_code=OuterRef('stock_code')).order_by('-date').values('issued_total')[:1]),
+            Value(ZERO),
+            output_field=DecimalField(max_digits=16, decimal_places=2),
+        )
+        for stock_id, quantity, unit_cost, cumulative in layers.filter(
+            stock_code__in=stock_ids, cumulative_quantity__gt=issued,
+        ).order_by('stock_code', 'cumulative_quantity').values_list(
+            'stock_code', 'quantity', 'unit_cost', 'cumulative_quantity'
+        ):
+            open_layers[stock_id].append((quantity, unit_cost, cumulative))
+
+    receipts = defaultdict(list)
+    for stock_id, day, quantity, price in _daily_receipts(
+        Purchase.objects.filter(_from_own_date('transaction_date', first_days))
+    ):
+        receipts[stock_id, day].append((quantity, price))
+    days = StockDailyBalance.objects.filter(_from_own_date('date', first_days)).order_by(
+        'stock_code', 'date'
+    ).values_list('stock_code', 'date', 'quantity_out', 'quantity_counted')
+
+    new_balances, new_layers = [], []
+    for stock_id, stock_days in groupby(days, key=lambda row: row[0]):
+        position = costing(previous.get(stock_id), open_layers.get(stock_id, ()))
+        for _, day, quantity_out, quantity_counted in stock_days:
+            balance, received = _close_day(
+                position, stock_id, day, receipts.get((stock_id, day), ()), quantity_out, quantity_counted,
+                StockCostBalance, CostLayer,
+            )
+            new_balances.append(balance)
+            new_layers.extend(received)
+    StockCostBalance.objects.bulk_create(new_balances, batch_size=500)
+    CostLayer.objects.bulk_create(new_layers, batch_size=500)
+
+
+def rebuild_costs(method=None, batch_size=2000):
+    """
+    Rebuild the cost positions and layers of ``method`` (the configured one
+    by default) from the purchases and the daily balances, which must be
+    current.
+
+    Streams daily receipts and balances ordered by (stock, day) and merges
+    them, so memory stays flat regardless of history length.  Returns the
+    number of positions written.
+    """
+    costing = costing_method(method)
+
+    def receipts():
+        for stock_id, day, quantity, price in _daily_receipts(Purchase.objects).iterator(
+            chunk_size=batch_size
+        ):
+            yield stock_id, day, 0, (quantity, price)
+
+    def days():
+        qs = StockDailyBalance.objects.values_list(
+            'stock_code', 'date', 'quantity_out', 'quantity_counted'
+        ).order_by('stock_code', 'date')
+        for stock_id, day, quantity_out, quantity_counted in qs.iterator(chunk_size=batch_size):
+            yield stock_id, day, 1, (quantity_out, quantity_counted)
+
+    # Within a day: the receipts, then the day's outs and count
+    merged = heapq.merge(receipts(), days(), key=lambda item: (item[0], item[1], item[2]))
+
+    written = 0
+    with transaction.atomic():
+        StockCostBalance.objects.filter(method=costing.name).delete()
+        CostLayer.objects.filter(method=costing.name).delete()
+
+        balances, layers = [], []
+        current_stock, position = None, None
+        for (stock_id, day), items in groupby(merged, key=lambda item: (item[0], item[1])):
+            if stock_id != current_stock:
+                current_stock, position = stock_id, costing()
+
+            day_receipts, quantity_out, quantity_counted = [], ZERO, None
+            for _, _, kind, value in items:
+                if kind == 0:
+                    day_receipts.append(value)
+                else:
+                    quantity_out, quantity_counted = value
+            balance, received = _close_day(
+                position, stock_id, day, day_receipts, quantity_out, quantity_counted, StockCostBalance, CostLayer
+            )
+            balances.append(balance)
+            layers.extend(received)
+
+            if len(balances) >= batch_size:
+                StockCostBalance.objects.bulk_create(balances)
+                CostLayer.objects.bulk_create(layers)
+                written += len(balances)
+                balances, layers = [], []
+
+        if balances:
+            StockCostBalance.objects.bulk_create(balances)
+            CostLayer.objects.bulk_create(layers)
+            written += len(balances)
+
+    return written
+
+
+def cost_values(as_of, stock_ids=None):
+    """
+    Cost of the stock on hand at the end of ``as_of`` under the configured
+    method, ``{stock_id: value}`` in one query.  ``stock_ids`` may be None
+    (every SKU), a list of pks or a pk queryset; SKUs without any position are
+    omitted.
+    """
+    qs = StockCostBalance.objects.filter(method=costing_method().name, date__lte=as_of)
+    if stock_ids is not None:
+        qs = qs.filter(stock_code__in=stock_ids)
+    qs = qs.annotate(
+        rank=Window(
+            RowNumber(),
+            partition_by=[F('stock_code')],
+            order_by=[F('date').desc()],
+        )
+    ).filter(rank=1)
+    return dict(qs.values_list('stock_code', 'value'))
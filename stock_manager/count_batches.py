@@ -0,0 +1,238 @@
+"""
+Chunked upload of handheld scanner lines into a stock count session.
+
+A stock take produces tens of thousands of scans, far more than the count
+form can take, so a scanner sends them in chunks of at most MAX_CHUNK_LINES
+lines, each under an id of its choosing.  A chunk is posted in one
+transaction: codes are resolved against the in-memory stock master (see
+stock_cache.py), repeated scans of a SKU are added up, and the totals are
+added to the session's entries, one per SKU: SKUs new to the session with one
+bulk_create(), SKUs scanned in an earlier chunk with an UPDATE per distinct
+quantity added.  The queries and memory a chunk needs depend only on its own
+size.
+
+The chunk id is stored with the session, so a scanner that lost a response
+can send the chunk again: it is acknowledged without being counted twice.
+chunk_status() lists the ids received so far, to resume from.
+
+The upload views are ordinary session-authenticated POSTs and go through
+Django's CSRF check: a scanner logs in through the login page and sends the
+CSRF token in an ``X-CSRFToken`` header (see views.count_upload_start()).
+"""
+import csv
+import io
+import json
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Upper
+
+from . import audit
+from .adjustments import refresh_adjustments
+from .balances import apply_movement_batch
+from .costing import refresh_costs
+from .dashboard_cache import invalidate_snapshots_from
+from .models import StockCountChunk, StockCountEntry, StockCountSession, StockTransaction
+from .stock_cache import stock_master
+
+ZERO = Decimal('0')
+MAX_CHUNK_LINES = 5000
+
+
+@dataclass
+class ChunkResult:
+    chunk_id: str
+    duplicate: bool = False
+    lines_received: int = 0
+    lines_rejected: int = 0
+    entries_created: int = 0
+    entries_updated: int = 0
+    errors: list = field(default_factory=list)  # [(line_number, message), ...]
+
+
+def parse_lines(body, content_type):
+    """
+    ``[(line_number, stock_code, quantity), ...]`` from a chunk body, with
+    values as sent.  JSON is a list of ``{"stock_code": ..., "quantity": ...}``
+    objects, bare or as ``{"lines": [...]}``; CSV has a header row naming
+    ``stock_code`` and optionally ``quantity``.  Raises ValidationError if the
+    body cannot be read or holds more than MAX_CHUNK_LINES lines.
+    """
+    if content_type == 'text/csv':
+        try:
+            text = body.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise ValidationError("The chunk is not UTF-8 text.")
+        reader = csv.DictReader(io.StringIO(text))
+        columns = [name.strip() for name in reader.fieldnames or []]
+        if 'stock_code' not in columns:
+            raise ValidationError("Missing column: stock_code.")
+        reader.fieldnames = columns
+        lines = ((reader.line_num, row.get('stock_code'), row.get('quantity')) for row in reader)
+    else:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise ValidationError("The chunk is not valid JSON.")
+        if isinstance(data, dict):
+            data = data.get('lines')
+        if not isinstance(data, list):
+            raise ValidationError('Expected a list of lines or {"lines": [...]}.')
+        lines = (
+            (number, line.get('stock_code'), line.get('quantity')) if isinstance(line, dict) else (number, None, None)
+            for number, line in enumerate(data, start=1)
+        )
+
+    lines = list(islice(lines, MAX_CHUNK_LINES + 1))
+    if len(lines) > MAX_CHUNK_LINES:
+        raise ValidationError(f"A chunk holds at most {MAX_CHUNK_LINES} lines.")
+    return lines
+
+
+def _quantity(value):
+    """A scan without a quantity counts one unit."""
+    if value is None or value == '':
+        return Decimal('1')
+    if isinstance(value, bool):
+        raise ValueError
+    try:
+        quantity = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError
+    if not quantity.is_finite() or quantity < 0 or quantity.as_tuple().exponent < -2:
+        raise ValueError
+    return quantity
+
+
+def _resolve_codes(codes):
+    """``{code: stock_id}`` for the codes that exist, in any case."""
+    master = stock_master()
+    stock_ids, missing = {}, set()
+    for code in codes:
+        row = master.row_for_code(code)
+        if row is not None:
+            stock_ids[code] = row[0]
+        else:
+            missing.add(code)
+
+    if missing:
+        # Created elsewhere since the master was loaded, or not a SKU at all
+        found = dict(
+            StockTransaction.objects.annotate(code_upper=Upper('stock_code'))
+            .filter(code_upper__in={code.upper() for code in missing})
+            .values_list('code_upper', 'pk')
+        )
+        for code in missing:
+            if code.upper() in found:
+                stock_ids[code] = found[code.upper()]
+    return stock_ids
+
+
+def post_chunk(session_id, chunk_id, lines):
+    """
+    Add the scanner ``lines`` (from parse_lines()) to the entries of count
+    session ``session_id`` and return a ChunkResult.  Lines with an unknown
+    code or a bad quantity are reported and skipped.  A ``chunk_id`` already
+    posted to the session changes nothing.  Raises
+    StockCountSession.DoesNotExist for an unknown session and
+    ValidationError, writing nothing, if a total would not fit an entry.
+    """
+    result = ChunkResult(chunk_id=chunk_id)
+
+    with transaction.atomic():
+        # Chunks of one session are posted one at a time
+        session = StockCountSession.objects.select_for_update().get(pk=session_id)
+        previous = session.chunks.filter(chunk_id=chunk_id).first()
+        if previous is not None:
+            result.duplicate = True
+            result.lines_received = previous.lines_received
+            result.lines_rejected = previous.lines_rejected
+            return result
+
+        result.lines_received = len(lines)
+        codes = {code.strip() for _, code, _ in lines if isinstance(code, str) and code.strip()}
+        stock_ids = _resolve_codes(codes)
+
+        totals = {}
+        for line, code, quantity in lines:
+            stock_id = stock_ids.get(code.strip()) if isinstance(code, str) else None
+            if stock_id is None:
+                result.errors.append((line, f"unknown stock code {code!r}."))
+                continue
+            try:
+                totals[stock_id] = totals.get(stock_id, ZERO) + _quantity(quantity)
+            except ValueError:
+                result.errors.append((line, f"quantity {quantity!r} is not a number of units."))
+        result.lines_rejected = len(result.errors)
+
+        # The latest entry of a SKU in the session takes the scans
+        existing = {
+            entry.stock_code_id: entry
+            for entry in session.entries.filter(stock_code__in=list(totals)).order_by('id')
+        }
+        created, updated = [], []
+        for stock_id, quantity in totals.items():
+            entry = existing.get(stock_id)
+            if entry is None:
+                created.append(StockCountEntry(session=session, stock_code_id=stock_id, quantity_counted=quantity))
+            else:
+                entry.quantity_counted += quantity
+                updated.append(entry)
+        for entry in created + updated:
+            try:
+                entry.clean_fields(exclude=['session', 'stock_code'])
+            except ValidationError:
+                raise ValidationError(
+                    f"The count for stock #{entry.stock_code_id} would reach {entry.quantity_counted}, "
+                    f"more than an entry can hold."
+                )
+
+        StockCountEntry.objects.bulk_create(created, batch_size=500)
+        # Scans mostly add the same few quantities: one UPDATE per distinct increment
+        increments = {}
+        for entry in updated:
+            increments.setdefault(totals[entry.stock_code_id], []).append(entry.pk)
+        for quantity, entry_ids in increments.items():
+            for i in range(0, len(entry_ids), 500):
+                StockCountEntry.objects.filter(pk__in=entry_ids[i:i + 500]).update(
+                    quantity_counted=F('quantity_counted') + quantity
+                )
+        StockCountChunk.objects.create(
+            session=session, chunk_id=chunk_id,
+            lines_received=result.lines_received, lines_rejected=result.lines_rejected,
+        )
+        result.entries_created = len(created)
+        result.entries_updated = len(updated)
+
+        audit.record_created(created)
+        audit.record_entries(
+            audit.audit_entry(audit.UPDATE, entry, audit.describe(entry), session.pk) for entry in updated
+        )
+        if totals:
+            # Another session on the same day may hold a later count of a SKU
+            latest = dict(
+                StockCountEntry.objects.filter(stock_code__in=list(totals), session__date=session.date)
+                .order_by('stock_code', 'id').values_list('stock_code', 'quantity_counted')
+            )
+            apply_movement_batch({}, {(stock_id, session.date): qty for stock_id, qty in latest.items()})
+            refresh_adjustments((stock_id, session.date) for stock_id in totals)
+            refresh_costs((stock_id, session.date) for stock_id in totals)
+            invalidate_snapshots_from(session.date)
+    return result
+
+
+def chunk_status(session):
+    """What a scanner needs to resume uploading to ``session``."""
+    chunks = list(session.chunks.order_by('id').values_list('chunk_id', 'lines_received', 'lines_rejected'))
+    return {
+        'session_id': session.pk,
+        'date': session.date.isoformat(),
+        'chunks': [chunk_id for chunk_id, _, _ in chunks],
+        'lines_received': sum(received for _, received, _ in chunks),
+        'lines_rejected': sum(rejected for _, _, rejected in chunks),
+        'entries': session.entries.count(),
+    }
@@ -0,0 +1,94 @@
+"""
+Month-keyed dashboard snapshots in Django's cache framework.
+
+The dashboard only changes when a Purchase, Sale or stock count is written,
+so its context is built once per month and reused until a write dated in or
+before that month invalidates it (see signals.py).  Hit/miss counts and
+rebuild times are kept in the same cache so they can be checked from the
+cache-stats endpoint.
+"""
+import time
+from datetime import date
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+SNAPSHOT_KEY = 'dashboard:snapshot:{:%Y-%m}'
+STATS_PREFIX = 'dashboard:stats:'
+STAT_NAMES = ('hits', 'misses', 'invalidations', 'rebuild_ms_total', 'last_rebuild_ms')
+
+
+def _cache():
+    return caches[getattr(settings, 'DASHBOARD_CACHE_ALIAS', 'default')]
+
+
+def _bump(name, amount=1):
+    cache = _cache()
+    key = STATS_PREFIX + name
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # Evicted between add() and incr()
+        cache.set(key, amount, timeout=None)
+
+
+def _month_keys(first_day, last_day):
+    month = first_day.replace(day=1)
+    keys = []
+    while month <= last_day:
+        keys.append(SNAPSHOT_KEY.format(month))
+        if month.month == 12:
+            month = month.replace(year=month.year + 1, month=1)
+        else:
+            month = month.replace(month=month.month + 1)
+    return keys
+
+
+def get_snapshot(month, build):
+    """
+    Cached dashboard context for the month containing ``month``, built by
+    calling ``build()`` on a miss.
+    """
+    cache = _cache()
+    key = SNAPSHOT_KEY.format(month)
+    snapshot = cache.get(key)
+    if snapshot is not None:
+        _bump('hits')
+        return snapshot
+
+    _bump('misses')
+    started = time.perf_counter()
+    snapshot = build()
+    elapsed_ms = int((time.perf_counter() - started) * 1000)
+
+    cache.set(key, snapshot, timeout=getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 3600))
+    _bump('rebuild_ms_total', elapsed_ms)
+    cache.set(STATS_PREFIX + 'last_rebuild_ms', elapsed_ms, timeout=None)
+    return snapshot
+
+
+def invalidate_snapshots_from(day):
+    """
+    Drop the snapshots a write dated ``day`` can affect: its own month and
+    every later one up to the current month, since opening stock carries
+    forward.  Runs after the surrounding transaction commits.
+    """
+    def invalidate():
+        keys = _month_keys(day, max(day, date.today()))
+        _cache().delete_many(keys)
+        _bump('invalidations')
+
+    transaction.on_commit(invalidate)
+
+
+def cache_stats():
+    """Hit ratio and rebuild timings since the stats keys were created."""
+    values = _cache().get_many([STATS_PREFIX + name for name in STAT_NAMES])
+    stats = {name: values.get(STATS_PREFIX + name, 0) for name in STAT_NAMES}
+
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else None
+    stats['avg_rebuild_ms'] = round(stats['rebuild_ms_total'] / stats['misses'], 1) if stats['misses'] else None
+    return stats
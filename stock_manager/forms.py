@@ -1,6 +1,51 @@
 from django import forms
-from .models import StockTransaction, Purchase, Sale, StockCountSession, StockCountEntry
+from .models import StockTransaction, Purchase, PurchaseDocument, Sale, SaleDocument, StockCountSession, StockCountEntry
 from django.core.exceptions import ValidationError
+from .stock_cache import get_stock, stock_code_for
+
+
+class StockCodeInput(forms.TextInput):
+    """Text box for a stock code; stock_code_typeahead.html attaches suggestions."""
+    def __init__(self, attrs=None):
+        super().__init__({'class': 'stock-code-input', 'autocomplete': 'off',
+                          'list': 'stock-code-options', **(attrs or {})})
+
+
+class StockCodeField(forms.Field):
+    """
+    A StockTransaction entered by its stock code and resolved through the
+    process-local stock master cache, so a formset does not query (or render)
+    the whole catalogue once per row.
+    """
+    widget = StockCodeInput
+    default_error_messages = {
+        'invalid_choice': "Unknown stock code %(value)s.",
+    }
+
+    def prepare_value(self, value):
+        if isinstance(value, StockTransaction):
+            return value.stock_code
+        if isinstance(value, int):
+            return stock_code_for(value) or value
+        return value
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        if isinstance(value, StockTransaction):
+            return value
+        code = str(value).strip()
+        stock = get_stock(code)
+        if stock is None:
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice',
+                                  params={'value': code})
+        return stock
+
+    def has_changed(self, initial, data):
+        if self.disabled:
+            return False
+        initial = self.prepare_value(initial)
+        return str(initial or '').upper() != str(data or '').strip().upper()
 
 
 class StockTransactionForm(forms.ModelForm):
@@ -16,6 +61,8 @@ class StockTransactionForm(forms.ModelForm):
 
 
 class PurchaseForm(forms.ModelForm):
+    stock_code = StockCodeField()
+
     class Meta:
         model = Purchase
         fields = [
@@ -31,6 +78,8 @@ class PurchaseForm(forms.ModelForm):
         }
 
 class SaleForm(forms.ModelForm):
+    stock_code = StockCodeField()
+
     class Meta:
         model = Sale
         fields = [
@@ -54,6 +103,8 @@ class StockCountSessionForm(forms.ModelForm):
         }
 
 class StockCountEntryForm(forms.ModelForm):
+    stock_code = StockCodeField()
+
     class Meta:
         model = StockCountEntry
         fields = ['stock_code', 'quantity_counted']
@@ -62,15 +113,18 @@ class StockCountEntryForm(forms.ModelForm):
 class PurchaseHeaderForm(forms.Form):
     transaction_date = forms.DateField(widget=forms.DateInput(attrs={'type': 'date'}))
     supplier_name = forms.CharField(max_length=100)
-    document_number = forms.CharField(max_length=50)
+    document_number = forms.CharField(max_length=50, required=False,
+                                      help_text="Leave blank to number the purchase automatically.")
     def clean_document_number(self):
         doc_num = self.cleaned_data['document_number']
-        if Purchase.objects.filter(document_number=doc_num).exists():
+        if doc_num and PurchaseDocument.objects.filter(document_number=doc_num).exists():
             raise ValidationError("This document number already exists.")
         return doc_num
 
 
 class PurchaseLineForm(forms.ModelForm):
+    stock_code = StockCodeField()
+
     class Meta:
         model = Purchase
         fields = ['stock_code', 'quantity', 'price_per_unit']
@@ -81,12 +135,14 @@ class SaleHeaderForm(forms.Form):
     # document_number = forms.CharField(max_length=50)
     def clean_document_number(self):
         doc_num = self.cleaned_data['document_number']
-        if Sale.objects.filter(document_number=doc_num).exists():
+        if SaleDocument.objects.filter(document_number=doc_num).exists():
             raise ValidationError("This document number already exists.")
         return doc_num
 
 
 class SaleLineForm(forms.ModelForm):
+    stock_code = StockCodeField()
+
     class Meta:
         model = Sale
         fields = ['stock_code', 'quantity', 'price_per_unit']
@@ -0,0 +1,272 @@
+"""
+Bulk CSV import of the stock master, purchases and sales.
+
+The file is read as a stream and handled ``chunk_size`` rows at a time: each
+chunk is validated in memory against a stock code -> id map built once per
+import, and its valid rows are written with bulk_create() in one transaction.
+Purchase and sale rows are grouped into documents by consecutive rows sharing
+a document number (or, when that column is blank, a date and supplier or
+customer); a document is imported whole or not at all, and a chunk never
+splits one.  Every rejected row is reported with its line number.
+"""
+import csv
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from itertools import groupby
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+from django.utils.dateparse import parse_date
+
+from .audit import record_created
+from .models import Purchase, PurchaseDocument, Sale, SaleDocument, StockTransaction, stock_search_key
+from .sequences import reserve_numbers
+from .services import post_purchase_documents, post_sale_documents
+from .stock_cache import bump_stock_version, stock_master
+
+DEFAULT_CHUNK_SIZE = 5000
+
+# kind: (required columns, optional columns)
+IMPORT_COLUMNS = {
+    'stock': (['stock_code', 'stock_description', 'uom'], []),
+    'purchase': (['transaction_date', 'supplier_name', 'stock_code', 'quantity', 'price_per_unit'],
+                 ['document_number']),
+    'sale': (['transaction_date', 'customer_name', 'stock_code', 'quantity', 'price_per_unit'],
+             ['document_number']),
+}
+
+# kind: (line model, header model, party field, sequence name, writer)
+DOCUMENT_KINDS = {
+    'purchase': (Purchase, PurchaseDocument, 'supplier_name', 'purchase', post_purchase_documents),
+    'sale': (Sale, SaleDocument, 'customer_name', 'sale', post_sale_documents),
+}
+
+
+@dataclass
+class ImportResult:
+    kind: str
+    rows_read: int = 0
+    rows_imported: int = 0
+    documents_created: int = 0
+    errors: list = field(default_factory=list)  # [(line_number, message), ...]
+
+    @property
+    def rows_rejected(self):
+        return self.rows_read - self.rows_imported
+
+    def write_error_report(self, out):
+        writer = csv.writer(out)
+        writer.writerow(['line', 'error'])
+        writer.writerows(self.errors)
+
+
+def _chunks(rows, chunk_size, key=None):
+    """
+    Lists of ``(line_number, row)`` of about ``chunk_size`` rows.  With
+    ``key``, consecutive rows with the same key stay in the same chunk.
+    """
+    chunk = []
+    groups = groupby(rows, key=key) if key else ((None, [row]) for row in rows)
+    for _, group in groups:
+        chunk.extend(group)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _numbered_rows(reader):
+    for row in reader:
+        yield reader.line_num, {name: (value or '').strip() for name, value in row.items() if name}
+
+
+def _field_errors(obj, exclude):
+    try:
+        obj.clean_fields(exclude=exclude)
+    except ValidationError as e:
+        return [f"{name} - {' '.join(messages)}" for name, messages in e.message_dict.items()]
+    return []
+
+
+def _import_stock(rows, result, chunk_size, dry_run):
+    seen = {code.upper() for code in StockTransaction.objects.values_list('stock_code', flat=True)}
+
+    for chunk in _chunks(rows, chunk_size):
+        objects = []
+        for line, row in chunk:
+            result.rows_read += 1
+            stock = StockTransaction(
+                stock_code=row['stock_code'], stock_description=row['stock_description'], uom=row['uom'],
+                search_key=stock_search_key(row['stock_code'], row['stock_description']),
+            )
+            errors = _field_errors(stock, exclude=[])
+            if not errors and stock.stock_code.upper() in seen:
+                errors.append(f"stock code {stock.stock_code!r} already exists.")
+            if errors:
+                result.errors.extend((line, error) for error in errors)
+                continue
+            seen.add(stock.stock_code.upper())
+            objects.append(stock)
+
+        if objects and not dry_run:
+            with transaction.atomic():
+                StockTransaction.objects.bulk_create(objects)
+                bump_stock_version()
+                record_created(objects)
+        result.rows_imported += len(objects)
+
+
+def _parse_line(model, row, party, stock_ids):
+    """Unsaved ``model`` instance for one CSV row, or the list of problems with it."""
+    errors = []
+    try:
+        transaction_date = parse_date(row['transaction_date'])
+    except ValueError:
+        transaction_date = None
+    if transaction_date is None:
+        errors.append(f"transaction_date - {row['transaction_date']!r} is not a YYYY-MM-DD date.")
+
+    stock_id = stock_ids.get(row['stock_code'])
+    if stock_id is None:
+        errors.append(f"unknown stock code {row['stock_code']!r}.")
+
+    values = {}
+    for name in ('quantity', 'price_per_unit'):
+        try:
+            values[name] = Decimal(row[name])
+        except InvalidOperation:
+            errors.append(f"{name} - {row[name]!r} is not a number.")
+    if errors:
+        return None, errors
+
+    obj = model(
+        transaction_date=transaction_date,
+        document_number=row.get('document_number', ''),
+        stock_code_id=stock_id,
+        **{party: row[party]},
+        **values,
+    )
+    errors = _field_errors(obj, exclude=['stock_code', 'document_number', 'document'])
+    if not errors and obj.quantity <= 0:
+        errors.append("quantity must be greater than zero.")
+    if not errors and obj.price_per_unit < 0:
+        errors.append("price_per_unit cannot be negative.")
+    return obj, errors
+
+
+def _import_documents(kind, rows, result, chunk_size, dry_run):
+    model, header_model, party, sequence, post_documents = DOCUMENT_KINDS[kind]
+    stock_ids = {code: row[0] for code, row in stock_master().by_code.items()}
+    max_number_length = header_model._meta.get_field('document_number').max_length
+    seen_numbers = set()
+
+    def document_key(numbered_row):
+        _, row = numbered_row
+        if row.get('document_number'):
+            return row['document_number']
+        return (row['transaction_date'], row[party])
+
+    for chunk in _chunks(rows, chunk_size, key=document_key):
+        documents = []
+        for key, group in groupby(chunk, key=document_key):
+            group = list(group)
+            result.rows_read += len(group)
+            number = key if isinstance(key, str) else ''
+
+            errors = []
+            if number and number in seen_numbers:
+                errors.append((group[0][0], f"document {number} appears more than once in the file."))
+            elif len(number) > max_number_length:
+                errors.append((group[0][0], f"document_number - longer than {max_number_length} characters."))
+            lines = []
+            for line, row in group:
+                obj, line_errors = _parse_line(model, row, party, stock_ids)
+                errors.extend((line, error) for error in line_errors)
+                lines.append(obj)
+            if number:
+                seen_numbers.add(number)
+
+            if len({obj.transaction_date for obj in lines if obj}) > 1:
+                errors.append((group[0][0], f"document {number} has lines on more than one date."))
+            if errors:
+                result.errors.extend(errors)
+                rejected = {line for line, _ in errors}
+                result.errors.extend(
+                    (line, f"not imported: another line of document {number or '(unnumbered)'} is invalid.")
+                    for line, _ in group if line not in rejected
+                )
+                continue
+            documents.append((number, group, lines))
+
+        # Numbers already posted, checked for the whole chunk at once
+        taken = set(header_model.objects.filter(
+            document_number__in=[number for number, _, _ in documents if number]
+        ).values_list('document_number', flat=True))
+        if taken:
+            for number, group, _ in documents:
+                if number in taken:
+                    result.errors.extend(
+                        (line, f"document number {number} already exists.") for line, _ in group
+                    )
+            documents = [document for document in documents if document[0] not in taken]
+
+        if not documents:
+            continue
+
+        unnumbered = sum(1 for number, _, _ in documents if not number)
+        new_numbers = iter(reserve_numbers(sequence, unnumbered) if unnumbered and not dry_run else [])
+
+        to_post = []
+        for number, group, lines in documents:
+            number = number or next(new_numbers, '')
+            header = {
+                'transaction_date': lines[0].transaction_date,
+                party: getattr(lines[0], party),
+                'document_number': number,
+            }
+            for obj in lines:
+                obj.document_number = number
+            to_post.append((header, lines))
+
+        imported = sum(len(lines) for _, lines in to_post)
+        if dry_run:
+            result.rows_imported += imported
+            result.documents_created += len(to_post)
+            continue
+        try:
+            post_documents(to_post)
+        except DatabaseError as e:
+            result.errors.extend(
+                (line, f"not imported: chunk failed to save ({e}).")
+                for _, group, _ in documents for line, _ in group
+            )
+        else:
+            result.rows_imported += imported
+            result.documents_created += len(to_post)
+
+
+def import_csv(kind, file, chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False):
+    """
+    Import a CSV text stream of ``kind`` ('stock', 'purchase' or 'sale') and
+    return an ImportResult.  Raises ValidationError if the header row is
+    missing required columns.  With ``dry_run`` nothing is written.
+    """
+    if kind not in IMPORT_COLUMNS:
+        raise ValueError(f"Unknown import kind: {kind}")
+
+    reader = csv.DictReader(file)
+    required, _ = IMPORT_COLUMNS[kind]
+    columns = [name.strip() for name in reader.fieldnames or []]
+    missing = [name for name in required if name not in columns]
+    if missing:
+        raise ValidationError(f"Missing columns: {', '.join(missing)}.")
+    reader.fieldnames = columns
+
+    result = ImportResult(kind=kind)
+    rows = _numbered_rows(reader)
+    if kind == 'stock':
+        _import_stock(rows, result, chunk_size, dry_run)
+    else:
+        _import_documents(kind, rows, result, chunk_size, dry_run)
+    return result
@@ -0,0 +1,54 @@
+"""
+Counters for the session keep-alive ping.
+
+The session-timeout script in base.html used to keep a session alive by
+re-fetching the page it was on, which re-ran the whole report behind it.  It
+now calls the ping_session view instead and says which page it is on, so each
+ping from a report page is one report render saved.  The counts are kept in
+Django's cache and read from the keep-alive stats endpoint.
+"""
+from django.core.cache import caches
+from django.urls import Resolver404, resolve
+
+STATS_PREFIX = 'keepalive:stats:'
+
+# URL names whose views build reports
+REPORT_VIEWS = ('dashboard', 'transaction_list', 'inventory_summary')
+
+
+def _cache():
+    return caches['default']
+
+
+def _bump(name, amount=1):
+    cache = _cache()
+    key = STATS_PREFIX + name
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # Evicted between add() and incr()
+        cache.set(key, amount, timeout=None)
+
+
+def record_ping(page):
+    """Count a keep-alive ping sent from the page at path ``page``."""
+    _bump('pings')
+    try:
+        url_name = resolve(page).url_name if page else None
+    except Resolver404:
+        url_name = None
+    if url_name in REPORT_VIEWS:
+        _bump('saved:' + url_name)
+
+
+def keepalive_stats():
+    """Pings received and report renders they saved, in total and per report."""
+    names = ['pings'] + ['saved:' + name for name in REPORT_VIEWS]
+    values = _cache().get_many([STATS_PREFIX + name for name in names])
+    saved = {name: values.get(STATS_PREFIX + 'saved:' + name, 0) for name in REPORT_VIEWS}
+    return {
+        'pings': values.get(STATS_PREFIX + 'pings', 0),
+        'report_renders_saved': sum(saved.values()),
+        'report_renders_saved_by_view': saved,
+    }
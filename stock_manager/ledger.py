@@ -0,0 +1,426 @@
+"""
+Set-based stock ledger engine.
+
+Works out opening, period-in, period-out, variance, on-hand, latest price,
+valuation and last-movement date for a whole set of SKUs in a fixed number of
+grouped and windowed queries, instead of a dozen queries per SKU.
+
+Opening and closing quantities are read from the StockDailyBalance table,
+latest prices and last-movement dates from the StockPrice history and the
+columns prices.py keeps on StockTransaction, and valuations from the cost
+positions kept by costing.py.
+Period figures are differences of cumulative movement totals ("everything in
+the period up to and including date X") taken at a handful of breakpoints: the
+end of the period and the dates of the counts involved.  Count dates come from
+sessions, so there are few distinct ones no matter how many SKUs were counted,
+and each of them costs one conditional SUM column rather than one query per SKU.
+
+``ledger_annotations()`` expresses the same columns as correlated subqueries on
+StockTransaction, for sorting and paging the ledger in the database and for
+totals that must not load every row.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import (
+    Case, CharField, DecimalField, Exists, ExpressionWrapper, F, IntegerField, OuterRef, Q, Subquery,
+    Sum, Value, When, Window,
+)
+from django.db.models.functions import Coalesce, Greatest, RowNumber, TruncDay, TruncMonth, TruncWeek
+
+from .balances import closing_balances
+from .costing import cost_values, costing_method
+from .models import (
+    Purchase, Sale, StockCostBalance, StockCountAdjustment, StockCountEntry, StockDailyBalance, StockPrice,
+    StockTransaction,
+)
+
+ZERO = Decimal('0')
+QUANTITY = DecimalField(max_digits=14, decimal_places=2)
+VALUE = DecimalField(max_digits=18, decimal_places=4)
+
+# Upper bound on conditional SUM columns per grouped query.
+BREAKPOINTS_PER_QUERY = 50
+
+TREND_TRUNCATORS = {
+    'day': TruncDay,
+    'week': TruncWeek,
+    'month': TruncMonth,
+}
+
+
+def _stock_filter(field, stock_ids):
+    """``stock_ids`` may be None (every SKU), a list of pks or a pk queryset."""
+    if stock_ids is None:
+        return Q()
+    return Q(**{f'{field}__in': stock_ids})
+
+
+def cumulative_movements(model, dates, stock_ids=None, after=None):
+    """
+    Cumulative quantity of ``model`` (Purchase or Sale) per SKU at each date.
+
+    Returns ``{stock_id: {date: qty}}`` where ``qty`` is the sum of every
+    movement dated on or before ``date`` (and after ``after``, if given).
+    SKUs without movements are omitted.
+    """
+    dates = sorted(set(dates))
+    result = {}
+
+    for i in range(0, len(dates), BREAKPOINTS_PER_QUERY):
+        chunk = dates[i:i + BREAKPOINTS_PER_QUERY]
+        qs = model.objects.filter(
+            _stock_filter('stock_code', stock_ids),
+            transaction_date__lte=chunk[-1]
+        )
+        if after is not None:
+            qs = qs.filter(transaction_date__gt=after)
+        qs = qs.values('stock_code').annotate(**{
+            f'c{n}': Sum('quantity', filter=Q(transaction_date__lte=d))
+            for n, d in enumerate(chunk)
+        }).order_by()
+
+        for row in qs:
+            totals = result.setdefault(row['stock_code'], {})
+            for n, d in enumerate(chunk):
+                totals[d] = row[f'c{n}'] or ZERO
+    return result
+
+
+def latest_counts(stock_ids=None, before=None, start=None, end=None):
+    """
+    Latest StockCountEntry per SKU, picked with a window function.
+
+    ``before`` restricts to sessions strictly before that date, ``start`` and
+    ``end`` to an inclusive session date window.  Returns
+    ``{stock_id: (count_date, quantity_counted)}``.
+    """
+    qs = StockCountEntry.objects.filter(_stock_filter('stock_code', stock_ids))
+    if before:
+        qs = qs.filter(session__date__lt=before)
+    if start:
+        qs = qs.filter(session__date__gte=start)
+    if end:
+        qs = qs.filter(session__date__lte=end)
+
+    qs = qs.annotate(
+        count_date=F('session__date'),
+        rank=Window(
+            RowNumber(),
+            partition_by=[F('stock_code')],
+            order_by=[F('session__date').desc(), F('id').desc()],
+        ),
+    ).filter(rank=1)
+
+    return {
+        stock_id: (count_date, qty)
+        for stock_id, count_date, qty in qs.values_list('stock_code', 'count_date', 'quantity_counted')
+    }
+
+
+def _before_own_date(field, dates, inclusive=False):
+    """
+    Q for rows of each SKU in ``dates`` (``{stock_id: date}``) dated before,
+    or with ``inclusive`` on or before, that SKU's own date: one OR term per
+    distinct date, so the filter stays small however many SKUs share them.
+    """
+    by_date = defaultdict(list)
+    for stock_id, day in dates.items():
+        by_date[day].append(stock_id)
+    lookup = f"{field}__{'lte' if inclusive else 'lt'}"
+    condition = Q(pk__in=[])
+    for day, stock_ids in by_date.items():
+        condition |= Q(stock_code__in=stock_ids, **{lookup: day})
+    return condition
+
+
+def prior_counts(count_dates):
+    """
+    Latest StockCountEntry per SKU in ``count_dates`` (``{stock_id: date}``)
+    from a session strictly before that SKU's date, in one query.  Returns
+    ``{stock_id: (count_date, quantity_counted)}``.
+    """
+    if not count_dates:
+        return {}
+    qs = StockCountEntry.objects.filter(_before_own_date('session__date', count_dates)).annotate(
+        count_date=F('session__date'),
+        rank=Window(
+            RowNumber(),
+            partition_by=[F('stock_code')],
+            order_by=[F('session__date').desc(), F('id').desc()],
+        ),
+    ).filter(rank=1)
+
+    return {
+        stock_id: (count_date, qty)
+        for stock_id, count_date, qty in qs.values_list('stock_code', 'count_date', 'quantity_counted')
+    }
+
+
+def latest_prices(up_to_date, stock_ids=None):
+    """
+    Latest purchase price per SKU on or before ``up_to_date``: the SKU's
+    ``last_cost`` if it was last bought by then, else from its StockPrice
+    history.
+    """
+    skus = StockTransaction.objects.filter(_stock_filter('pk', stock_ids))
+    prices = {
+        stock_id: price or ZERO
+        for stock_id, price in skus.filter(last_purchase_date__lte=up_to_date).values_list('pk', 'last_cost')
+    }
+    history = (
+        StockPrice.objects.filter(
+            stock_code__in=skus.filter(last_purchase_date__gt=up_to_date).values('pk'),
+            date__lte=up_to_date,
+        )
+        .annotate(rank=Window(RowNumber(), partition_by=[F('stock_code')], order_by=[F('date').desc()]))
+        .filter(rank=1)
+    )
+    prices.update((stock_id, price or ZERO) for stock_id, price in history.values_list('stock_code', 'price'))
+    return prices
+
+
+def stock_position(as_of, stock_ids=None):
+    """
+    Total quantity on hand at the end of ``as_of`` and its cost under the
+    configured costing method, over all SKUs in two queries.
+    """
+    total_qty = sum(closing_balances(as_of, stock_ids).values(), ZERO)
+    total_value = sum(cost_values(as_of, stock_ids).values(), ZERO)
+    return total_qty, total_value
+
+
+def count_variance(start_date, end_date):
+    """
+    Total variance quantity over every count entry with a session between
+    ``start_date`` and ``end_date``, read from the stored adjustments.
+    """
+    return StockCountAdjustment.objects.filter(
+        date__gte=start_date,
+        date__lte=end_date
+    ).aggregate(total=Sum('variance_quantity'))['total'] or ZERO
+
+
+def build_stock_ledger(start_date, end_date, stock_items=None):
+    """
+    Stock ledger rows for ``stock_items`` over ``start_date``..``end_date``.
+
+    ``stock_items`` is a StockTransaction queryset (all SKUs by default).
+    Returns ``(rows, total_valuation)`` where each row is the dict rendered by
+    ``transaction_list.html``.
+    """
+    if stock_items is None:
+        stock_items = StockTransaction.objects.all()
+        stock_ids = None
+    else:
+        stock_ids = stock_items.values('pk')
+    stock_items = list(stock_items)
+    if not stock_items:
+        return [], Decimal('0.00')
+
+    previous_day = start_date - timedelta(days=1)
+
+    opening = closing_balances(previous_day, stock_ids)
+    closing = closing_balances(end_date, stock_ids)
+    window_counts = latest_counts(stock_ids, start=start_date, end=end_date)
+    prices = latest_prices(end_date, stock_ids)
+    values = cost_values(end_date, stock_ids)
+
+    # Period movements, cumulated from the start of the period
+    breakpoints = {end_date}
+    breakpoints.update(count_date for count_date, _ in window_counts.values())
+    purchases = cumulative_movements(Purchase, breakpoints, stock_ids, after=previous_day)
+    sales = cumulative_movements(Sale, breakpoints, stock_ids, after=previous_day)
+
+    rows = []
+    total_valuation = Decimal('0.00')
+
+    for stock in stock_items:
+        bought = purchases.get(stock.pk, {})
+        sold = sales.get(stock.pk, {})
+
+        opening_quantity = opening.get(stock.pk, ZERO)
+        purchase_quantity = bought.get(end_date, ZERO)
+        sales_quantity = sold.get(end_date, ZERO)
+        quantity_on_hand = closing.get(stock.pk, ZERO)
+        latest_price = prices.get(stock.pk, ZERO)
+
+        # --- Variance (only if count exists in this filter window) ---
+        if stock.pk in window_counts:
+            count_date, counted = window_counts[stock.pk]
+            system_qty_at_count = opening_quantity + bought.get(count_date, ZERO) - sold.get(count_date, ZERO)
+            variance = counted - system_qty_at_count
+        else:
+            counted = variance = None
+
+        valuation = values.get(stock.pk, ZERO)
+        total_valuation += valuation
+
+        # --- Last movement date ---
+        movement_dates = [d for d in (stock.last_purchase_date, stock.last_sale_date) if d]
+
+        rows.append({
+            'stock_code': stock.stock_code,
+            'description': stock.stock_description,
+            'opening_quantity': opening_quantity,
+            'purchase_quantity': purchase_quantity,
+            'sales_quantity': sales_quantity,
+            'counted_quantity': counted,
+            'variance': variance,
+            'quantity_on_hand': quantity_on_hand,
+            'latest_price': latest_price,
+            'valuation': valuation,
+            'transaction_date': max(movement_dates) if movement_dates else None,
+        })
+
+    return rows, total_valuation
+
+
+def _quantity(subquery):
+    return Coalesce(subquery, Value(ZERO), output_field=QUANTITY)
+
+
+def _closing_at(day):
+    return _quantity(Subquery(
+        StockDailyBalance.objects.filter(stock_code=OuterRef('pk'), date__lte=day)
+        .order_by('-date').values('closing_quantity')[:1]
+    ))
+
+
+def _cost_at(day):
+    return Coalesce(Subquery(
+        StockCostBalance.objects.filter(stock_code=OuterRef('pk'), method=costing_method().name, date__lte=day)
+        .order_by('-date').values('value')[:1]
+    ), Value(ZERO), output_field=VALUE)
+
+
+def _movements_between(model, stock, after, up_to):
+    return _quantity(Subquery(
+        model.objects.filter(stock_code=stock, transaction_date__gt=after, transaction_date__lte=up_to)
+        .order_by().values('stock_code').annotate(total=Sum('quantity')).values('total')[:1]
+    ))
+
+
+def ledger_annotations(start_date, end_date):
+    """
+    The ``build_stock_ledger()`` columns as StockTransaction annotations.
+
+    ``variance`` is NULL for SKUs without a count in the window and
+    ``last_movement`` for SKUs that never moved; ``variance_missing`` and
+    ``movement_missing`` (0/1) let callers sort those rows last.
+    """
+    previous_day = start_date - timedelta(days=1)
+    window_counts = StockCountEntry.objects.filter(
+        session__date__gte=start_date,
+        session__date__lte=end_date
+    ).order_by('-session__date', '-id')
+
+    opening = _closing_at(previous_day)
+    on_hand = _closing_at(end_date)
+    latest_price = _quantity(Case(
+        When(last_purchase_date__lte=end_date, then=F('last_cost')),
+        default=Subquery(
+            StockPrice.objects.filter(stock_code=OuterRef('pk'), date__lte=end_date)
+            .order_by('-date').values('price')[:1]
+        ),
+    ))
+
+    # Movements up to the count date; the count is looked up again from
+    # inside the movement subquery, hence the doubled OuterRef
+    count_date = Subquery(window_counts.filter(stock_code=OuterRef(OuterRef('pk'))).values('session__date')[:1])
+    counted = Subquery(window_counts.filter(stock_code=OuterRef('pk')).values('quantity_counted')[:1])
+    system_at_count = (
+        opening
+        + _movements_between(Purchase, OuterRef('pk'), previous_day, count_date)
+        - _movements_between(Sale, OuterRef('pk'), previous_day, count_date)
+    )
+
+    last_purchase = F('last_purchase_date')
+    last_sale = F('last_sale_date')
+    has_movements = Q(last_purchase_date__isnull=False) | Q(last_sale_date__isnull=False)
+
+    return {
+        'opening_quantity': opening,
+        'purchase_quantity': _movements_between(Purchase, OuterRef('pk'), previous_day, end_date),
+        'sales_quantity': _movements_between(Sale, OuterRef('pk'), previous_day, end_date),
+        'quantity_on_hand': on_hand,
+        'latest_price': latest_price,
+        'valuation': _cost_at(end_date),
+        'variance': ExpressionWrapper(counted - system_at_count, output_field=QUANTITY),
+        'variance_missing': Case(
+            When(Exists(window_counts.filter(stock_code=OuterRef('pk'))), then=Value(0)),
+            default=Value(1),
+            output_field=IntegerField(),
+        ),
+        # Greatest() is NULL if either side is on some backends, so give each
+        # side the other as a fallback
+        'last_movement': Greatest(Coalesce(last_purchase, last_sale), Coalesce(last_sale, last_purchase)),
+        'movement_missing': Case(When(has_movements, then=Value(0)), default=Value(1), output_field=IntegerField()),
+    }
+
+
+def ledger_valuation(end_date, stock_items=None):
+    """
+    Total cost of the stock on hand at the end of ``end_date`` over
+    ``stock_items`` (all SKUs by default), summed in the database.
+    """
+    if stock_items is None:
+        stock_items = StockTransaction.objects.all()
+    valuation = ledger_annotations(end_date, end_date)['valuation']
+    total = stock_items.order_by().aggregate(total=Sum(valuation))['total']
+    return (total or ZERO).quantize(Decimal('0.01'))
+
+
+def period_start(day, granularity='month'):
+    """First day of the day/week (Monday)/month containing ``day``."""
+    if granularity == 'month':
+        return day.replace(day=1)
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'day':
+        return day
+    raise ValueError(f"Unknown trend granularity: {granularity}")
+
+
+def _shift_period(start, granularity, steps):
+    if granularity == 'month':
+        months = start.year * 12 + start.month - 1 + steps
+        return start.replace(year=months // 12, month=months % 12 + 1)
+    return start + timedelta(days=steps * (7 if granularity == 'week' else 1))
+
+
+def movement_trend(end_date, periods=6, granularity='month'):
+    """
+    Purchase and sale quantities for the ``periods`` day/week/month buckets
+    ending with the one containing ``end_date``, oldest first.
+
+    Both models are grouped on the truncated ``transaction_date`` over a plain
+    date range and combined with UNION ALL, so the whole series is one query.
+    Returns ``[{'period': start_date, 'purchases': qty, 'sales': qty}, ...]``
+    with empty buckets filled with zero.
+    """
+    truncate = TREND_TRUNCATORS.get(granularity)
+    if truncate is None:
+        raise ValueError(f"Unknown trend granularity: {granularity}")
+
+    last = period_start(end_date, granularity)
+    starts = [_shift_period(last, granularity, -n) for n in range(periods - 1, -1, -1)]
+    range_end = _shift_period(last, granularity, 1) - timedelta(days=1)
+
+    def grouped(model, kind):
+        return (
+            model.objects.filter(transaction_date__gte=starts[0], transaction_date__lte=range_end)
+            .annotate(period=truncate('transaction_date'), kind=Value(kind, output_field=CharField()))
+            .values('period', 'kind')
+            .annotate(total=Sum('quantity'))
+            .order_by()
+        )
+
+    buckets = {start: {'period': start, 'purchases': ZERO, 'sales': ZERO} for start in starts}
+    for row in grouped(Purchase, 'purchases').union(grouped(Sale, 'sales'), all=True):
+        period = row['period']
+        if hasattr(period, 'date'):
+            period = period.date()
+        buckets[period][row['kind']] = row['total'] or ZERO
+    return [buckets[start] for start in starts]
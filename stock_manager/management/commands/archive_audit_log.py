@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from stock_manager.audit_archive import DEFAULT_BATCH_SIZE, archive_audit_log
+
+
+class Command(BaseCommand):
+    help = (
+        "Move audit log rows older than the retention period into monthly JSONL.gz archive files, "
+        "deleting them from the database batch by batch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.AUDIT_RETENTION_DAYS,
+                            help="Keep rows newer than this many days in the database.")
+        parser.add_argument('--directory', default=settings.AUDIT_ARCHIVE_DIR)
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                            help="Rows written and deleted per transaction.")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the rows that would move.")
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['batch_size'] < 1:
+            raise CommandError("--days must be zero or more and --batch-size at least 1.")
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        archived = archive_audit_log(
+            cutoff, options['directory'], batch_size=options['batch_size'], dry_run=options['dry_run'],
+        )
+        verb = "Would archive" if options['dry_run'] else "Archived"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {archived} audit log rows from before {cutoff:%Y-%m-%d %H:%M} to {options['directory']}."
+        ))
@@ -0,0 +1,239 @@
+import json
+import subprocess
+import time
+import tracemalloc
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment,
+)
+from django.urls import reverse
+
+from stock_manager.models import StockTransaction
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the report and posting views against freshly seeded data at several scales, "
+        "and session writes per request. "
+        "Runs in a throwaway test database and writes one JSON object per view and scale."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='1000,10000,100000',
+                            help="Comma-separated SKU counts to seed and measure.")
+        parser.add_argument('--years', type=float, default=2)
+        parser.add_argument('--documents-per-day', type=int, default=10)
+        parser.add_argument('--lines-per-document', type=int, default=5)
+        parser.add_argument('--count-sessions', type=int, default=12)
+        parser.add_argument('--count-fraction', type=float, default=0.3)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--repeat', type=int, default=3,
+                            help="Timed runs per view; the median is reported.")
+        parser.add_argument('--session-requests', type=int, default=50,
+                            help="Requests in the session write burst; 0 skips it.")
+        parser.add_argument('--output', help="Append JSON lines to this file instead of stdout.")
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(scale) for scale in options['scales'].split(',') if scale.strip()]
+        except ValueError:
+            raise CommandError("--scales must be a comma-separated list of integers.")
+
+        commit = git_commit()
+        started = datetime.now(timezone.utc).isoformat()
+        results = []
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            for skus in scales:
+                seed_started = time.perf_counter()
+                # History up to today, which the dashboard and ledger windows default to
+                call_command(
+                    'seed_stock_data', skus=skus, flush=True, seed=options['seed'], years=options['years'],
+                    end_date=date.today(),
+                    documents_per_day=options['documents_per_day'],
+                    lines_per_document=options['lines_per_document'],
+                    count_sessions=options['count_sessions'], count_fraction=options['count_fraction'],
+                    stdout=self.stderr,
+                )
+                seed_ms = (time.perf_counter() - seed_started) * 1000
+
+                for view, measurement in self.measure_views(options['repeat']):
+                    results.append({
+                        'commit': commit,
+                        'started': started,
+                        'vendor': connection.vendor,
+                        'skus': skus,
+                        'seed': options['seed'],
+                        'years': options['years'],
+                        'seed_ms': round(seed_ms, 1),
+                        'view': view,
+                        **measurement,
+                    })
+            for mode, measurement in self.measure_session_writes(options['session_requests']):
+                results.append({
+                    'commit': commit,
+                    'started': started,
+                    'vendor': connection.vendor,
+                    'session_engine': settings.SESSION_ENGINE,
+                    'view': 'session_writes',
+                    'mode': mode,
+                    **measurement,
+                })
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        lines = '\n'.join(json.dumps(result) for result in results) + '\n'
+        if options['output']:
+            with open(options['output'], 'a') as output:
+                output.write(lines)
+            self.stderr.write(f"Wrote {len(results)} results to {options['output']}.")
+        else:
+            self.stdout.write(lines, ending='')
+
+    def benchmark_user(self):
+        user = get_user_model().objects.filter(username='benchmark').first()
+        if user is None:
+            user = get_user_model().objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+        return user
+
+    def measure_session_writes(self, requests):
+        """
+        Session table writes over a burst of keep-alive pings and stock
+        lookups, with the activity time stored on every request (as before
+        SESSION_ACTIVITY_GRANULARITY) and at the configured granularity.
+        """
+        if requests <= 0:
+            return
+        user = self.benchmark_user()
+        urls = [reverse('ping_session'), reverse('stock_lookup') + '?q=SKU']
+        modes = [
+            ('every_request', {'SESSION_ACTIVITY_GRANULARITY': 0, 'SESSION_SAVE_EVERY_REQUEST': True}),
+            ('granularity', {}),
+        ]
+        writes = 0
+
+        def count_writes(execute, sql, params, many, context):
+            nonlocal writes
+            if 'django_session' in sql and sql.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                writes += 1
+            return execute(sql, params, many, context)
+
+        for mode, overrides in modes:
+            with override_settings(**overrides):
+                client = Client()
+                client.force_login(user)
+                writes = 0
+                # Wrapped rather than captured: each request resets the query log
+                with connection.execute_wrapper(count_writes):
+                    for n in range(requests):
+                        client.get(urls[n % len(urls)])
+                yield mode, {
+                    'granularity_s': settings.SESSION_ACTIVITY_GRANULARITY,
+                    'requests': requests,
+                    'session_writes': writes,
+                    'writes_per_request': round(writes / requests, 3),
+                }
+
+    def measure_views(self, repeat):
+        user = self.benchmark_user()
+        client = Client()
+        client.force_login(user)
+
+        today = date.today()
+        stock_codes = list(StockTransaction.objects.order_by('pk').values_list('stock_code', flat=True)[:5])
+        dashboard_cache = caches[settings.DASHBOARD_CACHE_ALIAS]
+
+        def posting_data(party_field, party):
+            data = {
+                'transaction_date': today.isoformat(),
+                party_field: party,
+                'form-TOTAL_FORMS': str(len(stock_codes)),
+                'form-INITIAL_FORMS': '0',
+            }
+            for n, stock_code in enumerate(stock_codes):
+                data[f'form-{n}-stock_code'] = stock_code
+                data[f'form-{n}-quantity'] = '1'
+                data[f'form-{n}-price_per_unit'] = str(Decimal('9.99'))
+            return data
+
+        # (name, method, url, data, before-each-run hook)
+        cases = [
+            ('transaction_list', 'get', reverse('transaction_list'), None, None),
+            ('dashboard_cold', 'get', reverse('dashboard'), None, dashboard_cache.clear),
+            ('dashboard_warm', 'get', reverse('dashboard'), None, None),
+            ('inventory_summary', 'get', reverse('inventory_summary'), None, None),
+            ('purchase_form', 'get', reverse('add_purchases'), None, None),
+            ('stock_lookup', 'get', reverse('stock_lookup') + '?q=SKU00001', None, None),
+            ('add_purchase', 'post', reverse('add_purchases'),
+             lambda: posting_data('supplier_name', 'Benchmark Supplier'), None),
+            ('add_sale', 'post', reverse('add_sales'),
+             lambda: posting_data('customer_name', 'Benchmark Customer'), None),
+        ]
+
+        for name, method, url, data, before in cases:
+            def request():
+                if method == 'post':
+                    return client.post(url, data())
+                return client.get(url)
+
+            # The before hook runs ahead of every request, outside the timed
+            # and query-captured region
+            before = before or (lambda: None)
+
+            # Warm-up run, also checks the view still answers
+            before()
+            response = request()
+            if response.status_code >= 400:
+                raise CommandError(f"{name} returned HTTP {response.status_code}")
+
+            timings = []
+            for _ in range(max(1, repeat)):
+                before()
+                # The request_started signal resets the query log, so start
+                # from an empty one or the captured slice comes out empty
+                reset_queries()
+                with CaptureQueriesContext(connection) as queries:
+                    run_started = time.perf_counter()
+                    request()
+                    timings.append((time.perf_counter() - run_started) * 1000)
+
+            # Memory is traced in a separate run, tracemalloc skews the timings
+            before()
+            tracemalloc.start()
+            try:
+                request()
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+            timings.sort()
+            yield name, {
+                'status': response.status_code,
+                'wall_ms': round(timings[len(timings) // 2], 1),
+                'wall_ms_min': round(timings[0], 1),
+                'wall_ms_max': round(timings[-1], 1),
+                'queries': len(queries),
+                'peak_memory_kb': round(peak / 1024, 1),
+            }
@@ -0,0 +1,51 @@
+import sys
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from stock_manager.imports import DEFAULT_CHUNK_SIZE, IMPORT_COLUMNS, import_csv
+
+
+class Command(BaseCommand):
+    help = "Import stock items, purchases or sales from a CSV file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(IMPORT_COLUMNS))
+        parser.add_argument('path', help="CSV file with a header row, or - for stdin.")
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help="Rows validated and written per transaction.")
+        parser.add_argument('--dry-run', action='store_true', help="Validate only, write nothing.")
+        parser.add_argument('--errors', help="Write the per-row error report to this CSV file.")
+        parser.add_argument('--encoding', default='utf-8-sig')
+
+    def handle(self, *args, **options):
+        kind = options['kind']
+        if options['path'] == '-':
+            file = sys.stdin
+        else:
+            try:
+                file = open(options['path'], encoding=options['encoding'], newline='')
+            except OSError as e:
+                raise CommandError(e)
+
+        try:
+            result = import_csv(kind, file, chunk_size=options['chunk_size'], dry_run=options['dry_run'])
+        except ValidationError as e:
+            raise CommandError(' '.join(e.messages))
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+        if options['errors']:
+            with open(options['errors'], 'w', newline='') as out:
+                result.write_error_report(out)
+        else:
+            for line, error in result.errors[:20]:
+                self.stderr.write(f"Line {line}: {error}")
+            if len(result.errors) > 20:
+                self.stderr.write(f"... {len(result.errors) - 20} more; use --errors to save them all.")
+
+        verb = "Would import" if options['dry_run'] else "Imported"
+        documents = f" in {result.documents_created} documents" if kind != 'stock' else ""
+        message = f"{verb} {result.rows_imported} of {result.rows_read} {kind} rows{documents}."
+        self.stdout.write(self.style.SUCCESS(message) if not result.errors else self.style.WARNING(message))
@@ -0,0 +1,51 @@
+import json
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from stock_manager.audit_archive import read_archive
+
+
+class Command(BaseCommand):
+    help = "Search archived audit log rows without loading them back; prints matches as JSON lines."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help="First day (YYYY-MM-DD), inclusive.")
+        parser.add_argument('--to', dest='end', help="Last day (YYYY-MM-DD), inclusive.")
+        parser.add_argument('--user', help="Username.")
+        parser.add_argument('--action')
+        parser.add_argument('--model', dest='model_name')
+        parser.add_argument('--object-id', type=int)
+        parser.add_argument('--directory', default=settings.AUDIT_ARCHIVE_DIR)
+
+    def day_start(self, value, name):
+        try:
+            day = parse_date(value)
+        except ValueError:
+            day = None
+        if day is None:
+            raise CommandError(f"--{name} must be a YYYY-MM-DD date.")
+        return datetime.combine(day, time.min, tzinfo=timezone.get_current_timezone())
+
+    def handle(self, *args, **options):
+        start = self.day_start(options['start'], 'from') if options['start'] else None
+        end = self.day_start(options['end'], 'to') + timedelta(days=1) if options['end'] else None
+
+        user_id = None
+        if options['user']:
+            # The user may be gone; archived rows keep the id
+            user_id = get_user_model().objects.filter(username=options['user']).values_list('pk', flat=True).first()
+            if user_id is None:
+                raise CommandError(f"No user named {options['user']!r}.")
+
+        rows = read_archive(
+            options['directory'], start=start, end=end, user_id=user_id, action=options['action'],
+            model_name=options['model_name'], object_id=options['object_id'],
+        )
+        for row in rows:
+            row['timestamp'] = row['timestamp'].isoformat()
+            self.stdout.write(json.dumps(row))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from stock_manager.costing import COSTING_METHODS, rebuild_costs
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the cost positions and cost layers from purchases and the daily balances "
+            "(run rebuild_daily_balances first if those are stale).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--method', choices=sorted(COSTING_METHODS),
+                            help="Costing method to rebuild; defaults to INVENTORY_COSTING_METHOD.")
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help="Rows fetched and inserted per round-trip.")
+
+    def handle(self, *args, **options):
+        written = rebuild_costs(method=options['method'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} cost positions."))
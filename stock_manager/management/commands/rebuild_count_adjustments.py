@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from stock_manager.adjustments import rebuild_adjustments
+
+
+class Command(BaseCommand):
+    help = "Rebuild the StockCountAdjustment table from purchases, sales and stock counts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help="Rows fetched and inserted per round-trip.")
+
+    def handle(self, *args, **options):
+        written = rebuild_adjustments(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} count adjustment rows."))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from stock_manager.balances import rebuild_daily_balances
+
+
+class Command(BaseCommand):
+    help = "Rebuild the StockDailyBalance table from purchases, sales and stock counts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help="Rows fetched and inserted per round-trip.")
+
+    def handle(self, *args, **options):
+        written = rebuild_daily_balances(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} daily balance rows."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from stock_manager.prices import rebuild_prices
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the StockPrice history and the last cost, last purchase and last sale "
+            "columns of every SKU from purchases and sales.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help="Rows fetched and inserted per round-trip.")
+
+    def handle(self, *args, **options):
+        written = rebuild_prices(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} stock price rows."))
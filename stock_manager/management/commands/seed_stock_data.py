@@ -0,0 +1,214 @@
+import random
+from contextlib import contextmanager
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min
+from django.db.models.signals import post_delete, pre_delete
+
+from stock_manager import audit
+from stock_manager.adjustments import rebuild_adjustments
+from stock_manager.balances import rebuild_daily_balances
+from stock_manager.costing import rebuild_costs
+from stock_manager.dashboard_cache import invalidate_snapshots_from
+from stock_manager.models import (
+    CostLayer, Purchase, PurchaseDocument, Sale, SaleDocument, StockCostBalance, StockCountAdjustment,
+    StockCountChunk, StockCountEntry, StockCountSession, StockDailyBalance, StockPrice, StockTransaction,
+    stock_search_key,
+)
+from stock_manager.prices import rebuild_prices
+from stock_manager.stock_cache import bump_stock_version
+
+UOMS = ['EA', 'BOX', 'KG', 'L', 'PACK']
+WORDS = ['Bolt', 'Nut', 'Washer', 'Bracket', 'Cable', 'Valve', 'Filter', 'Gasket', 'Hinge', 'Panel',
+         'Pump', 'Sensor', 'Switch', 'Tape', 'Tube', 'Clamp', 'Spring', 'Bearing', 'Seal', 'Fuse']
+
+# Fixed so that the same seed gives the same data whenever it is run
+DEFAULT_END_DATE = date(2025, 12, 31)
+
+# Deleted children first, so no delete has rows left to cascade to
+FLUSHED_MODELS = (
+    StockCountAdjustment, StockCountChunk, StockCountEntry, StockCountSession, Purchase, PurchaseDocument, Sale,
+    SaleDocument, StockDailyBalance, StockPrice, StockCostBalance, CostLayer, StockTransaction,
+)
+
+
+@contextmanager
+def delete_signals_muted():
+    """
+    Detach every pre_delete and post_delete receiver, so a queryset delete()
+    is a few plain DELETEs instead of per-row signal work.
+    """
+    saved = [(signal, signal.receivers) for signal in (pre_delete, post_delete)]
+    for signal, _ in saved:
+        signal.receivers = []
+        signal.sender_receivers_cache.clear()
+    try:
+        yield
+    finally:
+        for signal, receivers in saved:
+            signal.receivers = receivers
+            signal.sender_receivers_cache.clear()
+
+
+class Command(BaseCommand):
+    help = "Seed the database with deterministic synthetic stock data for benchmarks and demos."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skus', type=int, default=1000, help="Number of stock items.")
+        parser.add_argument('--years', type=float, default=2, help="Years of history ending on --end-date.")
+        parser.add_argument('--end-date', type=date.fromisoformat, default=DEFAULT_END_DATE,
+                            help=f"Last day of the history, YYYY-MM-DD (default {DEFAULT_END_DATE}).")
+        parser.add_argument('--documents-per-day', type=int, default=10,
+                            help="Purchase documents and sale documents posted per day (each).")
+        parser.add_argument('--lines-per-document', type=int, default=5)
+        parser.add_argument('--count-sessions', type=int, default=12,
+                            help="Stock count sessions spread evenly over the history.")
+        parser.add_argument('--count-fraction', type=float, default=0.3,
+                            help="Share of SKUs counted in each session.")
+        parser.add_argument('--seed', type=int, default=42, help="Random seed; same seed, same data.")
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--flush', action='store_true',
+                            help="Delete all existing stock data first.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+
+        end = options['end_date']
+        start = end - timedelta(days=int(options['years'] * 365))
+        days = (end - start).days + 1
+
+        # Dashboard months from the earliest data flushed or written on are stale
+        stale_from = start
+        if options['flush']:
+            stale_from = min(filter(None, (start, self.flush())))
+
+        with transaction.atomic():
+            stock_ids, costs = self.seed_stock(rng, options['skus'], batch_size)
+            movements = self.seed_documents(rng, stock_ids, costs, start, days, options, batch_size)
+            counts = self.seed_counts(rng, stock_ids, start, days, options, batch_size)
+            balances = rebuild_daily_balances(batch_size=batch_size)
+            rebuild_prices(batch_size=batch_size)
+            rebuild_adjustments(batch_size=batch_size)
+            rebuild_costs(batch_size=batch_size)
+            invalidate_snapshots_from(stale_from)
+        # Written before returning, so a benchmark that seeds first does not
+        # time the audit writer catching up
+        audit.writer.flush()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Seeded {len(stock_ids)} SKUs, {movements} purchase/sale lines, {counts} count entries "
+            f"and {balances} daily balance rows from {start} to {end}."
+        ))
+
+    def flush(self):
+        """
+        Delete all stock data (audit log rows are history and stay).  Returns
+        the earliest date the deleted movements and counts were on, if any.
+        """
+        earliest = [
+            model.objects.aggregate(earliest=Min(field))['earliest']
+            for model, field in ((Purchase, 'transaction_date'), (Sale, 'transaction_date'),
+                                 (StockCountSession, 'date'))
+        ]
+        with transaction.atomic(), delete_signals_muted():
+            for model in FLUSHED_MODELS:
+                model.objects.all().delete()
+        bump_stock_version()
+        return min(filter(None, earliest), default=None)
+
+    def seed_stock(self, rng, skus, batch_size):
+        last_pk = StockTransaction.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        existing = StockTransaction.objects.count()
+
+        def stock_item(i):
+            code = f'SKU{existing + i:07d}'
+            description = f'{rng.choice(WORDS)} {rng.choice(WORDS)} {rng.randint(1, 999)}'
+            return StockTransaction(
+                stock_code=code,
+                stock_description=description,
+                uom=rng.choice(UOMS),
+                search_key=stock_search_key(code, description),
+            )
+
+        items = StockTransaction.objects.bulk_create([stock_item(i) for i in range(skus)], batch_size=batch_size)
+        bump_stock_version()
+        audit.record_created(items)
+        stock_ids = list(
+            StockTransaction.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)
+        )
+        costs = {stock_id: Decimal(rng.randint(100, 50000)) / 100 for stock_id in stock_ids}
+        return stock_ids, costs
+
+    def seed_documents(self, rng, stock_ids, costs, start, days, options, batch_size):
+        per_day = options['documents_per_day']
+        lines_per_document = options['lines_per_document']
+        written = 0
+
+        for offset in range(days):
+            day = start + timedelta(days=offset)
+            # Numbered here rather than from the sale sequence, which --flush
+            # does not reset and real sales go on drawing from
+            for kind, numbers in (('purchase', [f'SEED-{day:%Y%m%d}-{n:04d}' for n in range(per_day)]),
+                                  ('sale', [f'SEED-S{day:%Y%m%d}-{n:04d}' for n in range(per_day)])):
+                header_model, line_model, party = (
+                    (PurchaseDocument, Purchase, 'supplier_name') if kind == 'purchase'
+                    else (SaleDocument, Sale, 'customer_name')
+                )
+                headers, lines = [], []
+                for number in numbers:
+                    party_name = f'{kind.title()} Partner {rng.randint(1, 200)}'
+                    doc_lines = []
+                    for stock_id in rng.sample(stock_ids, min(lines_per_document, len(stock_ids))):
+                        cost = costs[stock_id]
+                        price = cost if kind == 'purchase' else (cost * Decimal('1.3')).quantize(Decimal('0.01'))
+                        doc_lines.append(line_model(
+                            transaction_date=day, document_number=number, stock_code_id=stock_id,
+                            quantity=Decimal(rng.randint(1, 40 if kind == 'purchase' else 25)),
+                            price_per_unit=price, **{party: party_name},
+                        ))
+                    headers.append(header_model(
+                        document_number=number, transaction_date=day,
+                        total_quantity=sum(line.quantity for line in doc_lines),
+                        total_value=sum(line.quantity * line.price_per_unit for line in doc_lines),
+                        **{party: party_name},
+                    ))
+                    lines.append(doc_lines)
+
+                header_model.objects.bulk_create(headers, batch_size=batch_size)
+                header_ids = dict(
+                    header_model.objects.filter(document_number__in=numbers).values_list('document_number', 'pk')
+                )
+                flat = []
+                for doc_lines in lines:
+                    for line in doc_lines:
+                        line.document_id = header_ids[line.document_number]
+                        flat.append(line)
+                line_model.objects.bulk_create(flat, batch_size=batch_size)
+                audit.record_created(flat)
+                written += len(flat)
+        return written
+
+    def seed_counts(self, rng, stock_ids, start, days, options, batch_size):
+        sessions = options['count_sessions']
+        if not sessions:
+            return 0
+        counted = max(1, int(len(stock_ids) * options['count_fraction']))
+        written = 0
+        for n in range(sessions):
+            # Saved one at a time; there are only a handful and they need pks
+            session = StockCountSession.objects.create(
+                date=start + timedelta(days=(n + 1) * days // (sessions + 1))
+            )
+            entries = [
+                StockCountEntry(session=session, stock_code_id=stock_id,
+                                quantity_counted=Decimal(rng.randint(0, 200)))
+                for stock_id in rng.sample(stock_ids, counted)
+            ]
+            StockCountEntry.objects.bulk_create(entries, batch_size=batch_size)
+            audit.record_created(entries)
+            written += len(entries)
+        return written
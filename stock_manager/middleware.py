@@ -1,11 +1,23 @@
 import datetime
 from django.conf import settings
+from django.http import JsonResponse
 from django.shortcuts import redirect
+from django.urls import reverse
 from django.contrib import messages
 
+from .audit import reset_current_user, set_current_user
+
 class SessionTimeoutMiddleware:
     """
     Middleware to log out users after `SESSION_IDLE_TIMEOUT` seconds of inactivity.
+
+    The last-activity time is only stored again once the stored value is
+    `SESSION_ACTIVITY_GRANULARITY` seconds old, so most requests leave the
+    session unmodified and it is not written back.  The stored time can then
+    trail the real last request by up to the granularity.  It is still
+    compared against the timeout itself, so nobody stays signed in past
+    `SESSION_IDLE_TIMEOUT`; a user may be logged out up to the granularity
+    early instead.
     """
     def __init__(self, get_response):
         self.get_response = get_response
@@ -14,16 +26,36 @@ class SessionTimeoutMiddleware:
         if request.user.is_authenticated:
             current_time = datetime.datetime.utcnow().timestamp()
             last_activity = request.session.get('last_activity')
+            granularity = getattr(settings, 'SESSION_ACTIVITY_GRANULARITY', 0)
 
             if last_activity:
                 elapsed = current_time - last_activity
                 if elapsed > getattr(settings, 'SESSION_IDLE_TIMEOUT', 900):
                     from django.contrib.auth import logout
                     logout(request)
+                    if request.path == reverse('ping_session'):
+                        # The keep-alive script handles this itself
+                        return JsonResponse({'status': 'expired'}, status=401)
                     messages.info(request, "Your session has expired due to inactivity.")
                     return redirect('login')  # Adjust to your login URL name
 
-            # Update last activity timestamp
-            request.session['last_activity'] = current_time
+            # Update last activity timestamp, at most once per granularity
+            if not last_activity or current_time - last_activity >= granularity:
+                request.session['last_activity'] = current_time
 
         return self.get_response(request)
+
+
+class AuditUserMiddleware:
+    """
+    Attributes audit log rows recorded while handling a request to its user.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = set_current_user(getattr(request, 'user', None))
+        try:
+            return self.get_response(request)
+        finally:
+            reset_current_user(token)
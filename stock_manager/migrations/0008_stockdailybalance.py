@@ -0,0 +1,109 @@
+# Generated by Django 5.2.5 on 2026-10-18 19:06
+
+import heapq
+from decimal import Decimal
+from itertools import groupby
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import F, Sum, Window
+from django.db.models.functions import RowNumber
+
+BATCH_SIZE = 2000
+
+
+def backfill_daily_balances(apps, schema_editor):
+    """
+    One row per (stock, day) with movements or a count, merged from per-day
+    totals streamed in (stock, day) order.  A frozen copy of what
+    balances.rebuild_daily_balances() did when the table was added.
+    """
+    StockDailyBalance = apps.get_model('stock_manager', 'StockDailyBalance')
+
+    def daily_totals(model_name, kind):
+        qs = (
+            apps.get_model('stock_manager', model_name).objects.values_list('stock_code', 'transaction_date')
+            .annotate(total=Sum('quantity'))
+            .order_by('stock_code', 'transaction_date')
+        )
+        for stock_id, day, total in qs.iterator(chunk_size=BATCH_SIZE):
+            yield stock_id, day, kind, total
+
+    def daily_counts():
+        # Latest entry per (stock, day) wins
+        qs = (
+            apps.get_model('stock_manager', 'StockCountEntry').objects.annotate(
+                count_date=F('session__date'),
+                rank=Window(
+                    RowNumber(),
+                    partition_by=[F('stock_code'), F('session__date')],
+                    order_by=[F('id').desc()],
+                ),
+            )
+            .filter(rank=1)
+            .values_list('stock_code', 'count_date', 'quantity_counted')
+            .order_by('stock_code', 'count_date')
+        )
+        for stock_id, day, qty in qs.iterator(chunk_size=BATCH_SIZE):
+            yield stock_id, day, 'counted', qty
+
+    merged = heapq.merge(
+        daily_totals('Purchase', 'in'),
+        daily_totals('Sale', 'out'),
+        daily_counts(),
+        key=lambda item: (item[0], item[1]),
+    )
+
+    batch = []
+    current_stock, closing = None, Decimal('0')
+    for (stock_id, day), items in groupby(merged, key=lambda item: (item[0], item[1])):
+        if stock_id != current_stock:
+            current_stock, closing = stock_id, Decimal('0')
+
+        totals = {'in': Decimal('0'), 'out': Decimal('0'), 'counted': None}
+        for _, _, kind, value in items:
+            totals[kind] = value
+
+        if totals['counted'] is not None:
+            closing = totals['counted']
+        else:
+            closing = closing + totals['in'] - totals['out']
+
+        batch.append(StockDailyBalance(
+            stock_code_id=stock_id,
+            date=day,
+            quantity_in=totals['in'],
+            quantity_out=totals['out'],
+            quantity_counted=totals['counted'],
+            closing_quantity=closing,
+        ))
+        if len(batch) >= BATCH_SIZE:
+            StockDailyBalance.objects.bulk_create(batch)
+            batch = []
+    StockDailyBalance.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_manager', '0007_alter_purchase_document_number_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockDailyBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('quantity_in', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('quantity_out', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('quantity_counted', models.DecimalField(blank=True, decimal_places=2, max_digits=14, null=True)),
+                ('closing_quantity', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('stock_code', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_balances', to='stock_manager.stocktransaction')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('stock_code', 'date'), name='unique_daily_balance_per_stock')],
+            },
+        ),
+        migrations.RunPython(backfill_daily_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.5 on 2026-10-18 19:11
+
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def seed_sequences(apps, schema_editor):
+    """Start each sequence after the highest number already issued."""
+    DocumentSequence = apps.get_model('stock_manager', 'DocumentSequence')
+    models_by_name = {
+        'sale': apps.get_model('stock_manager', 'Sale'),
+        'purchase': apps.get_model('stock_manager', 'Purchase'),
+    }
+    for name, config in settings.DOCUMENT_SEQUENCES.items():
+        model = models_by_name.get(name)
+        prefix = config.get('prefix', '')
+        highest = 0
+        if model is not None:
+            pattern = re.compile(re.escape(prefix) + r'(\d+)$')
+            numbers = model.objects.filter(document_number__startswith=prefix).values_list('document_number', flat=True)
+            for number in numbers.iterator():
+                match = pattern.match(number)
+                if match:
+                    highest = max(highest, int(match.group(1)))
+            if name == 'sale':
+                # Sale numbers used to be derived from the last row id
+                highest = max(highest, model.objects.aggregate(models.Max('id'))['id__max'] or 0)
+        DocumentSequence.objects.create(
+            name=name,
+            prefix=prefix,
+            number_format=config.get('format', '{prefix}{number:06d}'),
+            next_number=highest + 1,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_manager', '0008_stockdailybalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('prefix', models.CharField(blank=True, max_length=20)),
+                ('number_format', models.CharField(default='{prefix}{number:06d}', max_length=100)),
+                ('next_number', models.PositiveBigIntegerField(default=1)),
+            ],
+        ),
+        migrations.RunPython(seed_sequences, migrations.RunPython.noop),
+    ]
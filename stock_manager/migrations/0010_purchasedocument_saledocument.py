@@ -0,0 +1,101 @@
+# Generated by Django 5.2.5 on 2026-10-18 19:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import F, Min, OuterRef, Subquery, Sum
+
+
+def create_document_headers(apps, schema_editor):
+    """One header per distinct document_number, then point the lines at it."""
+    for line_name, header_name, party_field in (
+        ('Purchase', 'PurchaseDocument', 'supplier_name'),
+        ('Sale', 'SaleDocument', 'customer_name'),
+    ):
+        Line = apps.get_model('stock_manager', line_name)
+        Header = apps.get_model('stock_manager', header_name)
+
+        documents = (
+            Line.objects.values('document_number')
+            .annotate(
+                first_date=Min('transaction_date'),
+                party=Min(party_field),
+                line_quantity=Sum('quantity'),
+                line_value=Sum(F('quantity') * F('price_per_unit')),
+            )
+            .order_by('document_number')
+        )
+        Header.objects.bulk_create(
+            (
+                Header(
+                    document_number=doc['document_number'],
+                    transaction_date=doc['first_date'],
+                    total_quantity=doc['line_quantity'] or 0,
+                    total_value=doc['line_value'] or 0,
+                    **{party_field: doc['party']},
+                )
+                for doc in documents.iterator()
+            ),
+            batch_size=1000,
+        )
+        Line.objects.update(document_id=Subquery(
+            Header.objects.filter(document_number=OuterRef('document_number')).values('id')[:1]
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_manager', '0009_documentsequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PurchaseDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('document_number', models.CharField(max_length=50, unique=True)),
+                ('transaction_date', models.DateField()),
+                ('total_quantity', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_value', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('supplier_name', models.CharField(max_length=100)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='SaleDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('document_number', models.CharField(max_length=50, unique=True)),
+                ('transaction_date', models.DateField()),
+                ('total_quantity', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_value', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('customer_name', models.CharField(max_length=100)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AlterField(
+            model_name='purchase',
+            name='document_number',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='sale',
+            name='document_number',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='purchase',
+            name='document',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='stock_manager.purchasedocument'),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='document',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='stock_manager.saledocument'),
+        ),
+        migrations.RunPython(create_document_headers, migrations.RunPython.noop),
+    ]
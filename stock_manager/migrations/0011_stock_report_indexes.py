@@ -0,0 +1,38 @@
+# Generated by Django 5.2.5 on 2026-10-18 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_manager', '0010_purchasedocument_saledocument'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockcountsession',
+            name='date',
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['stock_code', 'transaction_date'], include=('quantity', 'price_per_unit'), name='purchase_stock_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['transaction_date'], name='purchase_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['stock_code', 'transaction_date'], include=('quantity', 'price_per_unit'), name='sale_stock_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['transaction_date'], name='sale_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stockcountentry',
+            index=models.Index(fields=['stock_code', 'session'], include=('quantity_counted',), name='count_entry_stock_session_idx'),
+        ),
+    ]
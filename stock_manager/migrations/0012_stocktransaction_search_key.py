@@ -0,0 +1,87 @@
+# Generated by Django 5.2.5 on 2026-10-18 21:40
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+TRIGRAM_INDEX = 'stock_search_key_trgm'
+
+
+# Frozen copies of models.normalize_search_text() and stock_search_key() as
+# they were when the column was added, so later changes there cannot change
+# what this migration writes
+def normalize_search_text(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.split(r'[\W_]+', text.upper())).strip()
+
+
+def stock_search_key(stock_code, stock_description):
+    code = normalize_search_text(stock_code)
+    compact_code = code.replace(' ', '')
+    words = [code, compact_code if compact_code != code else '', normalize_search_text(stock_description)]
+    return (' ' + ' '.join(filter(None, words)))[:200]
+
+
+def fill_search_keys(apps, schema_editor):
+    StockTransaction = apps.get_model('stock_manager', 'StockTransaction')
+    batch = []
+    for stock in StockTransaction.objects.only('stock_code', 'stock_description').iterator(chunk_size=2000):
+        stock.search_key = stock_search_key(stock.stock_code, stock.stock_description)
+        batch.append(stock)
+        if len(batch) >= 2000:
+            StockTransaction.objects.bulk_update(batch, ['search_key'])
+            batch = []
+    if batch:
+        StockTransaction.objects.bulk_update(batch, ['search_key'])
+
+
+def create_trigram_index(apps, schema_editor):
+    """
+    GIN trigram index for LIKE '%word%' on PostgreSQL.  pg_trgm ships with
+    PostgreSQL and is a trusted extension from version 13; where it still
+    cannot be installed the index is skipped and search falls back to scans.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = apps.get_model('stock_manager', 'StockTransaction')._meta.db_table
+    schema_editor.execute("""
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN insufficient_privilege THEN
+            RAISE NOTICE 'pg_trgm could not be installed; stock search will not be indexed';
+        END
+        $$
+    """)
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            return
+    schema_editor.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema_editor.quote_name(TRIGRAM_INDEX)} "
+        f"ON {schema_editor.quote_name(table)} USING gin (search_key gin_trgm_ops)"
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f"DROP INDEX IF EXISTS {schema_editor.quote_name(TRIGRAM_INDEX)}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_manager', '0011_stock_report_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stocktransaction',
+            name='search_key',
+            field=models.CharField(default='', editable=False, max_length=200),
+        ),
+        migrations.RunPython(fill_search_keys, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,112 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:12
+
+import heapq
+from decimal import Decimal
+from itertools import groupby
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+BATCH_SIZE = 2000
+ZERO = Decimal('0')
+
+
+def backfill_adjustments(apps, schema_editor):
+    """
+    One adjustment per count entry, from purchases, daily sale totals and
+    count entries streamed in (stock, day) order.  A frozen copy of what
+    adjustments.rebuild_adjustments() did when the table was added.
+    """
+    Purchase = apps.get_model('stock_manager', 'Purchase')
+    Sale = apps.get_model('stock_manager', 'Sale')
+    StockCountEntry = apps.get_model('stock_manager', 'StockCountEntry')
+    StockCountAdjustment = apps.get_model('stock_manager', 'StockCountAdjustment')
+
+    def purchases():
+        # Every line, oldest first, so the last one seen on a day sets the price
+        qs = Purchase.objects.values_list(
+            'stock_code', 'transaction_date', 'quantity', 'price_per_unit'
+        ).order_by('stock_code', 'transaction_date', 'id')
+        for stock_id, day, qty, price in qs.iterator(chunk_size=BATCH_SIZE):
+            yield stock_id, day, 0, (qty, price)
+
+    def sales():
+        qs = Sale.objects.values_list('stock_code', 'transaction_date').annotate(
+            total=Sum('quantity')
+        ).order_by('stock_code', 'transaction_date')
+        for stock_id, day, total in qs.iterator(chunk_size=BATCH_SIZE):
+            yield stock_id, day, 1, total
+
+    def counts():
+        qs = StockCountEntry.objects.values_list(
+            'id', 'stock_code', 'session__date', 'quantity_counted'
+        ).order_by('stock_code', 'session__date', 'id')
+        for entry_id, stock_id, day, counted in qs.iterator(chunk_size=BATCH_SIZE):
+            yield stock_id, day, 2, (entry_id, counted)
+
+    def adjustment(entry_id, stock_id, day, counted, system_qty, price):
+        variance = counted - system_qty
+        return StockCountAdjustment(
+            entry_id=entry_id,
+            stock_code_id=stock_id,
+            date=day,
+            system_quantity=system_qty,
+            variance_quantity=variance,
+            unit_price=price,
+            variance_value=variance * price,
+        )
+
+    # Within a day: purchases, then sales, then counts
+    merged = heapq.merge(purchases(), sales(), counts(), key=lambda item: (item[0], item[1], item[2]))
+
+    batch = []
+    current_stock, on_hand, price = None, ZERO, ZERO
+    for (stock_id, day), items in groupby(merged, key=lambda item: (item[0], item[1])):
+        if stock_id != current_stock:
+            current_stock, on_hand, price = stock_id, ZERO, ZERO
+
+        counted_today = None
+        for _, _, kind, value in items:
+            if kind == 0:
+                on_hand += value[0]
+                price = value[1] or ZERO
+            elif kind == 1:
+                on_hand -= value
+            else:
+                entry_id, counted_today = value
+                batch.append(adjustment(entry_id, stock_id, day, counted_today, on_hand, price))
+        if counted_today is not None:
+            on_hand = counted_today
+
+        if len(batch) >= BATCH_SIZE:
+            StockCountAdjustment.objects.bulk_create(batch)
+            batch = []
+    StockCountAdjustment.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_manager', '0014_audit_log_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockCountAdjustment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('system_quantity', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('variance_quantity', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('unit_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('variance_value', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('entry', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='adjustment', to='stock_manager.stockcountentry')),
+                ('stock_code', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='count_adjustments', to='stock_manager.stocktransaction')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date'], include=('variance_quantity', 'variance_value'), name='count_adjustment_date_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_adjustments, migrations.RunPython.noop),
+    ]
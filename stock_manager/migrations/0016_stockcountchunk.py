@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:15
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_manager', '0015_stockcountadjustment'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockCountChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunk_id', models.CharField(max_length=100)),
+                ('lines_received', models.PositiveIntegerField()),
+                ('lines_rejected', models.PositiveIntegerField(default=0)),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='stock_manager.stockcountsession')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('session', 'chunk_id'), name='unique_count_chunk_per_session')],
+            },
+        ),
+    ]
@@ -0,0 +1,80 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:23
+
+from itertools import groupby
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+BATCH_SIZE = 2000
+
+
+def backfill_prices(apps, schema_editor):
+    """
+    The price of the last purchase line of each (stock, day), then each SKU's
+    latest price and purchase and sale dates.  A frozen copy of what
+    prices.rebuild_prices() did when the table was added.
+    """
+    Purchase = apps.get_model('stock_manager', 'Purchase')
+    Sale = apps.get_model('stock_manager', 'Sale')
+    StockPrice = apps.get_model('stock_manager', 'StockPrice')
+    StockTransaction = apps.get_model('stock_manager', 'StockTransaction')
+
+    lines = Purchase.objects.values_list(
+        'stock_code', 'transaction_date', 'price_per_unit'
+    ).order_by('stock_code', 'transaction_date', 'id').iterator(chunk_size=BATCH_SIZE)
+
+    batch = []
+    for (stock_id, day), day_lines in groupby(lines, key=lambda line: (line[0], line[1])):
+        *_, (_, _, price) = day_lines
+        batch.append(StockPrice(stock_code_id=stock_id, date=day, price=price))
+        if len(batch) >= BATCH_SIZE:
+            StockPrice.objects.bulk_create(batch)
+            batch = []
+    StockPrice.objects.bulk_create(batch)
+
+    latest = StockPrice.objects.filter(stock_code=OuterRef('pk')).order_by('-date')
+    last_sale = Sale.objects.filter(stock_code=OuterRef('pk')).order_by('-transaction_date')
+    StockTransaction.objects.update(
+        last_cost=Subquery(latest.values('price')[:1]),
+        last_purchase_date=Subquery(latest.values('date')[:1]),
+        last_sale_date=Subquery(last_sale.values('transaction_date')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_manager', '0016_stockcountchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stocktransaction',
+            name='last_cost',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='stocktransaction',
+            name='last_purchase_date',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='stocktransaction',
+            name='last_sale_date',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='StockPrice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('stock_code', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='prices', to='stock_manager.stocktransaction')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('stock_code', 'date'), name='unique_stock_price_per_day')],
+            },
+        ),
+        migrations.RunPython(backfill_prices, migrations.RunPython.noop),
+    ]
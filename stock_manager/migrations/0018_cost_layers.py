@@ -0,0 +1,185 @@
+# Generated by Django 5.2.5 on 2026-10-18 20:28
+
+import heapq
+from collections import deque
+from decimal import Decimal
+from itertools import groupby
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Min, Sum
+
+BATCH_SIZE = 2000
+ZERO = Decimal('0')
+COST_PLACES = Decimal('0.0001')
+
+
+# Frozen copy of FifoCost in costing.py as it was when the tables were added,
+# cut down to a position started from nothing, so later changes there cannot
+# change what this migration writes.
+
+class FifoCost:
+    name = 'fifo'
+    keeps_layers = True
+
+    def __init__(self):
+        self.quantity = self.unit_cost = self.value = self.received_total = self.issued_total = ZERO
+        # (date, quantity, unit_cost, cumulative_quantity) received since the last day closed
+        self.received = []
+        # [quantity left, unit_cost] of the open layers, oldest first
+        self.open = deque()
+        self.open_value = ZERO
+
+    def _open(self, quantity, unit_cost):
+        if quantity > 0:
+            self.open.append([quantity, unit_cost])
+            self.open_value += quantity * unit_cost
+
+    def _revalue(self):
+        self.value = self.open_value if self.quantity > 0 else self.quantity * self.unit_cost
+
+    def receive(self, day, quantity, unit_cost):
+        self.quantity += quantity
+        self.received_total += quantity
+        self.received.append((day, quantity, unit_cost, self.received_total))
+        self.unit_cost = unit_cost
+        # Anything issued short is taken from this layer straight away
+        self._open(min(quantity, self.received_total - self.issued_total), unit_cost)
+        self._revalue()
+
+    def issue(self, quantity):
+        self.quantity -= quantity
+        self.issued_total += quantity
+        while quantity > 0 and self.open:
+            layer = self.open[0]
+            taken = min(layer[0], quantity)
+            layer[0] -= taken
+            quantity -= taken
+            self.open_value -= taken * layer[1]
+            if not layer[0]:
+                self.open.popleft()
+        self._revalue()
+
+
+def backfill_costs(apps, schema_editor):
+    """
+    FIFO cost positions and layers, from daily receipts and the daily balances
+    streamed in (stock, day) order.  A frozen copy of what
+    costing.rebuild_costs('fifo') did when the tables were added.
+
+    FIFO is the default INVENTORY_COSTING_METHOD.  The setting is not read
+    here, so what this writes does not depend on the environment migrating;
+    installations on another method run rebuild_cost_layers, as after any
+    change of method.
+    """
+    Purchase = apps.get_model('stock_manager', 'Purchase')
+    StockDailyBalance = apps.get_model('stock_manager', 'StockDailyBalance')
+    StockCostBalance = apps.get_model('stock_manager', 'StockCostBalance')
+    CostLayer = apps.get_model('stock_manager', 'CostLayer')
+    costing = FifoCost
+
+    def receipts():
+        # Purchases summed per (stock, day, price), in order of each group's first line
+        qs = Purchase.objects.values('stock_code', 'transaction_date', 'price_per_unit').annotate(
+            total=Sum('quantity'), first_id=Min('id'),
+        ).order_by('stock_code', 'transaction_date', 'first_id').values_list(
+            'stock_code', 'transaction_date', 'total', 'price_per_unit'
+        )
+        for stock_id, day, quantity, price in qs.iterator(chunk_size=BATCH_SIZE):
+            yield stock_id, day, 0, (quantity, price)
+
+    def days():
+        qs = StockDailyBalance.objects.values_list(
+            'stock_code', 'date', 'quantity_out', 'quantity_counted'
+        ).order_by('stock_code', 'date')
+        for stock_id, day, quantity_out, quantity_counted in qs.iterator(chunk_size=BATCH_SIZE):
+            yield stock_id, day, 1, (quantity_out, quantity_counted)
+
+    # Within a day: the receipts, then the day's outs and count
+    merged = heapq.merge(receipts(), days(), key=lambda item: (item[0], item[1], item[2]))
+
+    balances, layers = [], []
+    current_stock, position = None, None
+    for (stock_id, day), items in groupby(merged, key=lambda item: (item[0], item[1])):
+        if stock_id != current_stock:
+            current_stock, position = stock_id, costing()
+
+        quantity_out, quantity_counted = ZERO, None
+        for _, _, kind, value in items:
+            if kind == 0:
+                position.receive(day, *value)
+            else:
+                quantity_out, quantity_counted = value
+        if quantity_out:
+            position.issue(quantity_out)
+        if quantity_counted is not None:
+            # Bring the quantity to the count
+            difference = quantity_counted - position.quantity
+            if difference > 0:
+                position.receive(day, difference, position.unit_cost)
+            elif difference < 0:
+                position.issue(-difference)
+
+        balances.append(StockCostBalance(
+            stock_code_id=stock_id, method=costing.name, date=day, quantity=position.quantity,
+            unit_cost=position.unit_cost.quantize(COST_PLACES), value=position.value.quantize(COST_PLACES),
+            received_total=position.received_total, issued_total=position.issued_total,
+        ))
+        layers.extend(
+            CostLayer(
+                stock_code_id=stock_id, method=costing.name, date=received_on, quantity=quantity,
+                unit_cost=unit_cost, cumulative_quantity=cumulative,
+            )
+            for received_on, quantity, unit_cost, cumulative in position.received
+        )
+        position.received = []
+
+        if len(balances) >= BATCH_SIZE:
+            StockCostBalance.objects.bulk_create(balances)
+            CostLayer.objects.bulk_create(layers)
+            balances, layers = [], []
+    StockCostBalance.objects.bulk_create(balances)
+    CostLayer.objects.bulk_create(layers)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stock_manager', '0017_stocktransaction_last_cost_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CostLayer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=20)),
+                ('date', models.DateField()),
+                ('quantity', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('unit_cost', models.DecimalField(decimal_places=4, max_digits=14)),
+                ('cumulative_quantity', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('stock_code', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cost_layers', to='stock_manager.stocktransaction')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['stock_code', 'method', 'date'], name='cost_layer_stock_date_idx'), models.Index(fields=['stock_code', 'method', 'cumulative_quantity'], name='cost_layer_position_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockCostBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=20)),
+                ('date', models.DateField()),
+                ('quantity', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('unit_cost', models.DecimalField(decimal_places=4, max_digits=14)),
+                ('value', models.DecimalField(decimal_places=4, max_digits=18)),
+                ('received_total', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('issued_total', models.DecimalField(decimal_places=2, max_digits=16)),
+                ('stock_code', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cost_balances', to='stock_manager.stocktransaction')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('stock_code', 'method', 'date'), name='unique_cost_balance_per_day')],
+            },
+        ),
+        migrations.RunPython(backfill_costs, migrations.RunPython.noop),
+    ]
@@ -1,58 +1,349 @@
-from django.db import models
+import re
+import unicodedata
+
+from django.db import models, transaction
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 
+class AtomicWriteModel(models.Model):
+    """
+    Runs save() and delete() in a transaction so that the signal receivers
+    maintaining derived tables (see signals.py) commit or roll back together
+    with the row itself.
+    """
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
+
+
+SEARCH_KEY_LENGTH = 200
+
+
+def normalize_search_text(text):
+    """Upper case, accents dropped, every run of other characters one space."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.split(r'[\W_]+', text.upper())).strip()
+
+
+def stock_search_key(stock_code, stock_description):
+    """
+    Value of StockTransaction.search_key: the normalized code (also without
+    its separators, so 'SKU-001' is found by 'SKU001') and description, with
+    a leading space so that a word prefix is matched by ``' ' + prefix``.
+    """
+    code = normalize_search_text(stock_code)
+    compact_code = code.replace(' ', '')
+    words = [code, compact_code if compact_code != code else '', normalize_search_text(stock_description)]
+    return (' ' + ' '.join(filter(None, words)))[:SEARCH_KEY_LENGTH]
+
+
 class StockTransaction(models.Model):
     stock_code = models.CharField(max_length=20, unique=True)
     stock_description = models.CharField(max_length=100)
     uom = models.CharField(max_length=10)  # Unit of Measure
-    
+    # Set on save(); bulk writers must fill it in with stock_search_key()
+    search_key = models.CharField(max_length=SEARCH_KEY_LENGTH, default='', editable=False)
+    # Maintained by prices.py as purchases and sales are posted
+    last_cost = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, editable=False)
+    last_purchase_date = models.DateField(null=True, blank=True, editable=False)
+    last_sale_date = models.DateField(null=True, blank=True, editable=False)
+
+    MAINTAINED_FIELDS = ('last_cost', 'last_purchase_date', 'last_sale_date')
+
     def __str__(self):
         return f"{self.stock_code} - {self.stock_description}"
 
+    def save(self, *args, **kwargs):
+        self.search_key = stock_search_key(self.stock_code, self.stock_description)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'search_key'}
+        elif not self._state.adding:
+            # Never write back maintained columns read before a posting changed them
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.MAINTAINED_FIELDS
+            ]
+        super().save(*args, **kwargs)
 
-class Purchase(models.Model):
+
+class DocumentHeader(models.Model):
+    """
+    Header of a multi-line document.  Totals are stored so invoices and
+    receipts do not re-sum their lines on every view.
+    """
+    document_number = models.CharField(max_length=50, unique=True)
     transaction_date = models.DateField()
+    total_quantity = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_value = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+
+    class Meta:
+        abstract = True
+
+    def recalculate_totals(self):
+        totals = self.lines.aggregate(
+            line_quantity=models.Sum('quantity'),
+            line_value=models.Sum(models.F('quantity') * models.F('price_per_unit')),
+        )
+        self.total_quantity = totals['line_quantity'] or 0
+        self.total_value = totals['line_value'] or 0
+        self.save(update_fields=['total_quantity', 'total_value'])
+
+
+class PurchaseDocument(DocumentHeader):
+    """Supplier invoice; its lines are Purchase rows."""
     supplier_name = models.CharField(max_length=100)
-    document_number = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return f"Purchase Invoice {self.document_number}"
+
+
+class SaleDocument(DocumentHeader):
+    """Sale receipt; its lines are Sale rows."""
+    customer_name = models.CharField(max_length=100)
+
+    def __str__(self):
+        return f"Sale Receipt {self.document_number}"
+
+
+class Purchase(AtomicWriteModel):
+    document = models.ForeignKey(PurchaseDocument, on_delete=models.CASCADE, related_name='lines', null=True, blank=True)
+    transaction_date = models.DateField()
+    supplier_name = models.CharField(max_length=100)
+    document_number = models.CharField(max_length=50, db_index=True)
     stock_code = models.ForeignKey(StockTransaction, on_delete=models.CASCADE)
     quantity = models.DecimalField(max_digits=10, decimal_places=2)
     price_per_unit = models.DecimalField(max_digits=10, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            # Per-SKU history up to a date, newest first; covering on PostgreSQL
+            models.Index(fields=['stock_code', 'transaction_date'], include=['quantity', 'price_per_unit'],
+                         name='purchase_stock_date_idx'),
+            # Period totals and trends over all SKUs
+            models.Index(fields=['transaction_date'], name='purchase_date_idx'),
+        ]
+
     def __str__(self):
         return f"Purchase - {self.stock_code.stock_code} ({self.document_number})"
 
 
-class Sale(models.Model):
+class Sale(AtomicWriteModel):
+    document = models.ForeignKey(SaleDocument, on_delete=models.CASCADE, related_name='lines', null=True, blank=True)
     transaction_date = models.DateField()
     customer_name = models.CharField(max_length=100)
-    document_number = models.CharField(max_length=50, unique=True)
+    document_number = models.CharField(max_length=50, db_index=True)
     stock_code = models.ForeignKey(StockTransaction, on_delete=models.CASCADE)
     quantity = models.DecimalField(max_digits=10, decimal_places=2)
     price_per_unit = models.DecimalField(max_digits=10, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            # Per-SKU history up to a date, newest first; covering on PostgreSQL
+            models.Index(fields=['stock_code', 'transaction_date'], include=['quantity', 'price_per_unit'],
+                         name='sale_stock_date_idx'),
+            # Period totals and trends over all SKUs
+            models.Index(fields=['transaction_date'], name='sale_date_idx'),
+        ]
+
     def __str__(self):
         return f"Sale - {self.stock_code.stock_code} ({self.document_number})"
 
 
-class StockCountSession(models.Model):
-    date = models.DateField()
+class StockCountSession(AtomicWriteModel):
+    date = models.DateField(db_index=True)
 
     def __str__(self):
         return f"Stock Count Session on {self.date}"
 
 
-class StockCountEntry(models.Model):
+class StockCountEntry(AtomicWriteModel):
     session = models.ForeignKey(StockCountSession, on_delete=models.CASCADE, related_name='entries')
     stock_code = models.ForeignKey(StockTransaction, on_delete=models.CASCADE)
     quantity_counted = models.DecimalField(max_digits=10, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['stock_code', 'session'], include=['quantity_counted'], name='count_entry_stock_session_idx'),
+        ]
+
     def __str__(self):
         return f"{self.stock_code.stock_code} - Counted: {self.quantity_counted}"
 
 
+class StockCountChunk(models.Model):
+    """
+    One chunk of scanner lines posted to a count session, recorded so that a
+    resent chunk is recognised and not counted twice (see count_batches.py).
+    """
+    session = models.ForeignKey(StockCountSession, on_delete=models.CASCADE, related_name='chunks')
+    chunk_id = models.CharField(max_length=100)
+    lines_received = models.PositiveIntegerField()
+    lines_rejected = models.PositiveIntegerField(default=0)
+    received_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'chunk_id'], name='unique_count_chunk_per_session'),
+        ]
+
+    def __str__(self):
+        return f"Chunk {self.chunk_id} of session #{self.session_id}"
+
+
+class StockCountAdjustment(models.Model):
+    """
+    Variance found by one count entry, stored so reports do not re-derive it.
+    ``system_quantity`` is what should have been on hand at the count: the
+    previous count of the SKU plus purchases less sales after it up to and
+    including the count date.  The variance is valued at the latest purchase
+    price on the count date.  Maintained by adjustments.refresh_adjustments().
+    """
+    entry = models.OneToOneField(StockCountEntry, on_delete=models.CASCADE, related_name='adjustment')
+    stock_code = models.ForeignKey(StockTransaction, on_delete=models.CASCADE, related_name='count_adjustments')
+    date = models.DateField()
+    system_quantity = models.DecimalField(max_digits=14, decimal_places=2)
+    variance_quantity = models.DecimalField(max_digits=14, decimal_places=2)
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    variance_value = models.DecimalField(max_digits=16, decimal_places=2)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date'], include=['variance_quantity', 'variance_value'],
+                         name='count_adjustment_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.stock_code.stock_code} on {self.date} - Variance: {self.variance_quantity}"
+
+
+class StockDailyBalance(models.Model):
+    """
+    Materialized end-of-day stock position per SKU, one row per day with
+    movements or a count.  ``closing_quantity`` is the counted quantity on
+    count days, otherwise the previous closing plus ins minus outs, so "on hand
+    as of X" is the closing of the latest row dated on or before X.
+    Maintained by balances.refresh_balance().
+    """
+    stock_code = models.ForeignKey(StockTransaction, on_delete=models.CASCADE, related_name='daily_balances')
+    date = models.DateField()
+    quantity_in = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    quantity_out = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    quantity_counted = models.DecimalField(max_digits=14, decimal_places=2, null=True, blank=True)
+    closing_quantity = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['stock_code', 'date'], name='unique_daily_balance_per_stock'),
+        ]
+
+    def __str__(self):
+        return f"{self.stock_code.stock_code} on {self.date} - Closing: {self.closing_quantity}"
+
+
+class StockPrice(models.Model):
+    """
+    Purchase price history: the price of the last purchase line of a SKU on
+    each day it was bought, so the price as of X is the latest row dated on
+    or before X.  Maintained by prices.refresh_prices().
+    """
+    stock_code = models.ForeignKey(StockTransaction, on_delete=models.CASCADE, related_name='prices')
+    date = models.DateField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['stock_code', 'date'], name='unique_stock_price_per_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.stock_code.stock_code} on {self.date} - Price: {self.price}"
+
+
+class StockCostBalance(models.Model):
+    """
+    Cost position of a SKU at the end of each day with a StockDailyBalance
+    row, under one costing method (see costing.py).  ``quantity`` equals the
+    daily balance's closing quantity; ``value`` is its cost and ``unit_cost``
+    the cost a count surplus is taken in at.  ``received_total`` and
+    ``issued_total`` are cumulative quantities in and out, including count
+    adjustments, which place the day within the SKU's cost layers.  The cost
+    of stock as of X is the value of the latest row dated on or before X.
+    """
+    stock_code = models.ForeignKey(StockTransaction, on_delete=models.CASCADE, related_name='cost_balances')
+    method = models.CharField(max_length=20)
+    date = models.DateField()
+    quantity = models.DecimalField(max_digits=14, decimal_places=2)
+    unit_cost = models.DecimalField(max_digits=14, decimal_places=4)
+    value = models.DecimalField(max_digits=18, decimal_places=4)
+    received_total = models.DecimalField(max_digits=16, decimal_places=2)
+    issued_total = models.DecimalField(max_digits=16, decimal_places=2)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['stock_code', 'method', 'date'], name='unique_cost_balance_per_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.stock_code.stock_code} on {self.date} ({self.method}) - Value: {self.value}"
+
+
+class CostLayer(models.Model):
+    """
+    Stock received at one unit cost: the purchases of a SKU on one day at one
+    price, or a count surplus.  ``cumulative_quantity`` is the SKU's
+    received_total once the layer is in, so the layer still holds stock while
+    issued_total is below it.  Layers are never updated, only replaced from
+    the first changed day on.
+    """
+    stock_code = models.ForeignKey(StockTransaction, on_delete=models.CASCADE, related_name='cost_layers')
+    method = models.CharField(max_length=20)
+    date = models.DateField()
+    quantity = models.DecimalField(max_digits=14, decimal_places=2)
+    unit_cost = models.DecimalField(max_digits=14, decimal_places=4)
+    cumulative_quantity = models.DecimalField(max_digits=16, decimal_places=2)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['stock_code', 'method', 'date'], name='cost_layer_stock_date_idx'),
+            # Open layers: those past the SKU's issued total
+            models.Index(fields=['stock_code', 'method', 'cumulative_quantity'], name='cost_layer_position_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.stock_code.stock_code} on {self.date} - {self.quantity} @ {self.unit_cost}"
+
+
+class DocumentSequence(models.Model):
+    """
+    Counter handing out document numbers per document type (see
+    sequences.reserve_numbers()).  ``number_format`` is a str.format()
+    template receiving ``prefix`` and ``number``.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    prefix = models.CharField(max_length=20, blank=True)
+    number_format = models.CharField(max_length=100, default='{prefix}{number:06d}')
+    next_number = models.PositiveBigIntegerField(default=1)
+
+    def format_number(self, number):
+        return self.number_format.format(prefix=self.prefix, number=number)
+
+    def __str__(self):
+        return f"{self.name} - next {self.format_number(self.next_number)}"
+
+
 class AuditLog(models.Model):
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the write happens; rows are inserted later, in batches (see audit.py)
+    timestamp = models.DateTimeField(default=timezone.now)
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
     action = models.CharField(max_length=100)
     model_name = models.CharField(max_length=100)
@@ -60,5 +351,16 @@ class AuditLog(models.Model):
     description = models.TextField()
     session = models.ForeignKey(StockCountSession, on_delete=models.SET_NULL, null=True, blank=True)
 
+    class Meta:
+        # The audit browser pages newest first on (timestamp, id), optionally
+        # narrowed by one equality filter; each has an index in that order.
+        indexes = [
+            models.Index(fields=['timestamp', 'id'], name='audit_time_idx'),
+            models.Index(fields=['user', 'timestamp', 'id'], name='audit_user_time_idx'),
+            models.Index(fields=['action', 'timestamp', 'id'], name='audit_action_time_idx'),
+            models.Index(fields=['model_name', 'timestamp', 'id'], name='audit_model_time_idx'),
+            models.Index(fields=['object_id', 'timestamp', 'id'], name='audit_object_time_idx'),
+        ]
+
     def __str__(self):
         return f"{self.timestamp} - {self.action} on {self.model_name} #{self.object_id}"
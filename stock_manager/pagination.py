@@ -0,0 +1,137 @@
+"""
+Keyset ("seek") pagination.
+
+Pages are fetched with ``WHERE (sort keys) > (values of the last row seen)``
+instead of OFFSET, so page 2,000 costs the same as page 1 and rows inserted
+meanwhile do not shift the page boundaries.  The cursor is the sort-key values
+of the row at the page edge, packed into an opaque URL-safe token.
+
+The ordering must end with a unique field so every row has a distinct
+position.  Keys may be NULL only where all rows sharing the preceding keys are
+NULL too (e.g. a value behind an "is missing" flag key).
+"""
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.db.models import F, Q
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _json_value(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def encode_cursor(direction, values):
+    payload = json.dumps([direction, [_json_value(value) for value in values]], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns ``(direction, values)``; the values are strings, numbers or None."""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(payload)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    if direction not in (NEXT, PREVIOUS) or not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return direction, values
+
+
+def _parse_ordering(ordering):
+    return [(key.lstrip('-'), key.startswith('-')) for key in ordering]
+
+
+def _seek_filter(keys, values):
+    """Rows strictly after ``values`` in the order given by ``keys``."""
+    condition = Q(pk__in=[])
+    equal = Q()
+    for (name, descending), value in zip(keys, values):
+        if value is not None:
+            lookup = 'lt' if descending else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        else:
+            equal &= Q(**{f'{name}__isnull': True})
+    return condition
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    ``ordering`` is a list of field or annotation names as for ``order_by()``
+    (``'-name'`` for descending) whose values are readable as attributes of
+    the fetched objects.
+    """
+    def __init__(self, queryset, ordering, page_size):
+        self.queryset = queryset
+        self.keys = _parse_ordering(ordering)
+        self.page_size = page_size
+
+    def _values(self, obj):
+        return [getattr(obj, name) for name, _ in self.keys]
+
+    def page(self, cursor=None):
+        """The page following (or preceding) ``cursor``, the first page if None."""
+        direction, values = decode_cursor(cursor) if cursor else (NEXT, None)
+        if values is not None and len(values) != len(self.keys):
+            raise InvalidCursor(cursor)
+
+        keys = self.keys
+        if direction == PREVIOUS:
+            keys = [(name, not descending) for name, descending in keys]
+
+        queryset = self.queryset.order_by(*[
+            F(name).desc() if descending else F(name).asc() for name, descending in keys
+        ])
+        if values is not None:
+            queryset = queryset.filter(_seek_filter(keys, values))
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+
+        if direction == PREVIOUS:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+
+        return KeysetPage(
+            rows,
+            next_cursor=encode_cursor(NEXT, self._values(rows[-1])) if rows and has_next else None,
+            previous_cursor=encode_cursor(PREVIOUS, self._values(rows[0])) if rows and has_previous else None,
+        )
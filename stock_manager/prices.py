@@ -0,0 +1,156 @@
+"""
+Maintenance of the StockPrice history and of the last-cost and last-movement
+columns on StockTransaction.
+
+Reports value stock at the latest purchase price as of a date and show each
+SKU's last movement.  Rather than search the purchase and sale tables for
+every SKU, the price of the last purchase line of each (SKU, day) is kept in
+StockPrice, and each SKU carries the price and date of its latest purchase
+(``last_cost``, ``last_purchase_date``) and the date of its latest sale
+(``last_sale_date``).  A price as of a date on or after ``last_purchase_date``
+is ``last_cost``; an earlier one is the latest StockPrice row dated on or
+before it, one index probe.
+
+Posting (services.py) and the signal receivers refresh the (SKU, day) pairs
+that changed, in the same transaction as the write.  rebuild_prices()
+recomputes everything and is what the rebuild_stock_prices command runs.
+"""
+from collections import defaultdict
+from itertools import groupby
+
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery, Window
+from django.db.models.functions import RowNumber
+
+from .models import Purchase, Sale, StockPrice, StockTransaction
+
+# SKUs per round of queries when refreshing prices
+PRICE_BATCH_SIZE = 500
+
+
+def _latest_price(price_model):
+    """The outer SKU's price history, latest first."""
+    return price_model.objects.filter(stock_code=OuterRef('pk')).order_by('-date')
+
+
+def _last_sale(sale_model):
+    return Subquery(
+        sale_model.objects.filter(stock_code=OuterRef('pk'))
+        .order_by('-transaction_date').values('transaction_date')[:1]
+    )
+
+
+def refresh_prices(keys):
+    """
+    Recompute the StockPrice rows and last-cost columns for purchases at
+    ``keys``, ``(stock_id, day)`` pairs: the price of each day becomes that of
+    its last purchase line, and days left without purchases lose their row.
+    """
+    days = defaultdict(set)
+    for stock_id, day in keys:
+        days[stock_id].add(day)
+    stock_ids = sorted(days)
+
+    with transaction.atomic():
+        for i in range(0, len(stock_ids), PRICE_BATCH_SIZE):
+            batch = stock_ids[i:i + PRICE_BATCH_SIZE]
+            _refresh({stock_id: days[stock_id] for stock_id in batch})
+
+
+def _refresh(days):
+    by_day = defaultdict(list)
+    for stock_id, stock_days in days.items():
+        for day in stock_days:
+            by_day[day].append(stock_id)
+    on_days = Q(pk__in=[])
+    for day, stock_ids in by_day.items():
+        on_days |= Q(stock_code__in=stock_ids, transaction_date=day)
+
+    last_lines = Purchase.objects.filter(on_days).annotate(
+        rank=Window(
+            RowNumber(),
+            partition_by=[F('stock_code'), F('transaction_date')],
+            order_by=[F('id').desc()],
+        ),
+    ).filter(rank=1)
+    prices = [
+        StockPrice(stock_code_id=stock_id, date=day, price=price)
+        for stock_id, day, price in last_lines.values_list('stock_code', 'transaction_date', 'price_per_unit')
+    ]
+
+    priced = {(price.stock_code_id, price.date) for price in prices}
+    gone = Q(pk__in=[])
+    for day, stock_ids in by_day.items():
+        emptied = [stock_id for stock_id in stock_ids if (stock_id, day) not in priced]
+        if emptied:
+            gone |= Q(stock_code__in=emptied, date=day)
+    StockPrice.objects.filter(gone).delete()
+    StockPrice.objects.bulk_create(
+        prices, update_conflicts=True, unique_fields=['stock_code', 'date'], update_fields=['price'],
+    )
+
+    latest = _latest_price(StockPrice)
+    StockTransaction.objects.filter(pk__in=list(days)).update(
+        last_cost=Subquery(latest.values('price')[:1]),
+        last_purchase_date=Subquery(latest.values('date')[:1]),
+    )
+
+
+def refresh_last_sale_dates(stock_ids):
+    """Recompute ``last_sale_date`` of ``stock_ids``."""
+    stock_ids = sorted(set(stock_ids))
+    with transaction.atomic():
+        for i in range(0, len(stock_ids), PRICE_BATCH_SIZE):
+            StockTransaction.objects.filter(pk__in=stock_ids[i:i + PRICE_BATCH_SIZE]).update(
+                last_sale_date=_last_sale(Sale)
+            )
+
+
+def refresh_movement_columns(model, keys):
+    """
+    Refresh what a write of ``model`` (Purchase or Sale) rows at ``keys``,
+    ``(stock_id, day)`` pairs, can change.
+    """
+    if model is Purchase:
+        refresh_prices(keys)
+    else:
+        refresh_last_sale_dates(stock_id for stock_id, _ in keys)
+
+
+def rebuild_prices(batch_size=2000):
+    """
+    Rebuild StockPrice from Purchase and reset the last-cost and last-movement
+    columns of every SKU.
+
+    Streams purchases ordered by (stock, day, id), so memory stays flat
+    regardless of history length; the columns are then set with one UPDATE.
+    Returns the number of price rows written.
+    """
+    lines = Purchase.objects.values_list(
+        'stock_code', 'transaction_date', 'price_per_unit'
+    ).order_by('stock_code', 'transaction_date', 'id').iterator(chunk_size=batch_size)
+
+    written = 0
+    with transaction.atomic():
+        StockPrice.objects.all().delete()
+
+        batch = []
+        for (stock_id, day), day_lines in groupby(lines, key=lambda line: (line[0], line[1])):
+            *_, (_, _, price) = day_lines
+            batch.append(StockPrice(stock_code_id=stock_id, date=day, price=price))
+            if len(batch) >= batch_size:
+                StockPrice.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            StockPrice.objects.bulk_create(batch)
+            written += len(batch)
+
+        latest = _latest_price(StockPrice)
+        StockTransaction.objects.update(
+            last_cost=Subquery(latest.values('price')[:1]),
+            last_purchase_date=Subquery(latest.values('date')[:1]),
+            last_sale_date=_last_sale(Sale),
+        )
+
+    return written
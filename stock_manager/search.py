@@ -0,0 +1,92 @@
+"""
+Stock search shared by the typeahead endpoint and the report filters.
+
+A term is normalized the same way as StockTransaction.search_key (see
+models.stock_search_key) and matches a SKU when every one of its words
+occurs in the key, so 'hinge 18' finds "Bracket Hinge 183".  On PostgreSQL
+the key has a pg_trgm GIN index (migration 0012) and these LIKE '%word%'
+filters are index scans instead of a sequential UPPER() LIKE over the code
+and description.  Without the index -- SQLite, or a server where the
+extension could not be installed -- the typeahead is answered from the
+process-local stock master (stock_cache.py) and report filters scan the
+column.
+
+Typeahead matches are ranked: the exact code, other codes starting with the
+term, SKUs where every word starts a word of the key, then the rest; each
+group in code order.
+"""
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from .models import StockTransaction, normalize_search_text
+from .stock_cache import FIELDS, SEARCH_LIMIT, stock_master
+
+TRIGRAM_INDEX = 'stock_search_key_trgm'
+
+_trigram_index = {}
+
+
+def search_words(term):
+    return normalize_search_text(term).split()
+
+
+def search_filter(term, prefix=''):
+    """
+    Q matching StockTransaction rows for ``term``; ``prefix`` reaches them
+    through a relation, e.g. ``'stock_code__'`` from a count entry.  A term
+    with no letters or digits matches nothing.
+    """
+    words = search_words(term)
+    if not words:
+        return Q(pk__in=[])
+    condition = Q()
+    for word in words:
+        condition &= Q(**{f'{prefix}search_key__contains': word})
+    return condition
+
+
+def trigram_index_available(using='default'):
+    """True if the search_key trigram index exists on the ``using`` database."""
+    if using not in _trigram_index:
+        connection = connections[using]
+        available = False
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", [TRIGRAM_INDEX])
+                available = cursor.fetchone() is not None
+        _trigram_index[using] = available
+    return _trigram_index[using]
+
+
+def _database_search(term, limit):
+    term = term.strip()
+    word_starts = Q()
+    for word in search_words(term):
+        word_starts &= Q(search_key__contains=' ' + word)
+    rank = Case(
+        When(stock_code__iexact=term, then=Value(0)),
+        When(stock_code__istartswith=term, then=Value(1)),
+        When(word_starts, then=Value(2)),
+        default=Value(3),
+        output_field=IntegerField(),
+    )
+    return list(
+        StockTransaction.objects.filter(search_filter(term))
+        .annotate(rank=rank)
+        .order_by('rank', 'stock_code')
+        .values_list(*FIELDS)[:limit]
+    )
+
+
+def search_stock(term, limit=SEARCH_LIMIT):
+    """Up to ``limit`` ranked matches for ``term`` as JSON-ready dicts."""
+    if not search_words(term):
+        return []
+    if trigram_index_available():
+        rows = _database_search(term, limit)
+    else:
+        rows = stock_master().search(term, limit)
+    return [
+        {'id': pk, 'code': code, 'description': description, 'uom': uom}
+        for pk, code, description, uom, _ in rows
+    ]
@@ -0,0 +1,230 @@
+"""
+Posting of purchase and sale documents and of stock count sessions.
+
+Web forms and programmatic callers (imports, scripts) both post through here.
+All lines are validated before anything is written; the header is then
+created with its totals, the lines are inserted with one bulk_create() and the
+dependent aggregates (daily balances, price history and last-movement
+columns, cost positions, dashboard snapshots) are updated in the same transaction, so a document is either fully posted or not at all.  Each
+line is audited once the transaction commits.  Count sessions are posted the
+same way, with the count adjustments (see adjustments.py) of the counted SKUs
+worked out together.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+
+from .adjustments import refresh_adjustments
+from .audit import record_created
+from .balances import apply_movement_batch
+from .costing import refresh_costs
+from .dashboard_cache import invalidate_snapshots_from
+from .models import (
+    Purchase, PurchaseDocument, Sale, SaleDocument, StockCountEntry, StockCountSession, StockTransaction,
+)
+from .prices import refresh_movement_columns
+from .sequences import next_document_number
+
+ZERO = Decimal('0')
+
+
+def _resolve_stock(lines):
+    """Map each line's stock_code (instance, pk or code string) to a StockTransaction."""
+    wanted_codes = {line['stock_code'] for line in lines if isinstance(line['stock_code'], str)}
+    wanted_ids = {line['stock_code'] for line in lines if isinstance(line['stock_code'], int)}
+
+    by_code, by_id = {}, {}
+    if wanted_codes or wanted_ids:
+        for stock in StockTransaction.objects.filter(Q(stock_code__in=wanted_codes) | Q(pk__in=wanted_ids)):
+            by_code[stock.stock_code] = stock
+            by_id[stock.pk] = stock
+
+    def resolve(value):
+        if isinstance(value, StockTransaction):
+            return value
+        if isinstance(value, str):
+            return by_code.get(value)
+        return by_id.get(value)
+
+    return [resolve(line['stock_code']) for line in lines]
+
+
+def _build_lines(model, header_model, header, lines):
+    """Validate every line up front and return unsaved model instances."""
+    lines = list(lines)
+    if not lines:
+        raise ValidationError("A document needs at least one line.")
+
+    if header_model.objects.filter(document_number=header['document_number']).exists():
+        raise ValidationError("This document number already exists.")
+
+    errors = []
+    objects = []
+    for number, (line, stock) in enumerate(zip(lines, _resolve_stock(lines)), start=1):
+        if stock is None:
+            errors.append(f"Line {number}: unknown stock code {line['stock_code']!r}.")
+            continue
+
+        obj = model(stock_code=stock, quantity=line['quantity'], price_per_unit=line['price_per_unit'], **header)
+        try:
+            obj.clean_fields(exclude=['stock_code', 'document_number'])
+        except ValidationError as e:
+            errors.extend(f"Line {number}: {field} - {' '.join(messages)}" for field, messages in e.message_dict.items())
+            continue
+        if obj.quantity <= 0:
+            errors.append(f"Line {number}: quantity must be greater than zero.")
+            continue
+        objects.append(obj)
+
+    if errors:
+        raise ValidationError(errors)
+    return objects
+
+
+def _post_many(model, header_model, documents, direction, batch_size=2000):
+    """
+    Write already validated ``documents``, a list of ``(header, lines)`` with
+    ``lines`` unsaved model instances, in one transaction and return the
+    created headers.
+    """
+    headers = []
+    movements = defaultdict(Decimal)
+    for header, objects in documents:
+        total_quantity = Decimal('0')
+        total_value = Decimal('0.00')
+        for obj in objects:
+            movements[obj.stock_code_id, header['transaction_date']] += obj.quantity
+            total_quantity += obj.quantity
+            total_value += obj.quantity * obj.price_per_unit
+        headers.append(header_model(total_quantity=total_quantity, total_value=total_value, **header))
+
+    if not headers:
+        return []
+
+    with transaction.atomic():
+        header_model.objects.bulk_create(headers, batch_size=batch_size)
+        if headers[0].pk is None:
+            # Backend cannot return ids from a bulk insert
+            ids = dict(
+                header_model.objects.filter(document_number__in=[document.document_number for document in headers])
+                .values_list('document_number', 'pk')
+            )
+            for document in headers:
+                document.pk = ids[document.document_number]
+
+        lines = []
+        for document, (_, objects) in zip(headers, documents):
+            for obj in objects:
+                obj.document = document
+                lines.append(obj)
+        model.objects.bulk_create(lines, batch_size=batch_size)
+        record_created(lines)
+
+        apply_movement_batch({
+            key: (quantity, ZERO) if direction == 'in' else (ZERO, quantity)
+            for key, quantity in movements.items()
+        })
+        # Adjustments are valued from the price history, so refresh it first
+        refresh_movement_columns(model, movements)
+        refresh_adjustments(movements)
+        refresh_costs(movements)
+        invalidate_snapshots_from(min(day for _, day in movements))
+    return headers
+
+
+def _post(model, header_model, header, lines, direction):
+    objects = _build_lines(model, header_model, header, lines)
+    return _post_many(model, header_model, [(header, objects)], direction)[0]
+
+
+def post_purchase_documents(documents):
+    """
+    Bulk counterpart of post_purchase_document() for importers: ``documents``
+    is a list of ``(header, lines)`` already checked by the caller, where
+    ``header`` holds transaction_date, supplier_name and document_number and
+    ``lines`` are unsaved Purchase instances.  Returns the created headers.
+    """
+    return _post_many(Purchase, PurchaseDocument, documents, 'in')
+
+
+def post_sale_documents(documents):
+    """Sale counterpart of post_purchase_documents()."""
+    return _post_many(Sale, SaleDocument, documents, 'out')
+
+
+def post_purchase_document(transaction_date, supplier_name, document_number, lines):
+    """
+    Post a purchase document.  ``lines`` is an iterable of dicts with
+    ``stock_code`` (StockTransaction, pk or code), ``quantity`` and
+    ``price_per_unit``.  A blank ``document_number`` is taken from the
+    'purchase' sequence.  Raises ValidationError without writing anything if
+    any line is invalid; returns the created PurchaseDocument.
+    """
+    header = {
+        'transaction_date': transaction_date,
+        'supplier_name': supplier_name,
+        'document_number': document_number or next_document_number('purchase'),
+    }
+    return _post(Purchase, PurchaseDocument, header, lines, 'in')
+
+
+def post_sale_document(transaction_date, customer_name, lines, document_number=None):
+    """
+    Post a sale document, numbering it from the 'sale' sequence unless
+    ``document_number`` is given.  Same line format and guarantees as
+    post_purchase_document(); returns the created SaleDocument.
+    """
+    header = {
+        'transaction_date': transaction_date,
+        'customer_name': customer_name,
+        'document_number': document_number or next_document_number('sale'),
+    }
+    return _post(Sale, SaleDocument, header, lines, 'out')
+
+
+def post_stock_count(count_date, entries, batch_size=2000):
+    """
+    Post a stock count session on ``count_date``.  ``entries`` is an iterable
+    of dicts with ``stock_code`` (StockTransaction, pk or code) and
+    ``quantity_counted``.  The entries are inserted with one bulk_create()
+    and their adjustments computed for all counted SKUs together.  Raises
+    ValidationError without writing anything if any entry is invalid;
+    returns the created StockCountSession.
+    """
+    entries = list(entries)
+    if not entries:
+        raise ValidationError("A stock count needs at least one entry.")
+
+    errors = []
+    objects = []
+    for number, (entry, stock) in enumerate(zip(entries, _resolve_stock(entries)), start=1):
+        if stock is None:
+            errors.append(f"Line {number}: unknown stock code {entry['stock_code']!r}.")
+            continue
+        obj = StockCountEntry(stock_code=stock, quantity_counted=entry['quantity_counted'])
+        try:
+            obj.clean_fields(exclude=['session', 'stock_code'])
+        except ValidationError as e:
+            errors.extend(f"Line {number}: {field} - {' '.join(messages)}" for field, messages in e.message_dict.items())
+            continue
+        objects.append(obj)
+    if errors:
+        raise ValidationError(errors)
+
+    with transaction.atomic():
+        session = StockCountSession.objects.create(date=count_date)
+        for obj in objects:
+            obj.session = session
+        StockCountEntry.objects.bulk_create(objects, batch_size=batch_size)
+        record_created(objects)
+
+        # Insertion order is id order, so the last entry for a SKU is the one that counts
+        counts = {(obj.stock_code_id, count_date): obj.quantity_counted for obj in objects}
+        apply_movement_batch({}, counts)
+        refresh_adjustments(counts)
+        refresh_costs(counts)
+        invalidate_snapshots_from(count_date)
+    return session
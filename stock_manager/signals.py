@@ -0,0 +1,177 @@
+"""
+Signal receivers keeping derived stock tables (daily balances, count
+adjustments, price history and last-movement columns, cost positions),
+document header totals, cached dashboard snapshots and the process-local stock
+master in step with their sources, and recording writes in the audit log.
+
+Purchase, Sale, StockCountSession and StockCountEntry save and delete inside a
+transaction (see models.AtomicWriteModel), so the work done here commits or
+rolls back together with the write that triggered it.  bulk_create() sends no
+signals: bulk writers must call balances.apply_movement_batch() (or
+refresh_balances()), prices.refresh_movement_columns(),
+adjustments.refresh_adjustments(), costing.refresh_costs(),
+dashboard_cache.invalidate_snapshots_from(),
+audit.record_created() and, for StockTransaction,
+stock_cache.bump_stock_version() themselves.
+"""
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import audit
+from .adjustments import refresh_adjustments
+from .balances import refresh_balance, refresh_balances
+from .costing import refresh_costs
+from .dashboard_cache import invalidate_snapshots_from
+from .prices import refresh_movement_columns
+from .stock_cache import bump_stock_version
+from .models import Purchase, Sale, StockCountEntry, StockCountSession, StockTransaction
+
+
+def _movement_key(instance):
+    return instance.stock_code_id, instance.transaction_date
+
+
+def _count_key(instance):
+    return instance.stock_code_id, instance.session.date
+
+
+def _remember_previous(sender, instance, key_func):
+    """Stash the (stock, day) and document a row belonged to before an update."""
+    instance._previous_balance_key = None
+    instance._previous_document_id = None
+    if instance.pk:
+        previous = sender.objects.filter(pk=instance.pk).first()
+        if previous:
+            instance._previous_balance_key = key_func(previous)
+            instance._previous_document_id = getattr(previous, 'document_id', None)
+
+
+def _origin_model(origin):
+    return origin.model if isinstance(origin, QuerySet) else type(origin)
+
+
+def _deleting_stock(origin):
+    """True when a delete cascades from the SKU itself (its balances go too)."""
+    return _origin_model(origin) is StockTransaction
+
+
+def _recalculate_documents(sender, document_ids):
+    header_model = sender._meta.get_field('document').related_model
+    for document in header_model.objects.filter(pk__in=[pk for pk in document_ids if pk]):
+        document.recalculate_totals()
+
+
+@receiver(pre_save, sender=Purchase)
+@receiver(pre_save, sender=Sale)
+def remember_movement_key(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _remember_previous(sender, instance, _movement_key)
+
+
+@receiver(pre_save, sender=StockCountEntry)
+def remember_count_key(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _remember_previous(sender, instance, _count_key)
+
+
+@receiver(post_save, sender=Purchase)
+@receiver(post_save, sender=Sale)
+@receiver(post_save, sender=StockCountEntry)
+def update_balance_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    key_func = _count_key if sender is StockCountEntry else _movement_key
+    keys = {key_func(instance)}
+    previous = getattr(instance, '_previous_balance_key', None)
+    if previous:
+        keys.add(previous)
+    refresh_balances(keys)
+    if sender is not StockCountEntry:
+        refresh_movement_columns(sender, keys)
+    refresh_adjustments(keys)
+    refresh_costs(keys)
+    invalidate_snapshots_from(min(day for _, day in keys))
+
+
+@receiver(post_delete, sender=Purchase)
+@receiver(post_delete, sender=Sale)
+def update_balance_on_movement_delete(sender, instance, origin=None, **kwargs):
+    stock_id, day = _movement_key(instance)
+    if not _deleting_stock(origin):
+        refresh_balance(stock_id, day)
+        refresh_movement_columns(sender, [(stock_id, day)])
+        refresh_adjustments([(stock_id, day)])
+        refresh_costs([(stock_id, day)])
+    invalidate_snapshots_from(day)
+
+
+@receiver(post_delete, sender=StockCountEntry)
+def update_balance_on_count_delete(sender, instance, origin=None, **kwargs):
+    session = StockCountSession.objects.filter(pk=instance.session_id).first()
+    if not session:
+        return
+    if not _deleting_stock(origin):
+        refresh_balance(instance.stock_code_id, session.date)
+        refresh_adjustments([(instance.stock_code_id, session.date)])
+        refresh_costs([(instance.stock_code_id, session.date)])
+    invalidate_snapshots_from(session.date)
+
+
+@receiver(pre_save, sender=StockCountSession)
+def remember_session_date(sender, instance, raw=False, **kwargs):
+    instance._previous_date = None
+    if instance.pk and not raw:
+        instance._previous_date = sender.objects.filter(pk=instance.pk).values_list('date', flat=True).first()
+
+
+@receiver(post_save, sender=StockCountSession)
+def update_balance_on_session_move(sender, instance, created, raw=False, **kwargs):
+    previous_date = getattr(instance, '_previous_date', None)
+    if raw or created or not previous_date or previous_date == instance.date:
+        return
+    stock_ids = instance.entries.values_list('stock_code', flat=True).distinct()
+    keys = [(stock_id, day) for stock_id in stock_ids for day in (previous_date, instance.date)]
+    refresh_balances(keys)
+    refresh_adjustments(keys)
+    refresh_costs(keys)
+    invalidate_snapshots_from(min(previous_date, instance.date))
+
+
+@receiver(post_save, sender=Purchase)
+@receiver(post_save, sender=Sale)
+def update_document_totals_on_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _recalculate_documents(sender, {instance.document_id, getattr(instance, '_previous_document_id', None)})
+
+
+@receiver(post_delete, sender=Purchase)
+@receiver(post_delete, sender=Sale)
+def update_document_totals_on_delete(sender, instance, origin=None, **kwargs):
+    if _origin_model(origin) is not sender._meta.get_field('document').related_model:
+        _recalculate_documents(sender, {instance.document_id})
+
+
+@receiver(post_save, sender=StockTransaction)
+@receiver(post_delete, sender=StockTransaction)
+def invalidate_stock_master(sender, instance, raw=False, **kwargs):
+    bump_stock_version()
+
+
+@receiver(post_save, sender=StockTransaction)
+@receiver(post_save, sender=Purchase)
+@receiver(post_save, sender=Sale)
+@receiver(post_save, sender=StockCountSession)
+@receiver(post_save, sender=StockCountEntry)
+def audit_save(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        audit.record(audit.CREATE if created else audit.UPDATE, instance)
+
+
+@receiver(post_delete, sender=StockTransaction)
+@receiver(post_delete, sender=Purchase)
+@receiver(post_delete, sender=Sale)
+@receiver(post_delete, sender=StockCountSession)
+@receiver(post_delete, sender=StockCountEntry)
+def audit_delete(sender, instance, **kwargs):
+    audit.record(audit.DELETE, instance)
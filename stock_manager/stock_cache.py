@@ -0,0 +1,169 @@
+"""
+Process-local copy of the stock master for line forms and the typeahead.
+
+Every purchase, sale and count line names a SKU, and the typeahead searches
+the whole catalogue on each keystroke, so the (id, code, description, uom,
+search key) rows are loaded into memory once per process and shared by every
+request it serves.  A version token in Django's cache changes whenever a
+StockTransaction is saved or deleted (see signals.py); a process compares its
+copy against the token at most every STOCK_CACHE_CHECK_SECONDS and reloads
+when it has moved on.  A code missing from the copy is looked up in the
+database before it is rejected, so a SKU created in another process is usable
+straight away.  bulk_create() sends no signals: bulk writers must call
+bump_stock_version() themselves.
+"""
+import threading
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router, transaction
+
+from .models import StockTransaction, normalize_search_text
+
+VERSION_KEY = 'stock_master:version'
+FIELDS = ('id', 'stock_code', 'stock_description', 'uom', 'search_key')
+SEARCH_LIMIT = 20
+
+_lock = threading.Lock()
+_state = {'master': None, 'version': None, 'checked_at': 0.0}
+
+
+def _cache():
+    return caches[getattr(settings, 'STOCK_CACHE_ALIAS', 'default')]
+
+
+def _check_seconds():
+    return getattr(settings, 'STOCK_CACHE_CHECK_SECONDS', 5)
+
+
+class StockMaster:
+    """Immutable snapshot of the stock master with lookups by id and code."""
+    def __init__(self, rows):
+        self.rows = sorted(rows, key=lambda row: row[1].upper())
+        self.by_pk = {row[0]: row for row in self.rows}
+        self.by_code = {row[1]: row for row in self.rows}
+        self.by_code_upper = {row[1].upper(): row for row in self.rows}
+        self._index = {row[0]: index for index, row in enumerate(self.rows)}
+        self._upper_codes = [row[1].upper() for row in self.rows]
+        # Search keys joined into one string so str.find() does the scanning
+        self._keys = [row[4] for row in self.rows]
+        self._offsets = []
+        offset = 0
+        for key in self._keys:
+            self._offsets.append(offset)
+            offset += len(key) + 1
+        self._blob = '\n'.join(self._keys)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def row_for_code(self, code):
+        return self.by_code.get(code) or self.by_code_upper.get(code.upper())
+
+    def search(self, term, limit=SEARCH_LIMIT):
+        """
+        Rows matching ``term``, ranked as search.search_stock() describes:
+        the exact code, other codes starting with it, rows where every word
+        of the term starts a word of the search key, then rows merely
+        containing every word; each group in code order.
+        """
+        words = normalize_search_text(term).split()
+        if not words:
+            return []
+        term = term.strip().upper()
+
+        taken = []
+        exact = self.by_code_upper.get(term)
+        if exact is not None:
+            taken.append(self._index[exact[0]])
+        start = bisect_left(self._upper_codes, term)
+        for index in range(start, len(self.rows)):
+            if len(taken) >= limit or not self._upper_codes[index].startswith(term):
+                break
+            if index not in taken:
+                taken.append(index)
+        for pattern in ([' ' + word for word in words], words):
+            if len(taken) >= limit:
+                break
+            taken.extend(self._matches(pattern, limit - len(taken), set(taken)))
+        return [self.rows[index] for index in taken[:limit]]
+
+    def _matches(self, words, limit, exclude):
+        """Indexes of up to ``limit`` rows whose key contains all ``words``, in code order."""
+        longest = max(words, key=len)
+        found = []
+        position = self._blob.find(longest)
+        while position != -1 and len(found) < limit:
+            index = bisect_right(self._offsets, position) - 1
+            key = self._keys[index]
+            if index not in exclude and all(word in key for word in words):
+                found.append(index)
+            position = self._blob.find(longest, self._offsets[index] + len(key) + 1)
+        return found
+
+
+def _instance(row):
+    return StockTransaction.from_db(router.db_for_read(StockTransaction), FIELDS, row)
+
+
+def _current_version():
+    cache = _cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def stock_master():
+    """The current StockMaster, reloaded if another write has changed the table."""
+    state = _state
+    if state['master'] is not None and time.monotonic() - state['checked_at'] < _check_seconds():
+        return state['master']
+
+    with _lock:
+        version = _current_version()
+        if state['master'] is None or state['version'] != version:
+            state['master'] = StockMaster(StockTransaction.objects.values_list(*FIELDS))
+            state['version'] = version
+        state['checked_at'] = time.monotonic()
+        return state['master']
+
+
+def _forget_local():
+    with _lock:
+        _state['master'] = None
+        _state['checked_at'] = 0.0
+
+
+def bump_stock_version():
+    """
+    Mark every process's copy stale.  This process drops its copy at once;
+    the shared token changes when the surrounding transaction commits, so
+    other processes do not reload before the change is visible to them.
+    """
+    _forget_local()
+    transaction.on_commit(lambda: _cache().set(VERSION_KEY, uuid.uuid4().hex, timeout=None))
+
+
+def get_stock(code):
+    """The StockTransaction with stock code ``code`` (any case), or None."""
+    row = stock_master().row_for_code(code)
+    if row is not None:
+        return _instance(row)
+
+    stock = (StockTransaction.objects.filter(stock_code=code).first()
+             or StockTransaction.objects.filter(stock_code__iexact=code).first())
+    if stock is not None:
+        # Created elsewhere since our copy was loaded
+        _state['checked_at'] = 0.0
+    return stock
+
+
+def stock_code_for(pk):
+    row = stock_master().by_pk.get(pk)
+    return row[1] if row else None
+
@@ -1,3 +1,1607 @@
-from django.test import TestCase
+import csv
+import io
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from importlib import import_module
+from unittest import mock
+from xml.etree import ElementTree
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection, reset_queries, transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import audit, stock_cache
+from .audit_archive import archive_audit_log, archive_months, read_archive
+from .balances import rebuild_daily_balances
+from .costing import cost_values, refresh_costs
+from .dashboard_cache import SNAPSHOT_KEY, get_snapshot
+from .forms import StockCodeField
+from .imports import import_csv
+from .ledger import build_stock_ledger, count_variance, latest_prices
+from .middleware import AuditUserMiddleware, SessionTimeoutMiddleware
+from .models import (
+    AuditLog, CostLayer, DocumentSequence, Purchase, PurchaseDocument, Sale, SaleDocument, StockCostBalance,
+    StockCountAdjustment, StockCountEntry, StockCountSession, StockDailyBalance, StockPrice, StockTransaction,
+)
+from .prices import rebuild_prices, refresh_prices
+from .search import _database_search, search_stock
+from .sequences import next_document_number, reserve_numbers
+from .services import post_purchase_document, post_purchase_documents, post_sale_document, post_stock_count
+from .stock_cache import SEARCH_LIMIT, stock_code_for, stock_master
+from .views import LEDGER_COLUMNS, LEDGER_EXPORT_COLUMNS, STOCK_LOOKUP_MAX_LIMIT, SUMMARY_EXPORT_COLUMNS
+
+
+class ReportQueryPlanTests(TestCase):
+    """
+    Runs EXPLAIN on the per-SKU and per-period lookups the reports are built
+    from and fails if any of them falls back to a full table scan, e.g.
+    because an index was dropped or a filter stopped matching one.
+    """
+    WATCHED_TABLES = {
+        model._meta.db_table
+        for model in (AuditLog, Purchase, Sale, StockCountEntry, StockCountSession, StockDailyBalance, StockPrice)
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.stocks = StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=f'SKU{i:04d}', stock_description=f'Item {i}', uom='ea')
+            for i in range(50)
+        )
+        document = PurchaseDocument.objects.create(
+            document_number='PLAN-1', transaction_date=date(2025, 1, 1), supplier_name='Supplier'
+        )
+        start = date(2024, 1, 1)
+        purchases, sales = [], []
+        for i in range(2000):
+            stock = cls.stocks[i % len(cls.stocks)]
+            day = start + timedelta(days=i % 500)
+            purchases.append(Purchase(
+                document=document, transaction_date=day, supplier_name='Supplier', document_number='PLAN-1',
+                stock_code=stock, quantity=Decimal('5'), price_per_unit=Decimal('2.50'),
+            ))
+            sales.append(Sale(
+                transaction_date=day, customer_name='Customer', document_number=f'SAL-{i}',
+                stock_code=stock, quantity=Decimal('2'), price_per_unit=Decimal('4.00'),
+            ))
+        Purchase.objects.bulk_create(purchases)
+        Sale.objects.bulk_create(sales)
+        rebuild_prices()
+
+        for n in range(12):
+            session = StockCountSession.objects.create(date=start + timedelta(days=30 * n))
+            StockCountEntry.objects.bulk_create(
+                StockCountEntry(session=session, stock_code=stock, quantity_counted=Decimal('10'))
+                for stock in cls.stocks
+            )
+        StockDailyBalance.objects.bulk_create(
+            StockDailyBalance(stock_code=stock, date=start + timedelta(days=d), closing_quantity=Decimal(d))
+            for stock in cls.stocks
+            for d in range(0, 500, 7)
+        )
+
+        cls.user = User.objects.create_user('auditor')
+        AuditLog.objects.bulk_create(
+            AuditLog(
+                timestamp=datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i),
+                user=cls.user if i % 3 == 0 else None,
+                action=('create', 'update', 'delete')[i % 3],
+                model_name=('purchase', 'sale', 'stockcountentry', 'stocktransaction')[i % 4],
+                object_id=i % 400,
+                description=f'Entry {i}',
+            )
+            for i in range(2000)
+        )
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Make the planner prefer any usable index, so a sequential
+                # scan here means there is no index to use
+                cursor.execute('SET enable_seqscan = off')
+                cursor.execute('ANALYZE')
+            elif connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+
+    def full_scans(self, queryset):
+        plan = queryset.explain()
+        if connection.vendor == 'postgresql':
+            scanned = re.findall(r'Seq Scan on (\w+)', plan)
+        elif connection.vendor == 'sqlite':
+            scanned = re.findall(r'\bSCAN (\w+)(?! USING)', plan)
+        else:
+            self.skipTest(f'No plan parser for {connection.vendor}')
+        return [table for table in scanned if table in self.WATCHED_TABLES], plan
+
+    def assertUsesIndexes(self, queryset):
+        scanned, plan = self.full_scans(queryset)
+        self.assertEqual(scanned, [], f'Full table scan in plan:\n{plan}')
+
+    def test_latest_purchase_price_for_stock(self):
+        self.assertUsesIndexes(
+            Purchase.objects.filter(stock_code=self.stocks[3], transaction_date__lte=date(2024, 6, 1))
+            .order_by('-transaction_date').values('price_per_unit')[:1]
+        )
+
+    def test_price_as_of_date_for_stock(self):
+        self.assertUsesIndexes(
+            StockPrice.objects.filter(stock_code=self.stocks[3], date__lte=date(2024, 6, 1))
+            .order_by('-date').values('price')[:1]
+        )
+
+    def test_movement_totals_for_stock_in_period(self):
+        for model in (Purchase, Sale):
+            with self.subTest(model=model.__name__):
+                self.assertUsesIndexes(
+                    model.objects.filter(
+                        stock_code=self.stocks[7],
+                        transaction_date__gt=date(2024, 3, 1),
+                        transaction_date__lte=date(2024, 4, 1),
+                    ).values('stock_code').annotate(total=Sum('quantity'))
+                )
+
+    def test_period_totals_over_all_stock(self):
+        for model in (Purchase, Sale):
+            with self.subTest(model=model.__name__):
+                self.assertUsesIndexes(
+                    model.objects.filter(
+                        transaction_date__gte=date(2024, 5, 1),
+                        transaction_date__lte=date(2024, 5, 31),
+                    ).values('transaction_date').annotate(total=Sum('quantity'))
+                )
+
+    def test_latest_prior_count_for_stock(self):
+        self.assertUsesIndexes(
+            StockCountEntry.objects.filter(stock_code=self.stocks[11], session__date__lt=date(2024, 9, 1))
+            .order_by('-session__date').values('quantity_counted')[:1]
+        )
+
+    def test_count_sessions_in_window(self):
+        self.assertUsesIndexes(
+            StockCountSession.objects.filter(date__gte=date(2024, 5, 1), date__lte=date(2024, 5, 31))
+        )
+
+    def test_on_hand_lookup(self):
+        self.assertUsesIndexes(
+            StockDailyBalance.objects.filter(stock_code=self.stocks[5], date__lte=date(2024, 8, 1))
+            .order_by('-date').values('closing_quantity')[:1]
+        )
+
+    def test_document_lines(self):
+        self.assertUsesIndexes(
+            Purchase.objects.filter(document__document_number='PLAN-1').select_related('stock_code')
+        )
+
+
+    def test_audit_log_pages(self):
+        newest_first = ('-timestamp', '-id')
+        since = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+        for name, filters in (
+            ('none', {}),
+            ('date range', {'timestamp__gte': since, 'timestamp__lt': since + timedelta(days=1)}),
+            ('user', {'user': self.user}),
+            ('action', {'action': 'update'}),
+            ('model', {'model_name': 'sale'}),
+            ('object', {'object_id': 17}),
+        ):
+            with self.subTest(filter=name):
+                self.assertUsesIndexes(AuditLog.objects.filter(**filters).order_by(*newest_first)[:101])
+
+
+class StockLedgerTests(TestCase):
+    """
+    Pins the ledger for February 2024 to the figures the original per-SKU
+    loop produced for the same history, valued at FIFO cost.
+    """
+    START, END = date(2024, 2, 1), date(2024, 2, 29)
+
+    def setUp(self):
+        self.user = User.objects.create_user('ledger')
+        self.client.force_login(self.user)
+        self.client.get(reverse('transaction_list'))
+        StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=code, stock_description=code, uom='ea')
+            for code in ('LED1', 'LED2', 'LED3', 'LED4')
+        )
+
+    def buy(self, day, code, quantity, price):
+        post_purchase_document(day, 'Supplier', '', [{'stock_code': code, 'quantity': quantity,
+                                                      'price_per_unit': price}])
+
+    def sell(self, day, code, quantity):
+        post_sale_document(day, 'Customer', [{'stock_code': code, 'quantity': quantity, 'price_per_unit': 9}])
+
+    def count(self, day, code, quantity):
+        post_stock_count(day, [{'stock_code': code, 'quantity_counted': quantity}])
+
+    def post_history(self):
+        # LED1: a count before the window, one inside it and a purchase after it
+        self.buy(date(2024, 1, 5), 'LED1', 10, 2)
+        self.sell(date(2024, 1, 8), 'LED1', 3)
+        self.count(date(2024, 1, 20), 'LED1', 6)
+        self.buy(date(2024, 1, 25), 'LED1', 4, 3)
+        self.buy(date(2024, 2, 5), 'LED1', 5, 4)
+        self.sell(date(2024, 2, 10), 'LED1', 6)
+        self.count(date(2024, 2, 15), 'LED1', 8)
+        self.buy(date(2024, 2, 20), 'LED1', 2, 5)
+        self.sell(date(2024, 2, 25), 'LED1', 1)
+        self.buy(date(2024, 3, 5), 'LED1', 5, 6)
+        # LED2: no prior count, two counts and a purchase on the same day
+        self.buy(date(2024, 1, 10), 'LED2', 20, 1)
+        self.sell(date(2024, 1, 15), 'LED2', 5)
+        self.buy(date(2024, 2, 12), 'LED2', 10, 2)
+        self.count(date(2024, 2, 12), 'LED2', 30)
+        self.count(date(2024, 2, 12), 'LED2', 24)
+        self.sell(date(2024, 2, 20), 'LED2', 4)
+        # LED3: only counted, before the window; LED4 never moved
+        self.count(date(2024, 1, 31), 'LED3', 5)
+
+    def ledger(self):
+        rows, total_valuation = build_stock_ledger(self.START, self.END)
+        return {row['stock_code']: row for row in rows}, total_valuation
+
+    def test_rows_match_per_sku_figures(self):
+        self.post_history()
+        rows, total_valuation = self.ledger()
+        columns = ('opening_quantity', 'purchase_quantity', 'sales_quantity', 'counted_quantity', 'variance',
+                   'quantity_on_hand', 'latest_price', 'valuation', 'transaction_date')
+        expected = {
+            # 6 counted + 4 bought; 9 expected at the count; layers 2@3, 5@4 and 2@5 left
+            'LED1': (10, 7, 7, 8, -1, 9, 5, 36, date(2024, 3, 5)),
+            # The later count of the 12th wins: 15 + 10 expected, 10@1 and 10@2 left
+            'LED2': (15, 10, 4, 24, -1, 20, 2, 30, date(2024, 2, 20)),
+            'LED3': (5, 0, 0, None, None, 5, 0, 0, None),
+            'LED4': (0, 0, 0, None, None, 0, 0, 0, None),
+        }
+        for code, figures in expected.items():
+            with self.subTest(stock_code=code):
+                self.assertEqual(tuple(rows[code][column] for column in columns), figures)
+        self.assertEqual(total_valuation, Decimal('66'))
+
+        response = self.client.get(reverse('transaction_list'), {'start_date': self.START, 'end_date': self.END})
+        self.assertEqual([row['stock_code'] for row in response.context['transactions']],
+                         ['LED1', 'LED2', 'LED3', 'LED4'])
+        self.assertEqual(response.context['transactions'][0], rows['LED1'])
+        self.assertEqual(response.context['total_valuation'], Decimal('66.00'))
+
+    def count_queries(self):
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            self.ledger()
+        ledger = len(queries)
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('transaction_list'), {'start_date': self.START, 'end_date': self.END})
+        return ledger, len(queries)
+
+    def test_query_count_does_not_grow_with_stock(self):
+        self.post_history()
+        few = self.count_queries()
+        stocks = StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=f'LEDX{i:02d}', stock_description='Item', uom='ea') for i in range(30)
+        )
+        post_purchase_document(date(2024, 2, 3), 'Supplier', 'LED-BULK',
+                               [{'stock_code': stock, 'quantity': 5, 'price_per_unit': 2} for stock in stocks])
+        post_stock_count(date(2024, 2, 14), [{'stock_code': stock, 'quantity_counted': 4} for stock in stocks])
+        self.assertEqual(self.count_queries(), few)
+
+
+class DailyBalanceTests(TestCase):
+    """
+    Edits the history in the ways balances.py maintains incrementally and
+    checks after each one that the table equals a fresh rebuild.
+    """
+    def setUp(self):
+        self.stocks = StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=code, stock_description=code, uom='ea') for code in ('BAL1', 'BAL2')
+        )
+        self.post(date(2024, 1, 10), 10)
+        post_sale_document(date(2024, 1, 20), 'Customer', self.lines(3))
+        post_stock_count(date(2024, 1, 25), [{'stock_code': stock, 'quantity_counted': 9} for stock in self.stocks])
+        self.post(date(2024, 2, 1), 5)
+        self.assertMatchesRebuild()
+
+    def lines(self, quantity):
+        return [{'stock_code': stock, 'quantity': quantity, 'price_per_unit': 2} for stock in self.stocks]
+
+    def post(self, day, quantity):
+        return post_purchase_document(day, 'Supplier', '', self.lines(quantity))
+
+    def balances(self):
+        return list(StockDailyBalance.objects.order_by('stock_code', 'date').values_list(
+            'stock_code', 'date', 'quantity_in', 'quantity_out', 'quantity_counted', 'closing_quantity'
+        ))
+
+    def closing(self, day, stock=None):
+        return StockDailyBalance.objects.get(stock_code=stock or self.stocks[0], date=day).closing_quantity
+
+    def assertMatchesRebuild(self):
+        maintained = self.balances()
+        rebuild_daily_balances()
+        self.assertEqual(maintained, self.balances())
+
+    def test_backdated_insert(self):
+        self.post(date(2024, 1, 5), 4)
+        Sale.objects.create(transaction_date=date(2024, 1, 15), customer_name='Customer', document_number='S',
+                            stock_code=self.stocks[0], quantity=2, price_per_unit=5)
+        # Shifted up to the count, which resets the baseline
+        self.assertEqual((self.closing(date(2024, 1, 20)), self.closing(date(2024, 1, 20), self.stocks[1])),
+                         (Decimal('9'), Decimal('11')))
+        self.assertEqual(self.closing(date(2024, 2, 1)), Decimal('14'))
+        self.assertMatchesRebuild()
+
+    def test_backdated_delete(self):
+        Sale.objects.filter(stock_code=self.stocks[0], transaction_date=date(2024, 1, 20)).delete()
+        self.assertFalse(StockDailyBalance.objects.filter(stock_code=self.stocks[0], date=date(2024, 1, 20)).exists())
+        self.assertEqual(self.closing(date(2024, 1, 25)), Decimal('9'))
+        self.assertMatchesRebuild()
+
+    def test_quantity_change_on_older_line(self):
+        line = Purchase.objects.get(stock_code=self.stocks[1], transaction_date=date(2024, 1, 10))
+        line.quantity = 12
+        line.save()
+        self.assertEqual(self.closing(date(2024, 1, 20), self.stocks[1]), Decimal('9'))
+        # Moving a line after the count shifts the rows from there on only
+        line.transaction_date = date(2024, 1, 28)
+        line.save()
+        self.assertEqual(self.closing(date(2024, 2, 1), self.stocks[1]), Decimal('26'))
+        self.assertMatchesRebuild()
+
+    def test_day_deleted_then_recreated(self):
+        Sale.objects.filter(transaction_date=date(2024, 1, 20)).delete()
+        self.assertFalse(StockDailyBalance.objects.filter(date=date(2024, 1, 20)).exists())
+        post_sale_document(date(2024, 1, 20), 'Customer', self.lines(1))
+        Sale.objects.create(transaction_date=date(2024, 1, 20), customer_name='Customer', document_number='S',
+                            stock_code=self.stocks[0], quantity=2, price_per_unit=5)
+        self.assertEqual((self.closing(date(2024, 1, 20)), self.closing(date(2024, 1, 20), self.stocks[1])),
+                         (Decimal('7'), Decimal('9')))
+        self.assertMatchesRebuild()
+
+
+@override_settings(AUDIT_ASYNC=False)
+class DashboardTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('manager')
+        self.client.force_login(self.user)
+        self.client.get(reverse('dashboard'))
+        self.this_month = date.today().replace(day=1)
+        self.last_month = self.this_month - timedelta(days=1)
+        caches['default'].clear()
+
+    def add_stock(self, count, start):
+        stocks = StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=f'DSH{start + i:04d}', stock_description=f'Item {start + i}', uom='ea')
+            for i in range(count)
+        )
+        post_purchase_document(self.last_month, 'Supplier', f'DSH-P{start}',
+                               [{'stock_code': stock, 'quantity': 10, 'price_per_unit': 2} for stock in stocks])
+        post_sale_document(self.this_month, 'Customer',
+                           [{'stock_code': stock, 'quantity': 3, 'price_per_unit': 5} for stock in stocks])
+        post_stock_count(self.this_month, [{'stock_code': stock, 'quantity_counted': 6} for stock in stocks])
+
+    def render(self):
+        caches['default'].clear()
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('dashboard'))
+        return len(queries), response
+
+    def test_query_count_does_not_grow_with_stock_and_counts(self):
+        self.add_stock(5, 0)
+        few, response = self.render()
+        self.assertEqual((response.context['opening_stock'], response.context['variance_qty']),
+                         (Decimal('50'), Decimal('-5')))
+        self.add_stock(10, 5)
+        caches['default'].clear()
+        with self.assertNumQueries(few):
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual((response.context['opening_stock'], response.context['variance_qty'],
+                          response.context['closing_balance']), (Decimal('150'), Decimal('-15'), Decimal('90')))
+        # Last month's purchases fall outside the month's range, this month's sales inside it
+        self.assertEqual((response.context['purchases'], response.context['sales']), (0, Decimal('45')))
+
+
+    def cached_months(self, months):
+        cache = caches['default']
+        return [cache.get(SNAPSHOT_KEY.format(month)) is not None for month in months]
+
+    def test_second_hit_is_served_from_cache(self):
+        self.add_stock(2, 0)
+        self.client.get(reverse('dashboard'))
+        # Only the session and user lookups
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('dashboard'))
+        self.assertEqual(response.context['closing_balance'], Decimal('12'))
+
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.client.force_login(staff)
+        stats = self.client.get(reverse('dashboard_cache_stats')).json()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_ratio']), (1, 1, 0.5))
+
+    def test_write_drops_its_month_and_later_ones(self):
+        stock = StockTransaction.objects.create(stock_code='DSH1', stock_description='Item', uom='ea')
+        earlier = (self.last_month.replace(day=1) - timedelta(days=1)).replace(day=1)
+        months = [earlier, self.last_month.replace(day=1), self.this_month]
+        for month in months:
+            get_snapshot(month, dict)
+        self.assertEqual(self.cached_months(months), [True, True, True])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post_purchase_document(self.last_month, 'Supplier', 'DSH-P',
+                                   [{'stock_code': stock, 'quantity': 1, 'price_per_unit': 2}])
+        self.assertEqual(self.cached_months(months), [True, False, False])
+
+    def test_admin_edit_invalidates(self):
+        stock = StockTransaction.objects.create(stock_code='DSH1', stock_description='Item', uom='ea')
+        document = post_purchase_document(self.last_month, 'Supplier', 'DSH-P',
+                                          [{'stock_code': stock, 'quantity': 1, 'price_per_unit': 2}])
+        line = document.lines.get()
+        get_snapshot(self.this_month, dict)
+
+        admin = User.objects.create_superuser('admin')
+        self.client.force_login(admin)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('admin:stock_manager_purchase_change', args=[line.pk]), {
+                'document': document.pk, 'transaction_date': self.last_month, 'supplier_name': 'Supplier',
+                'document_number': 'DSH-P', 'stock_code': stock.pk, 'quantity': 4, 'price_per_unit': 2,
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.cached_months([self.this_month]), [False])
+
+
+class LedgerPagingTests(TestCase):
+    PERIOD = {'start_date': '2024-01-01', 'end_date': '2024-12-31'}
+    PAGE_SIZE = 4
+
+    def setUp(self):
+        self.user = User.objects.create_user('pager')
+        self.client.force_login(self.user)
+        self.client.get(reverse('transaction_list'))
+        self.add_stock(range(12))
+
+    def add_stock(self, numbers):
+        """
+        SKUs with ties in every column, some never counted (no variance) and
+        some never bought or sold (no last movement).
+        """
+        numbers = list(numbers)
+        StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=f'PAG{i:03d}', stock_description=('Bolt', 'Nut', 'Washer')[i % 3], uom='ea')
+            for i in numbers
+        )
+        for i in numbers:
+            code, day = f'PAG{i:03d}', date(2024, 3, 1) + timedelta(days=i % 5)
+            if i % 4 != 3:
+                post_purchase_document(day, 'Supplier', '', [{'stock_code': code, 'quantity': 5 + i % 3,
+                                                              'price_per_unit': 1 + i % 2}])
+            if i % 3 == 0:
+                post_sale_document(day, 'Customer', [{'stock_code': code, 'quantity': 2, 'price_per_unit': 9}])
+            if i % 2 == 0:
+                post_stock_count(date(2024, 4, 1), [{'stock_code': code, 'quantity_counted': 4 + i % 3}])
+
+    def get(self, **params):
+        return self.client.get(reverse('transaction_list'), {**self.PERIOD, 'page_size': self.PAGE_SIZE, **params})
+
+    def walk(self, **params):
+        """Every ledger row, following next_cursor from the first page."""
+        rows, cursor = [], None
+        for _ in range(StockTransaction.objects.count() + 1):
+            response = self.get(**params, **({'cursor': cursor} if cursor else {}))
+            rows += response.context['transactions']
+            cursor = response.context['page'].next_cursor
+            if cursor is None:
+                return rows
+        self.fail('Paging did not end')
+
+    def expected_order(self, rows, sort, descending):
+        # Ties broken on stock code; rows without a value last either way
+        rows = sorted(rows, key=lambda row: row['stock_code'], reverse=descending)
+        present = [row for row in rows if row[sort] is not None]
+        missing = [row for row in rows if row[sort] is None]
+        return sorted(present, key=lambda row: row[sort], reverse=descending) + missing
+
+    def test_every_sort_visits_each_sku_once_in_order(self):
+        codes = sorted(StockTransaction.objects.values_list('stock_code', flat=True))
+        for sort, _, _ in LEDGER_COLUMNS:
+            for direction in ('asc', 'desc'):
+                with self.subTest(sort=sort, direction=direction):
+                    rows = self.walk(sort=sort, dir=direction)
+                    self.assertEqual(sorted(row['stock_code'] for row in rows), codes)
+                    self.assertEqual(rows, self.expected_order(rows, sort, direction == 'desc'))
+
+    def test_previous_cursor_returns_the_earlier_page(self):
+        first = self.get(sort='quantity_on_hand', dir='desc')
+        second = self.get(sort='quantity_on_hand', dir='desc', cursor=first.context['page'].next_cursor)
+        self.assertIsNone(first.context['page'].previous_cursor)
+
+        back = self.get(sort='quantity_on_hand', dir='desc', cursor=second.context['page'].previous_cursor)
+        self.assertEqual(back.context['transactions'], first.context['transactions'])
+        self.assertEqual(back.context['page'].next_cursor, first.context['page'].next_cursor)
+
+    def test_garbage_cursor_falls_back_to_the_first_page(self):
+        first = self.get(sort='variance').context['transactions']
+        for cursor in ('not a cursor!', 'WyJuIiwgWzFdXQ', 'e30'):
+            with self.subTest(cursor=cursor):
+                response = self.get(sort='variance', cursor=cursor)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.context['transactions'], first)
+
+    def count_queries(self, **params):
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get(**params)
+        return len(queries), response.context['page'].next_cursor
+
+    def page_queries(self, sort):
+        first, cursor = self.count_queries(sort=sort)
+        return first, self.count_queries(sort=sort, cursor=cursor)[0]
+
+    def test_query_count_does_not_grow_with_the_catalogue(self):
+        sorts = ('stock_code', 'variance', 'transaction_date')
+        few = {sort: self.page_queries(sort) for sort in sorts}
+        self.add_stock(range(12, 36))
+        for sort in sorts:
+            with self.subTest(sort=sort):
+                self.assertEqual(self.page_queries(sort), few[sort])
+
+
+class ExportTests(TestCase):
+    PERIOD = {'start_date': '2024-01-01', 'end_date': '2024-01-31'}
+    SHEET = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+    def setUp(self):
+        self.user = User.objects.create_user('exporter')
+        self.client.force_login(self.user)
+        self.client.get(reverse('transaction_list'))
+        stocks = StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=code, stock_description=description, uom='ea')
+            for code, description in (('EXP1', 'Bolt, "hex"'), ('EXP2', 'Nut & washer'), ('EXP3', 'Unused'))
+        )
+        post_purchase_document(date(2024, 1, 5), 'Supplier', 'EXP-P1', [
+            {'stock_code': stock, 'quantity': 10, 'price_per_unit': 2.5} for stock in stocks[:2]
+        ])
+        post_sale_document(date(2024, 1, 8), 'Customer', [{'stock_code': 'EXP1', 'quantity': 4, 'price_per_unit': 6}])
+        post_stock_count(date(2024, 1, 20), [{'stock_code': 'EXP1', 'quantity_counted': 5},
+                                             {'stock_code': 'EXP2', 'quantity_counted': 10}])
+
+    def download(self, name, file_format, params=None):
+        response = self.client.get(reverse(name, args=[file_format]), params or {})
+        return response, b''.join(response.streaming_content)
+
+    def expected(self, rows, columns):
+        return [[label for _, label in columns]] + [
+            ['' if row[key] is None else str(row[key]) for key, _ in columns] for row in rows
+        ]
+
+    def test_csv_matches_the_ledger_and_summary(self):
+        ledger = self.client.get(reverse('transaction_list'), self.PERIOD).context['transactions']
+        response, content = self.download('export_transaction_list', 'csv', self.PERIOD)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertIn('stock_ledger_20240101_20240131.csv', response['Content-Disposition'])
+        self.assertEqual(list(csv.reader(io.StringIO(content.decode()))),
+                         self.expected(ledger, LEDGER_EXPORT_COLUMNS))
+
+        summary = self.client.get(reverse('inventory_summary')).context['summary']
+        _, content = self.download('export_inventory_summary', 'csv')
+        self.assertEqual(list(csv.reader(io.StringIO(content.decode()))),
+                         self.expected(summary, SUMMARY_EXPORT_COLUMNS))
+        self.assertEqual(len(summary), 2)
+
+    def test_xlsx_is_a_valid_workbook(self):
+        ledger = self.client.get(reverse('transaction_list'), self.PERIOD).context['transactions']
+        response, content = self.download('export_transaction_list', 'xlsx', self.PERIOD)
+        self.assertTrue(response['Content-Disposition'].endswith('.xlsx"'))
+
+        with zipfile.ZipFile(io.BytesIO(content)) as workbook:
+            self.assertIsNone(workbook.testzip())
+            self.assertEqual(set(workbook.namelist()), {
+                '[Content_Types].xml', '_rels/.rels', 'xl/_rels/workbook.xml.rels', 'xl/workbook.xml',
+                'xl/worksheets/sheet1.xml',
+            })
+            sheet_name = ElementTree.fromstring(workbook.read('xl/workbook.xml')).find(f'.//{self.SHEET}sheet')
+            sheet = ElementTree.fromstring(workbook.read('xl/worksheets/sheet1.xml'))
+        self.assertEqual(sheet_name.get('name'), 'Stock Ledger')
+
+        rows = [
+            {cell.get('r'): ''.join(cell.itertext()) for cell in row.iter(f'{self.SHEET}c')}
+            for row in sheet.iter(f'{self.SHEET}row')
+        ]
+        self.assertEqual(len(rows), len(ledger) + 1)
+        self.assertEqual(list(rows[0].values()), [label for _, label in LEDGER_EXPORT_COLUMNS])
+        self.assertEqual((rows[1]['A2'], rows[1]['B2'], rows[1]['G2']), ('EXP1', 'Bolt, "hex"', '5.00'))
+        self.assertEqual(rows[2]['B3'], 'Nut & washer')
+        # Empty cells (no variance, no movement) are left out
+        self.assertNotIn('F4', rows[3])
+
+    def test_unknown_format_is_not_found(self):
+        for name in ('export_transaction_list', 'export_inventory_summary'):
+            with self.subTest(view=name):
+                self.assertEqual(self.client.get(reverse(name, args=['pdf'])).status_code, 404)
+
+    def test_unreadable_dates_fall_back_to_the_defaults(self):
+        year = date.today().year
+        # 2026/03/01 does not parse; 2026-13-40 parses but is not a date
+        for params in ({'start_date': '2026/03/01'}, {'end_date': '2026-13-40'},
+                       {'start_date': '2026-13-40', 'end_date': '2026/03/01'}):
+            with self.subTest(params=params):
+                response = self.client.get(reverse('transaction_list'), params)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual((response.context['start_date'], response.context['end_date']),
+                                 (date(year, 3, 1), date(year + 1, 2, 28)))
+
+                response, _ = self.download('export_transaction_list', 'csv', params)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(f'stock_ledger_{year}0301_{year + 1}0228.csv', response['Content-Disposition'])
+
+                response, _ = self.download('export_inventory_summary', 'csv', params)
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('inventory_summary_20240120.csv', response['Content-Disposition'])
+
+
+class ImportTests(TestCase):
+    PURCHASE_HEADER = 'transaction_date,supplier_name,document_number,stock_code,quantity,price_per_unit\n'
+
+    def setUp(self):
+        result = self.load('stock', 'stock_code,stock_description,uom\nIMP1,Item 1,ea\nIMP2,Item 2,ea\nimp1,Again,ea\n')
+        self.assertEqual((result.rows_imported, result.errors), (2, [(4, "stock code 'imp1' already exists.")]))
+
+    def load(self, kind, text, **kwargs):
+        return import_csv(kind, io.StringIO(text), **kwargs)
+
+    def test_rejected_rows_are_reported_by_line(self):
+        result = self.load('purchase', self.PURCHASE_HEADER + (
+            '2024-01-05,Supplier,INV-1,IMP1,2,3\n'
+            '2024-13-01,Supplier,INV-2,IMP1,2,3\n'
+            '2024-01-05,Supplier,INV-3,NOPE,x,3\n'
+        ))
+        self.assertEqual((result.rows_read, result.rows_imported, result.documents_created), (3, 1, 1))
+        self.assertEqual(result.errors, [
+            (3, "transaction_date - '2024-13-01' is not a YYYY-MM-DD date."),
+            (4, "unknown stock code 'NOPE'."),
+            (4, "quantity - 'x' is not a number."),
+        ])
+        report = io.StringIO()
+        result.write_error_report(report)
+        self.assertEqual(report.getvalue().splitlines()[:2],
+                         ['line,error', "3,transaction_date - '2024-13-01' is not a YYYY-MM-DD date."])
+
+    def test_rows_are_grouped_into_documents(self):
+        result = self.load('purchase', self.PURCHASE_HEADER + (
+            '2024-01-05,Supplier A,INV-1,IMP1,2,3\n'
+            '2024-01-05,Supplier A,INV-1,IMP2,1,4\n'
+            '2024-01-06,Supplier B,,IMP1,5,3\n'
+            '2024-01-06,Supplier B,,IMP2,5,3\n'
+            '2024-01-07,Supplier B,,IMP1,1,3\n'
+        ))
+        self.assertEqual((result.rows_imported, result.documents_created, result.errors), (5, 3, []))
+        self.assertEqual(
+            list(PurchaseDocument.objects.order_by('transaction_date').values_list(
+                'transaction_date', 'supplier_name', 'total_quantity',
+            )),
+            [(date(2024, 1, 5), 'Supplier A', Decimal('3')), (date(2024, 1, 6), 'Supplier B', Decimal('10')),
+             (date(2024, 1, 7), 'Supplier B', Decimal('1'))],
+        )
+        self.assertEqual(StockDailyBalance.objects.get(stock_code__stock_code='IMP1', date=date(2024, 1, 7))
+                         .closing_quantity, Decimal('8'))
+
+    def test_bad_row_keeps_its_document_out(self):
+        result = self.load('sale', (
+            'transaction_date,customer_name,document_number,stock_code,quantity,price_per_unit\n'
+            '2024-01-05,Customer,SAL-A,IMP1,2,3\n'
+            '2024-01-05,Customer,SAL-A,IMP2,-1,3\n'
+            '2024-01-05,Customer,SAL-B,IMP2,1,3\n'
+        ))
+        self.assertEqual(result.errors, [
+            (3, 'quantity must be greater than zero.'),
+            (2, 'not imported: another line of document SAL-A is invalid.'),
+        ])
+        self.assertEqual(list(Sale.objects.values_list('document_number', flat=True)), ['SAL-B'])
+
+    def test_failed_chunk_is_rolled_back_whole(self):
+        calls = []
+
+        def fail_second_chunk(keys, *args, **kwargs):
+            calls.append(keys)
+            if len(calls) == 2:
+                raise DatabaseError('disk full')
+            return refresh_costs(keys, *args, **kwargs)
+
+        with mock.patch('stock_manager.services.refresh_costs', side_effect=fail_second_chunk):
+            result = self.load('purchase', self.PURCHASE_HEADER + (
+                '2024-01-05,Supplier,INV-1,IMP1,2,3\n'
+                '2024-01-05,Supplier,INV-1,IMP2,2,3\n'
+                '2024-01-06,Supplier,INV-2,IMP1,1,3\n'
+                '2024-01-07,Supplier,INV-3,IMP2,1,3\n'
+            ), chunk_size=2)
+        self.assertEqual((result.rows_imported, result.documents_created), (2, 1))
+        self.assertEqual(result.errors, [
+            (4, 'not imported: chunk failed to save (disk full).'),
+            (5, 'not imported: chunk failed to save (disk full).'),
+        ])
+        self.assertEqual(list(PurchaseDocument.objects.values_list('document_number', flat=True)), ['INV-1'])
+        self.assertEqual(Purchase.objects.count(), 2)
+        self.assertFalse(StockDailyBalance.objects.filter(date__gt=date(2024, 1, 5)).exists())
+
+    def test_unnumbered_documents_take_numbers_from_the_sequence(self):
+        next_document_number('purchase')
+        rows = self.PURCHASE_HEADER + (
+            '2024-01-05,Supplier A,,IMP1,2,3\n'
+            '2024-01-05,Supplier B,,IMP1,2,3\n'
+            '2024-01-06,Supplier A,OWN-1,IMP1,2,3\n'
+        )
+        self.load('purchase', rows, dry_run=True)
+        self.assertEqual(DocumentSequence.objects.get(name='purchase').next_number, 2)
+
+        self.load('purchase', rows)
+        self.assertEqual(
+            sorted(PurchaseDocument.objects.values_list('document_number', flat=True)),
+            ['OWN-1', 'PUR-000002', 'PUR-000003'],
+        )
+        self.assertEqual(next_document_number('purchase'), 'PUR-000004')
+
+
+@override_settings(AUDIT_ASYNC=False)
+class StockCacheTests(TestCase):
+    def setUp(self):
+        self.stock = StockTransaction.objects.create(stock_code='CCH1', stock_description='Item', uom='ea')
+
+    def version(self):
+        return caches['default'].get(stock_cache.VERSION_KEY)
+
+    def test_create_and_rename_bump_the_version(self):
+        stock_master()
+        for write in (
+            lambda: StockTransaction.objects.create(stock_code='CCH2', stock_description='Other', uom='ea'),
+            lambda: StockTransaction.objects.filter(pk=self.stock.pk).first().save(),
+        ):
+            before = self.version()
+            with self.captureOnCommitCallbacks(execute=True):
+                write()
+                # This process drops its copy straight away
+                self.assertIsNone(stock_cache._state['master'])
+            self.assertNotEqual(self.version(), before)
+
+        self.stock.stock_code = 'CCH1-NEW'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stock.save()
+        self.assertEqual(stock_code_for(self.stock.pk), 'CCH1-NEW')
+
+    @override_settings(STOCK_CACHE_CHECK_SECONDS=0)
+    def test_stale_copy_is_reloaded_on_next_lookup(self):
+        self.assertEqual(len(stock_master()), 1)
+        # Written by another process: no signal here, only its version change
+        other = StockTransaction.objects.bulk_create([
+            StockTransaction(stock_code='CCH2', stock_description='Other', uom='ea'),
+        ])[0]
+        self.assertIsNone(stock_code_for(other.pk))
+        caches['default'].set(stock_cache.VERSION_KEY, 'moved-on', timeout=None)
+        self.assertEqual(stock_code_for(other.pk), 'CCH2')
+        self.assertEqual(len(stock_master()), 2)
+
+    def test_missing_code_is_looked_up_before_rejecting(self):
+        stock_master()
+        StockTransaction.objects.bulk_create([StockTransaction(stock_code='CCH2', stock_description='Other', uom='ea')])
+        field = StockCodeField()
+        self.assertEqual(field.clean('cch2').stock_code, 'CCH2')
+        self.assertEqual(field.clean(' CCH1 ').pk, self.stock.pk)
+        with self.assertRaisesMessage(ValidationError, 'Unknown stock code NOPE.'):
+            field.clean('NOPE')
+
+
+class SearchTests(TestCase):
+    # In ranking order for 'hinge': exact code, code prefix, word prefix, substring
+    STOCK = [
+        ('HINGE', 'Door part'),
+        ('HINGE-18', 'Hinge 18mm'),
+        ('HINGEX', 'Spare'),
+        ('A100', 'Hinges, brass'),
+        ('B100', 'Bracket Hinge 183'),
+        ('AA-1', 'Rehinge kit'),
+        ('C100', 'Unhinged bracket'),
+        ('SKU-001', 'Crème brûlée torch'),
+        ('Z1', 'Nothing to see'),
+    ]
+    RANKED = ['HINGE', 'HINGE-18', 'HINGEX', 'A100', 'B100', 'AA-1', 'C100']
+
+    def setUp(self):
+        self.user = User.objects.create_user('searcher')
+        self.client.force_login(self.user)
+        for code, description in self.STOCK:
+            StockTransaction.objects.create(stock_code=code, stock_description=description, uom='ea')
+
+    def lookup(self, q, **params):
+        response = self.client.get(reverse('stock_lookup'), {'q': q, **params})
+        return [result['code'] for result in response.json()['results']]
+
+    def test_ranking_in_memory_and_in_the_database(self):
+        for term in ('hinge', ' HINGE '):
+            with self.subTest(term=term):
+                self.assertEqual([row[1] for row in stock_master().search(term, 20)], self.RANKED)
+                self.assertEqual([row[1] for row in _database_search(term, 20)], self.RANKED)
+        with mock.patch('stock_manager.search.trigram_index_available', return_value=True):
+            self.assertEqual([row['code'] for row in search_stock('hinge')], self.RANKED)
+        self.assertEqual([row['code'] for row in search_stock('hinge', limit=4)], self.RANKED[:4])
+
+    def test_lookup_normalizes_the_term(self):
+        self.assertEqual(self.lookup('creme BRULEE'), ['SKU-001'])
+        self.assertEqual(self.lookup('crème'), ['SKU-001'])
+        self.assertEqual(self.lookup('sku001'), ['SKU-001'])
+        self.assertEqual(self.lookup('sku 001'), ['SKU-001'])
+        # Both only word prefixes once the comma is a separator, so in code order
+        self.assertEqual(self.lookup('hinge,18'), ['B100', 'HINGE-18'])
+        self.assertEqual(self.lookup('  --  '), [])
+
+    def test_lookup_limit_is_clamped(self):
+        for i in range(60):
+            StockTransaction.objects.create(stock_code=f'BULK{i:02d}', stock_description='Bulk item', uom='ea')
+        self.assertEqual(len(self.lookup('bulk')), SEARCH_LIMIT)
+        self.assertEqual(len(self.lookup('bulk', limit=5)), 5)
+        self.assertEqual(len(self.lookup('bulk', limit=0)), 1)
+        self.assertEqual(len(self.lookup('bulk', limit=1000)), STOCK_LOOKUP_MAX_LIMIT)
+        self.assertEqual(len(self.lookup('bulk', limit='many')), SEARCH_LIMIT)
+
+    def test_report_search_finds_what_icontains_did(self):
+        post_stock_count(date(2024, 1, 10), [
+            {'stock_code': code, 'quantity_counted': 1} for code, _ in self.STOCK
+        ])
+        for term in ('hinge', 'Bracket', '18', 'HING', 'inge', 'sku', 'brass', 'zzz'):
+            with self.subTest(term=term):
+                expected = set(StockTransaction.objects.filter(
+                    Q(stock_code__icontains=term) | Q(stock_description__icontains=term)
+                ).values_list('stock_code', flat=True))
+                ledger = self.client.get(reverse('transaction_list'), {'search': term, 'page_size': 500})
+                self.assertEqual({row['stock_code'] for row in ledger.context['transactions']}, expected)
+                summary = self.client.get(reverse('inventory_summary'), {'search': term})
+                self.assertEqual({row['stock_code'] for row in summary.context['summary']}, expected)
+
+
+class AuditLogViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('auditor')
+        self.client.force_login(self.user)
+        # First request of a session stores its activity time; keep it out of the counts
+        self.client.get(reverse('audit_log'))
+
+    def add_entries(self, count, start):
+        AuditLog.objects.bulk_create(
+            AuditLog(
+                timestamp=datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=start + i),
+                user=self.user, action='create', model_name='purchase', object_id=start + i,
+                description=f'Entry {start + i}',
+            )
+            for i in range(count)
+        )
+
+    def count_queries(self, url, params):
+        # The request_started signal resets the query log, so start from an
+        # empty one or the captured slice is wrong
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        return len(queries), response
+
+    def test_query_count_does_not_grow_with_table_or_page(self):
+        url = reverse('audit_log')
+        self.add_entries(150, 0)
+        first_page, response = self.count_queries(url, {'page_size': 20})
+        small_page, _ = self.count_queries(url, {'page_size': 5})
+        next_page, _ = self.count_queries(url, {'page_size': 20, 'cursor': response.context['page'].next_cursor})
+        self.add_entries(1500, 150)
+        filtered, _ = self.count_queries(url, {'page_size': 20, 'user': self.user.pk, 'action': 'create'})
+        self.assertEqual(small_page, first_page)
+        self.assertEqual(next_page, first_page)
+        self.assertEqual(filtered, first_page)
+
+    def test_pages_walk_newest_first_without_gaps(self):
+        self.add_entries(45, 0)
+        url = reverse('audit_log')
+        seen, cursor = [], None
+        while True:
+            params = {'page_size': 20, **({'cursor': cursor} if cursor else {})}
+            page = self.client.get(url, params).context['page']
+            seen.extend(log.object_id for log in page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, list(range(44, -1, -1)))
+
+
+class InventorySummaryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('counter')
+        self.client.force_login(self.user)
+        self.client.get(reverse('inventory_summary'))
+        self.sessions = [StockCountSession.objects.create(date=date(2024, 1, 10 * n)) for n in (1, 2)]
+
+    def add_stock(self, count, start):
+        stocks = StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=f'SUM{start + i:04d}', stock_description=f'Item {start + i}', uom='ea')
+            for i in range(count)
+        )
+        for stock in stocks:
+            Purchase.objects.bulk_create([
+                Purchase(transaction_date=day, supplier_name='Supplier', document_number='P', stock_code=stock,
+                         quantity=quantity, price_per_unit=price)
+                for day, quantity, price in ((date(2024, 1, 5), 10, 2), (date(2024, 1, 15), 4, 3))
+            ])
+            refresh_prices([(stock.pk, date(2024, 1, 5)), (stock.pk, date(2024, 1, 15))])
+            Sale.objects.create(transaction_date=date(2024, 1, 12), customer_name='Customer', document_number='S',
+                                stock_code=stock, quantity=3, price_per_unit=5)
+            for session, counted in zip(self.sessions, (9, 11)):
+                StockCountEntry.objects.create(session=session, stock_code=stock, quantity_counted=counted)
+        return stocks
+
+    def summary(self):
+        reset_queries()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('inventory_summary'))
+        return len(queries), response.context['summary']
+
+    def test_variance_against_prior_count(self):
+        self.add_stock(1, 0)
+        _, summary = self.summary()
+        # 9 counted on the 10th, +4 bought and -3 sold since: 10 expected, 11 counted at the latest price 3
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]['count_date'], date(2024, 1, 20))
+        self.assertEqual(summary[0]['system_quantity'], Decimal('10'))
+        self.assertEqual(summary[0]['variance'], Decimal('1'))
+        self.assertEqual(summary[0]['latest_price'], Decimal('3'))
+
+    def test_query_count_does_not_grow_with_counted_stock(self):
+        self.add_stock(2, 0)
+        few, summary = self.summary()
+        self.add_stock(40, 2)
+        many, more_summary = self.summary()
+        self.assertEqual((len(summary), len(more_summary)), (2, 42))
+        self.assertEqual(many, few)
+
+
+class PostingTests(TestCase):
+    """A document is posted completely or not at all."""
+    WRITTEN = (PurchaseDocument, Purchase, StockDailyBalance, StockPrice, StockCountAdjustment, StockCostBalance,
+               CostLayer)
+
+    def setUp(self):
+        self.stocks = StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=f'PST{i}', stock_description=f'Item {i}', uom='ea') for i in range(3)
+        )
+        post_purchase_document(date(2024, 1, 5), 'Supplier', 'PST-P1', self.lines(self.stocks, 10))
+        # A later count, so a posting also has adjustments to refresh
+        post_stock_count(date(2024, 1, 20), [{'stock_code': stock, 'quantity_counted': 8} for stock in self.stocks])
+
+    def lines(self, stocks, quantity=5):
+        return [{'stock_code': stock, 'quantity': quantity, 'price_per_unit': 3} for stock in stocks]
+
+    def written(self):
+        return {model.__name__: list(model.objects.order_by('pk').values()) for model in self.WRITTEN}
+
+    def assertNothingWritten(self, post, error):
+        before = self.written()
+        with self.assertRaises(error):
+            post()
+        self.assertEqual(self.written(), before)
+
+    def test_unknown_stock_code_rejects_the_whole_document(self):
+        lines = self.lines(self.stocks) + [{'stock_code': 'NOPE', 'quantity': 1, 'price_per_unit': 3}]
+        self.assertNothingWritten(
+            lambda: post_purchase_document(date(2024, 1, 10), 'Supplier', 'PST-P2', lines), ValidationError
+        )
+
+    def test_duplicate_number_rolls_back_the_batch(self):
+        documents = [
+            ({'transaction_date': date(2024, 1, 10), 'supplier_name': 'Supplier', 'document_number': number},
+             [Purchase(stock_code=stock, quantity=5, price_per_unit=3) for stock in self.stocks])
+            for number in ('PST-P2', 'PST-P1')
+        ]
+        self.assertNothingWritten(lambda: post_purchase_documents(documents), IntegrityError)
+
+    def test_failure_after_the_lines_are_written_rolls_them_back(self):
+        with mock.patch('stock_manager.services.refresh_costs', side_effect=DatabaseError):
+            self.assertNothingWritten(
+                lambda: post_purchase_document(date(2024, 1, 10), 'Supplier', 'PST-P2', self.lines(self.stocks)),
+                DatabaseError,
+            )
+
+    def test_query_count_does_not_grow_with_lines(self):
+        stocks = StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=f'PSTX{i:02d}', stock_description='Item', uom='ea') for i in range(40)
+        )
+
+        def count(number, stocks):
+            with CaptureQueriesContext(connection) as queries:
+                post_purchase_document(date(2024, 1, 10), 'Supplier', number, self.lines(stocks))
+            return len(queries)
+
+        self.assertEqual(count('PST-P3', stocks[30:]), count('PST-P2', stocks[:2]))
+
+
+class DocumentSequenceTests(TestCase):
+    def test_reserves_consecutive_blocks(self):
+        self.assertEqual(reserve_numbers('purchase', 3), ['PUR-000001', 'PUR-000002', 'PUR-000003'])
+        self.assertEqual(next_document_number('purchase'), 'PUR-000004')
+        self.assertEqual(DocumentSequence.objects.get(name='purchase').next_number, 5)
+
+    def test_formats_with_the_sequence_template(self):
+        DocumentSequence.objects.create(name='credit', prefix='CN/', number_format='{prefix}{number:04d}/A',
+                                        next_number=42)
+        self.assertEqual(reserve_numbers('credit', 2), ['CN/0042/A', 'CN/0043/A'])
+
+    @override_settings(DOCUMENT_SEQUENCES={'transfer': {'prefix': 'TRF-', 'format': '{prefix}{number}', 'start': 7}})
+    def test_created_on_first_use_from_settings(self):
+        self.assertFalse(DocumentSequence.objects.filter(name='transfer').exists())
+        self.assertEqual(reserve_numbers('transfer', 2), ['TRF-7', 'TRF-8'])
+        # Unconfigured names still get a sequence, with the defaults
+        self.assertEqual(next_document_number('other'), '000001')
+
+    def test_seeding_starts_past_existing_numbers(self):
+        stock = StockTransaction.objects.create(stock_code='SEQ1', stock_description='Item', uom='ea')
+        for number in ('PUR-000041', 'PUR-000007', 'SUPPLIER-99'):
+            Purchase.objects.create(transaction_date=date(2024, 1, 1), supplier_name='Supplier',
+                                    document_number=number, stock_code=stock, quantity=1, price_per_unit=1)
+        Sale.objects.create(transaction_date=date(2024, 1, 1), customer_name='Customer', document_number='SAL-000003',
+                            stock_code=stock, quantity=1, price_per_unit=1)
+        DocumentSequence.objects.all().delete()
+
+        seed_sequences = import_module('stock_manager.migrations.0009_documentsequence').seed_sequences
+        seed_sequences(django_apps, None)
+        self.assertEqual(next_document_number('purchase'), 'PUR-000042')
+        # Old sale numbers came from the row id, which may be past the highest number
+        sale_id = Sale.objects.get().pk
+        self.assertEqual(next_document_number('sale'), f'SAL-{max(sale_id, 3) + 1:06d}')
+
+
+class DocumentSequenceConcurrencyTests(TransactionTestCase):
+    def test_concurrent_reservations_never_overlap(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # Shared-cache in-memory databases fail on a lock instead of waiting for it
+            self.skipTest('Needs a database that waits on locks; set a file TEST NAME for SQLite')
+        reserve_numbers('purchase')
+        threads, blocks, errors = 4, [], []
+        start = threading.Barrier(threads)
+
+        def reserve():
+            try:
+                start.wait()
+                for _ in range(10):
+                    blocks.append(reserve_numbers('purchase', 5))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=reserve) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        numbers = [number for block in blocks for number in block]
+        self.assertEqual(len(numbers), threads * 10 * 5)
+        self.assertEqual(sorted(numbers), [f'PUR-{n:06d}' for n in range(2, 2 + len(numbers))])
+
+
+class DocumentHeaderTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('clerk')
+        self.client.force_login(self.user)
+        self.stocks = StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=code, stock_description=code, uom='ea') for code in ('DOC1', 'DOC2')
+        )
+
+    def test_migration_groups_lines_into_headers(self):
+        for number, day, stock, quantity in (('INV-1', 2, 0, 2), ('INV-1', 1, 1, 3), ('INV-2', 5, 0, 1)):
+            Purchase.objects.create(transaction_date=date(2024, 1, day), supplier_name=f'Supplier {number}',
+                                    document_number=number, stock_code=self.stocks[stock], quantity=quantity,
+                                    price_per_unit=4)
+        Sale.objects.create(transaction_date=date(2024, 1, 6), customer_name='Customer', document_number='SAL-1',
+                            stock_code=self.stocks[0], quantity=1, price_per_unit=9)
+
+        migration = import_module('stock_manager.migrations.0010_purchasedocument_saledocument')
+        migration.create_document_headers(django_apps, None)
+
+        self.assertEqual(
+            list(PurchaseDocument.objects.order_by('document_number').values_list(
+                'document_number', 'transaction_date', 'supplier_name', 'total_quantity', 'total_value',
+            )),
+            [('INV-1', date(2024, 1, 1), 'Supplier INV-1', Decimal('5'), Decimal('20')),
+             ('INV-2', date(2024, 1, 5), 'Supplier INV-2', Decimal('1'), Decimal('4'))],
+        )
+        self.assertFalse(Purchase.objects.exclude(document__document_number=F('document_number')).exists())
+        self.assertEqual(SaleDocument.objects.get().lines.get().document_number, 'SAL-1')
+
+    def test_receipts_render_from_the_header(self):
+        purchase = post_purchase_document(date(2024, 1, 5), 'Supplier', 'DOC-P1', [
+            {'stock_code': stock, 'quantity': 2, 'price_per_unit': 3} for stock in self.stocks
+        ])
+        sale = post_sale_document(date(2024, 1, 6), 'Customer', [{'stock_code': 'DOC1', 'quantity': 1,
+                                                                 'price_per_unit': 7}])
+        for name, document, lines in (('purchase_invoice', purchase, 'purchases'), ('sale_receipt', sale, 'sales')):
+            with self.subTest(view=name):
+                response = self.client.get(reverse(name, args=[document.document_number]))
+                self.assertEqual(response.context['header'], document)
+                self.assertEqual((response.context['total_qty'], response.context['total_value']),
+                                 (document.total_quantity, document.total_value))
+                self.assertEqual([line.stock_code.stock_code for line in response.context[lines]],
+                                 [line.stock_code.stock_code for line in document.lines.order_by('id')])
+                self.assertContains(response, document.document_number)
+        self.assertEqual((purchase.total_quantity, purchase.total_value), (Decimal('4'), Decimal('12')))
+        self.assertEqual(self.client.get(reverse('sale_receipt', args=['NOPE'])).status_code, 404)
+
+    def test_totals_follow_line_edits_and_deletes(self):
+        document = post_purchase_document(date(2024, 1, 5), 'Supplier', 'DOC-P1', [
+            {'stock_code': stock, 'quantity': 2, 'price_per_unit': 3} for stock in self.stocks
+        ])
+        first, second = document.lines.order_by('id')
+        first.quantity = 5
+        first.save()
+        document.refresh_from_db()
+        self.assertEqual((document.total_quantity, document.total_value), (Decimal('7'), Decimal('21')))
+
+        second.delete()
+        document.refresh_from_db()
+        self.assertEqual((document.total_quantity, document.total_value), (Decimal('5'), Decimal('15')))
+
+
+class StockCountAdjustmentTests(TestCase):
+    def setUp(self):
+        self.stock = StockTransaction.objects.create(stock_code='ADJ1', stock_description='Item', uom='ea')
+        post_purchase_document(date(2024, 1, 5), 'Supplier', 'ADJ-P1',
+                               [{'stock_code': self.stock, 'quantity': 10, 'price_per_unit': 2}])
+
+    def adjustment(self, session):
+        return StockCountAdjustment.objects.get(entry__session=session)
+
+    def test_posted_count_stores_its_variance(self):
+        session = post_stock_count(date(2024, 1, 10), [{'stock_code': 'ADJ1', 'quantity_counted': 8}])
+        adjustment = self.adjustment(session)
+        self.assertEqual(
+            (adjustment.system_quantity, adjustment.variance_quantity, adjustment.variance_value),
+            (Decimal('10'), Decimal('-2'), Decimal('-4')),
+        )
+        self.assertEqual(StockDailyBalance.objects.get(stock_code=self.stock, date=date(2024, 1, 10)).closing_quantity,
+                         Decimal('8'))
+        self.assertEqual(count_variance(date(2024, 1, 1), date(2024, 1, 31)), Decimal('-2'))
+
+    def test_backdated_movements_refresh_later_counts(self):
+        first = post_stock_count(date(2024, 1, 10), [{'stock_code': 'ADJ1', 'quantity_counted': 8}])
+        second = post_stock_count(date(2024, 1, 20), [{'stock_code': 'ADJ1', 'quantity_counted': 12}])
+        post_purchase_document(date(2024, 1, 15), 'Supplier', 'ADJ-P2',
+                               [{'stock_code': self.stock, 'quantity': 5, 'price_per_unit': 3}])
+        Sale.objects.create(transaction_date=date(2024, 1, 8), customer_name='Customer', document_number='S',
+                            stock_code=self.stock, quantity=1, price_per_unit=5)
+        self.assertEqual(self.adjustment(first).system_quantity, Decimal('9'))
+        # 8 counted on the 10th plus 5 bought since, valued at the new price
+        second_adjustment = self.adjustment(second)
+        self.assertEqual(second_adjustment.system_quantity, Decimal('13'))
+        self.assertEqual(second_adjustment.variance_value, Decimal('-3'))
+
+
+class StockPriceTests(TestCase):
+    def setUp(self):
+        self.stock = StockTransaction.objects.create(stock_code='PRC1', stock_description='Item', uom='ea')
+
+    def buy(self, day, number, price):
+        return post_purchase_document(day, 'Supplier', number,
+                                      [{'stock_code': self.stock, 'quantity': 1, 'price_per_unit': price}])
+
+    def columns(self):
+        self.stock.refresh_from_db()
+        return self.stock.last_cost, self.stock.last_purchase_date, self.stock.last_sale_date
+
+    def test_posting_and_deletes_keep_columns_and_history_current(self):
+        self.buy(date(2024, 2, 1), 'PRC-P1', 3)
+        backdated = self.buy(date(2024, 1, 1), 'PRC-P2', 2)
+        post_sale_document(date(2024, 1, 15), 'Customer', [{'stock_code': self.stock, 'quantity': 1,
+                                                            'price_per_unit': 5}])
+        self.assertEqual(self.columns(), (Decimal('3'), date(2024, 2, 1), date(2024, 1, 15)))
+        self.assertEqual(latest_prices(date(2024, 1, 20))[self.stock.pk], Decimal('2'))
+        self.assertNotIn(self.stock.pk, latest_prices(date(2023, 12, 31)))
+
+        # Editing the SKU must not write back the columns it was loaded with
+        stale = StockTransaction.objects.get(pk=self.stock.pk)
+        self.buy(date(2024, 3, 1), 'PRC-P3', 4)
+        stale.stock_description = 'Renamed'
+        stale.save()
+        self.assertEqual(self.columns(), (Decimal('4'), date(2024, 3, 1), date(2024, 1, 15)))
+
+        Purchase.objects.filter(document__document_number='PRC-P3').delete()
+        Sale.objects.filter(stock_code=self.stock).delete()
+        self.assertEqual(self.columns(), (Decimal('3'), date(2024, 2, 1), None))
+        backdated.delete()
+        self.assertEqual(list(StockPrice.objects.values_list('date', 'price')), [(date(2024, 2, 1), Decimal('3'))])
+
+
+class CostingTests(TestCase):
+    def post_history(self):
+        self.stock = StockTransaction.objects.create(stock_code='COST1', stock_description='Item', uom='ea')
+        for day, number, quantity, price in ((1, 'COST-P1', 10, 2), (2, 'COST-P2', 10, 4)):
+            post_purchase_document(date(2024, 1, day), 'Supplier', number,
+                                   [{'stock_code': self.stock, 'quantity': quantity, 'price_per_unit': price}])
+        self.sell(date(2024, 1, 3), 15)
+        # 5 left; the count finds 2 more, taken in at the current unit cost
+        post_stock_count(date(2024, 1, 4), [{'stock_code': 'COST1', 'quantity_counted': 7}])
+
+    def sell(self, day, quantity):
+        post_sale_document(day, 'Customer', [{'stock_code': self.stock, 'quantity': quantity, 'price_per_unit': 9}])
+
+    def values(self):
+        return [cost_values(date(2024, 1, day)).get(self.stock.pk) for day in (3, 4)]
+
+    @override_settings(INVENTORY_COSTING_METHOD='fifo')
+    def test_fifo_issues_oldest_layers_first(self):
+        self.post_history()
+        self.assertEqual(self.values(), [Decimal('20'), Decimal('28')])
+        # A backdated sale uses up the first layer, so the later one goes too
+        self.sell(date(2024, 1, 1), 5)
+        self.assertEqual(self.values(), [Decimal('0'), Decimal('28')])
+
+    @override_settings(INVENTORY_COSTING_METHOD='average')
+    def test_average_cost_moves_with_receipts(self):
+        self.post_history()
+        self.assertEqual(self.values(), [Decimal('15'), Decimal('21')])
+        self.sell(date(2024, 1, 1), 5)
+        # 5 at 2 and 10 at 4 average 3.3333, and none is left after the 3rd
+        self.assertEqual(self.values(), [Decimal('0'), Decimal('23.3331')])
+
+
+class CountUploadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('scanner')
+        self.client.force_login(self.user)
+        StockTransaction.objects.bulk_create(
+            StockTransaction(stock_code=code, stock_description=code, uom='ea') for code in ('SCAN1', 'SCAN2')
+        )
+        response = self.client.post(reverse('count_upload_start'), {'date': '2024-03-01'},
+                                    content_type='application/json')
+        self.session_id = response.json()['session_id']
+
+    def post_chunk(self, chunk_id, body, content_type='application/json'):
+        url = reverse('count_upload_chunk', args=[self.session_id, chunk_id])
+        return self.client.post(url, body, content_type=content_type).json()
+
+    def counted(self):
+        return dict(StockCountEntry.objects.filter(session=self.session_id)
+                    .values_list('stock_code__stock_code', 'quantity_counted'))
+
+    def test_scans_merge_across_chunks_and_resent_chunks_count_once(self):
+        first = self.post_chunk('a', [{'stock_code': 'scan1'}, {'stock_code': 'SCAN1'}, {'stock_code': 'NOPE'}])
+        self.assertEqual((first['status'], first['entries_created'], first['lines_rejected']), ('posted', 1, 1))
+        self.assertEqual(first['errors'][0]['line'], 3)
+
+        second = self.post_chunk('b', 'stock_code,quantity\nSCAN1,3\nSCAN2,\n', content_type='text/csv')
+        self.assertEqual((second['entries_created'], second['entries_updated']), (1, 1))
+        self.assertEqual(self.post_chunk('a', [{'stock_code': 'SCAN1'}])['status'], 'duplicate')
+
+        self.assertEqual(self.counted(), {'SCAN1': Decimal('5'), 'SCAN2': Decimal('1')})
+        status = self.client.get(reverse('count_upload_status', args=[self.session_id])).json()
+        self.assertEqual((status['chunks'], status['lines_received']), (['a', 'b'], 5))
+        self.assertEqual(StockCountAdjustment.objects.filter(entry__session=self.session_id).count(), 2)
+
+    def test_uploads_need_the_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        User.objects.create_user('device', password='scan-pass')
+        client.get(reverse('login'))
+        client.post(reverse('login'), {'username': 'device', 'password': 'scan-pass',
+                                       'csrfmiddlewaretoken': client.cookies['csrftoken'].value})
+        start_url = reverse('count_upload_start')
+
+        response = client.post(start_url, {'date': '2024-03-02'}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+        response = client.post(start_url, {'date': '2024-03-02'}, content_type='application/json',
+                               HTTP_X_CSRFTOKEN=client.cookies['csrftoken'].value)
+        self.assertEqual(response.status_code, 201)
+        token = response.json()['csrf_token']
+        chunk_url = reverse('count_upload_chunk', args=[response.json()['session_id'], 'a'])
+        response = client.post(chunk_url, [{'stock_code': 'SCAN1'}], content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        response = client.post(chunk_url, [{'stock_code': 'SCAN1'}], content_type='application/json',
+                               HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.json()['entries_created'], 1)
+
+
+class KeepAliveTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create_user('pinger')
+        self.client.force_login(self.user)
+
+    def stats(self):
+        self.client.force_login(User.objects.create_user('ops', is_staff=True))
+        return self.client.get(reverse('ping_session_stats')).json()
+
+    def test_pings_from_report_pages_count_as_saved_renders(self):
+        self.client.get(reverse('ping_session'), {'page': reverse('dashboard')})
+        self.client.get(reverse('ping_session'), {'page': reverse('dashboard')})
+        self.client.get(reverse('ping_session'), {'page': reverse('audit_log')})
+        self.client.get(reverse('ping_session'), {'page': '/no/such/page/'})
+
+        stats = self.stats()
+        self.assertEqual((stats['pings'], stats['report_renders_saved']), (4, 2))
+        self.assertEqual(stats['report_renders_saved_by_view'],
+                         {'dashboard': 2, 'transaction_list': 0, 'inventory_summary': 0})
+
+    def test_stats_are_staff_only(self):
+        response = self.client.get(reverse('ping_session_stats'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.stats()['pings'], 0)
+
+    def test_expired_session_gets_json_not_a_redirect(self):
+        session = self.client.session
+        session['last_activity'] = datetime.now(timezone.utc).timestamp() - 86400
+        session.save()
+        response = self.client.get(reverse('ping_session'), {'page': reverse('dashboard')})
+        self.assertEqual((response.status_code, response.json()), (401, {'status': 'expired'}))
+        self.assertNotIn('_auth_user_id', self.client.session)
+
+        response = self.client.get(reverse('ping_session'))
+        self.assertEqual((response.status_code, response.json()), (401, {'status': 'expired'}))
+        self.assertEqual(self.stats()['pings'], 0)
+
+
+@override_settings(SESSION_IDLE_TIMEOUT=900, SESSION_ACTIVITY_GRANULARITY=60)
+class SessionTimeoutMiddlewareTests(TestCase):
+    NOW = 1_700_000_000.0
+
+    def setUp(self):
+        self.user = User.objects.create_user('idler')
+        self.session = SessionStore()
+        self.middleware = SessionTimeoutMiddleware(lambda request: HttpResponse('ok'))
+
+    def request(self, now, path='/'):
+        request = RequestFactory().get(path)
+        request.user = self.user
+        request.session = self.session
+        request._messages = FallbackStorage(request)
+        self.session.modified = False
+        with mock.patch('stock_manager.middleware.datetime') as clock:
+            clock.datetime.utcnow.return_value.timestamp.return_value = now
+            return request, self.middleware(request)
+
+    def test_requests_within_the_granularity_leave_the_session_unmodified(self):
+        request, _ = self.request(self.NOW)
+        self.assertTrue(request.session.modified)
+        request, _ = self.request(self.NOW + 59)
+        self.assertFalse(request.session.modified)
+        self.assertEqual(self.session['last_activity'], self.NOW)
+
+    def test_request_past_the_granularity_writes_the_session(self):
+        self.request(self.NOW)
+        request, _ = self.request(self.NOW + 60)
+        self.assertTrue(request.session.modified)
+        self.assertEqual(self.session['last_activity'], self.NOW + 60)
+
+    def test_not_logged_out_within_the_idle_timeout(self):
+        self.request(self.NOW)
+        request, response = self.request(self.NOW + 900)
+        self.assertEqual(response.content, b'ok')
+        self.assertTrue(request.user.is_authenticated)
+
+    def test_logged_out_once_the_idle_timeout_passes(self):
+        self.request(self.NOW)
+        request, response = self.request(self.NOW + 901)
+        self.assertRedirects(response, reverse('login'), fetch_redirect_response=False)
+        self.assertIsInstance(request.user, AnonymousUser)
+
+        self.session['last_activity'] = self.NOW
+        request, response = self.request(self.NOW + 901, path=reverse('ping_session'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_unstored_activity_can_only_bring_the_logout_forward(self):
+        # The request at +59 is not stored, so the cutoff runs from the first
+        self.request(self.NOW)
+        self.request(self.NOW + 59)
+        request, response = self.request(self.NOW + 901)
+        self.assertEqual(response.status_code, 302)
+        self.assertIsInstance(request.user, AnonymousUser)
+
+
+@override_settings(AUDIT_ASYNC=True)
+class AuditWriterTests(TransactionTestCase):
+    def setUp(self):
+        self.writer = audit.AuditWriter(batch_size=3, flush_interval=60, queue_size=100)
+        patcher = mock.patch.object(audit, 'writer', self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.writer.stop)
+
+    def entries(self, count):
+        return [
+            AuditLog(timestamp=datetime.now(timezone.utc), action=audit.CREATE, model_name='purchase',
+                     object_id=i, description=f'Entry {i}')
+            for i in range(count)
+        ]
+
+    def wait_for_rows(self, count, seconds=5):
+        deadline = time.monotonic() + seconds
+        while AuditLog.objects.count() < count and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return AuditLog.objects.count()
+
+    def test_full_batch_is_written_without_waiting_for_the_interval(self):
+        self.writer.put(self.entries(4))
+        self.assertEqual(self.wait_for_rows(3), 3)
+        # The fourth waits for the next batch or the interval
+        time.sleep(0.2)
+        self.assertEqual(AuditLog.objects.count(), 3)
+        self.writer.flush()
+        self.assertEqual(AuditLog.objects.count(), 4)
+        self.writer.put(self.entries(1))
+        self.writer.stop()
+        self.assertEqual(AuditLog.objects.count(), 5)
+
+    def test_partial_batch_is_written_after_the_interval(self):
+        self.writer.flush_interval = 0.2
+        self.writer.put(self.entries(1))
+        self.assertEqual(AuditLog.objects.count(), 0)
+        self.assertEqual(self.wait_for_rows(1), 1)
+
+    def test_entries_are_queued_on_commit_and_dropped_on_rollback(self):
+        with transaction.atomic():
+            StockTransaction.objects.create(stock_code='AUD1', stock_description='Item', uom='ea')
+            self.assertIsNone(self.writer._queue)
+        self.writer.flush()
+        self.assertEqual(list(AuditLog.objects.values_list('action', 'model_name')),
+                         [(audit.CREATE, 'stocktransaction')])
+
+        with self.assertRaises(ValueError), transaction.atomic():
+            StockTransaction.objects.create(stock_code='AUD2', stock_description='Item', uom='ea')
+            raise ValueError
+        self.writer.flush()
+        self.assertEqual(AuditLog.objects.count(), 1)
+
+    @override_settings(AUDIT_ASYNC=False)
+    def test_synchronous_mode_writes_on_commit_without_the_writer(self):
+        with transaction.atomic():
+            StockTransaction.objects.create(stock_code='AUD1', stock_description='Item', uom='ea')
+            self.assertEqual(AuditLog.objects.count(), 0)
+        self.assertEqual(AuditLog.objects.count(), 1)
+        self.assertIsNone(self.writer._thread)
+
+    def test_rows_are_attributed_to_the_request_user(self):
+        user = User.objects.create_user('clerk')
+
+        def view(request):
+            StockTransaction.objects.create(stock_code='AUD1', stock_description='Item', uom='ea')
+            return HttpResponse('ok')
+
+        request = RequestFactory().get('/')
+        request.user = user
+        AuditUserMiddleware(view)(request)
+        StockTransaction.objects.create(stock_code='AUD2', stock_description='Item', uom='ea')
+        self.writer.flush()
+        self.assertEqual(dict(AuditLog.objects.values_list('description', 'user')),
+                         {'AUD1 - Item (ea)': user.pk, 'AUD2 - Item (ea)': None})
+
+
+class AuditArchiveTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.user = User.objects.create_user('auditor')
+        # Two in January, three in February, one kept
+        stamps = [datetime(2024, 1, 30, tzinfo=timezone.utc), datetime(2024, 1, 31, 23, 59, tzinfo=timezone.utc),
+                  datetime(2024, 2, 1, tzinfo=timezone.utc), datetime(2024, 2, 2, tzinfo=timezone.utc),
+                  datetime(2024, 2, 3, tzinfo=timezone.utc), datetime(2024, 6, 1, tzinfo=timezone.utc)]
+        AuditLog.objects.bulk_create(
+            AuditLog(timestamp=stamp, user=self.user if i % 2 else None, action=audit.UPDATE if i % 3 else audit.CREATE,
+                     model_name='purchase', object_id=i, description=f'Entry {i}')
+            for i, stamp in enumerate(stamps)
+        )
+        self.cutoff = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+    def archived_ids(self, **filters):
+        return [row['object_id'] for row in read_archive(self.directory, **filters)]
+
+    def test_rows_move_to_one_file_per_month(self):
+        self.assertEqual(archive_audit_log(self.cutoff, self.directory, batch_size=2), 5)
+        self.assertEqual([month.month for month in archive_months(self.directory)], [1, 2])
+        self.assertEqual(list(AuditLog.objects.values_list('object_id', flat=True)), [5])
+        self.assertEqual(self.archived_ids(), [0, 1, 2, 3, 4])
+        row = next(read_archive(self.directory))
+        self.assertEqual((row['timestamp'], row['description']), (datetime(2024, 1, 30, tzinfo=timezone.utc), 'Entry 0'))
+
+    def test_batch_archived_twice_is_read_once(self):
+        # The first batch reaches the file but the run fails before deleting it
+        with mock.patch('stock_manager.audit_archive.transaction.atomic', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                archive_audit_log(self.cutoff, self.directory, batch_size=3)
+        self.assertEqual(AuditLog.objects.count(), 6)
+
+        self.assertEqual(archive_audit_log(self.cutoff, self.directory, batch_size=3), 5)
+        self.assertEqual(self.archived_ids(), [0, 1, 2, 3, 4])
+
+    def test_filters(self):
+        archive_audit_log(self.cutoff, self.directory)
+        self.assertEqual(self.archived_ids(start=datetime(2024, 1, 31, tzinfo=timezone.utc),
+                                           end=datetime(2024, 2, 2, tzinfo=timezone.utc)), [1, 2])
+        self.assertEqual(self.archived_ids(user_id=self.user.pk), [1, 3])
+        self.assertEqual(self.archived_ids(action=audit.CREATE), [0, 3])
+        self.assertEqual(self.archived_ids(model_name='sale'), [])
+        self.assertEqual(self.archived_ids(object_id=4), [4])
+
+    def test_dry_run_counts_without_moving_anything(self):
+        self.assertEqual(archive_audit_log(self.cutoff, self.directory, dry_run=True), 5)
+        self.assertEqual(AuditLog.objects.count(), 6)
+        self.assertEqual(archive_months(self.directory), {})
+
+
+@override_settings(AUDIT_ASYNC=False)
+class SeedStockDataTests(TestCase):
+    OPTIONS = {'skus': 15, 'years': 0.2, 'documents_per_day': 2, 'lines_per_document': 3, 'count_sessions': 3}
+
+    def seed(self, **options):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('seed_stock_data', flush=True, stdout=io.StringIO(), **self.OPTIONS, **options)
+
+    def data(self):
+        """Everything seeded, by natural keys, since ids move on between runs."""
+        return {
+            'stock': list(StockTransaction.objects.order_by('stock_code').values_list(
+                'stock_code', 'stock_description', 'uom', 'search_key', 'last_cost')),
+            'purchases': list(Purchase.objects.order_by('document_number', 'stock_code__stock_code').values_list(
+                'document_number', 'document__document_number', 'transaction_date', 'stock_code__stock_code',
+                'quantity', 'price_per_unit', 'supplier_name')),
+            'sales': list(Sale.objects.order_by('document_number', 'stock_code__stock_code').values_list(
+                'document_number', 'document__total_value', 'transaction_date', 'stock_code__stock_code',
+                'quantity', 'price_per_unit', 'customer_name')),
+            'counts': list(StockCountEntry.objects.order_by('session__date', 'stock_code__stock_code').values_list(
+                'session__date', 'stock_code__stock_code', 'quantity_counted', 'adjustment__variance_value')),
+            'balances': list(StockDailyBalance.objects.order_by('stock_code__stock_code', 'date').values_list(
+                'stock_code__stock_code', 'date', 'closing_quantity')),
+            'costs': list(StockCostBalance.objects.order_by('stock_code__stock_code', 'date').values_list(
+                'stock_code__stock_code', 'date', 'value')),
+        }
+
+    def test_same_seed_same_data(self):
+        self.seed()
+        first = self.data()
+        self.assertTrue(all(first.values()))
+        self.assertEqual(first['purchases'][-1][2], date(2025, 12, 31))
+
+        self.seed()
+        self.assertEqual(self.data(), first)
+        self.seed(seed=7)
+        self.assertNotEqual(self.data(), first)
+
+    def test_end_date_anchors_the_history(self):
+        self.seed(end_date=date(2024, 6, 30))
+        self.assertEqual(Purchase.objects.aggregate(last=Max('transaction_date'))['last'], date(2024, 6, 30))
+
+    def test_sale_sequence_is_left_alone(self):
+        before = next_document_number('sale')
+        self.seed()
+        self.seed()
+        self.assertEqual(int(next_document_number('sale')[4:]), int(before[4:]) + 1)
+
+    def test_seeded_rows_are_audited_and_stale_snapshots_dropped(self):
+        cache = caches['default']
+        flushed_month, seeded_month = SNAPSHOT_KEY.format(date(2024, 6, 1)), SNAPSHOT_KEY.format(date(2025, 12, 1))
+        self.seed(end_date=date(2024, 6, 30))
+        cache.set_many({flushed_month: {}, seeded_month: {}})
+
+        self.seed()
+        self.assertIsNone(cache.get(flushed_month))
+        self.assertIsNone(cache.get(seeded_month))
+        audited = dict(AuditLog.objects.filter(action=audit.CREATE).values_list('model_name').annotate(n=Count('id')))
+        self.assertEqual(audited, {
+            'stocktransaction': 30, 'purchase': 2 * Purchase.objects.count(), 'sale': 2 * Sale.objects.count(),
+            'stockcountsession': 6, 'stockcountentry': 2 * StockCountEntry.objects.count(),
+        })
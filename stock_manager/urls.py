@@ -15,12 +15,22 @@ urlpatterns = [
     path('logout/', auth_views.LogoutView.as_view(next_page='landing'), name='logout'),
     path('registration/pending/', registration_pending_view, name='registration_pending'),
     path('dashboard/', views.dashboard, name='dashboard'),
+    path('dashboard/cache-stats/', views.dashboard_cache_stats, name='dashboard_cache_stats'),
     path('transaction/add/', views.add_transaction, name='add_transaction'),
     path('purchase/add/', views.add_purchase, name='add_purchases'),
     path('sale/add/', views.add_sale, name='add_sales'),
+    path('stock/lookup/', views.stock_lookup, name='stock_lookup'),
+    path('import/', views.import_data, name='import_data'),
     path('count/session/add/', views.add_stock_count_session, name='add_stock_count_session'),
+    path('count/uploads/', views.count_upload_start, name='count_upload_start'),
+    path('count/uploads/<int:session_id>/', views.count_upload_status, name='count_upload_status'),
+    path('count/uploads/<int:session_id>/chunks/<str:chunk_id>/', views.count_upload_chunk,
+         name='count_upload_chunk'),
     path('transactions/', views.transaction_list, name='transaction_list'),
+    path('transactions/export/<str:file_format>/', views.export_transaction_list, name='export_transaction_list'),
     path('inventory_summary/', views.inventory_summary, name='inventory_summary'),
+    path('inventory_summary/export/<str:file_format>/', views.export_inventory_summary,
+         name='export_inventory_summary'),
     path('audit-log/', audit_log_view, name='audit_log'),
     path('sales/receipt/<str:document_number>/', views.sale_receipt, name='sale_receipt'),
     path('purchases/invoice/<str:document_number>/', views.purchase_invoice, name='purchase_invoice'),
@@ -30,6 +40,7 @@ urlpatterns = [
     path('reset/done/', auth_views.PasswordResetCompleteView.as_view(), name='password_reset_complete'),
     path('logout/', auth_views.LogoutView.as_view(next_page='landing'), name='logout'),
     path('ping-session/', ping_session, name='ping_session'),
+    path('ping-session/stats/', views.ping_session_stats, name='ping_session_stats'),
     path('help/', help_page, name='help_page'),
 
 
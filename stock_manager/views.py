@@ -1,21 +1,48 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.models import User
 from .forms import StockTransactionForm, PurchaseForm, SaleForm
 from django.forms import modelformset_factory, formset_factory
 from .forms import StockCountSessionForm, StockCountEntryForm, PurchaseHeaderForm, PurchaseLineForm, SaleHeaderForm, SaleLineForm
-from .models import StockTransaction, Purchase, Sale, StockCountEntry, AuditLog
+from .models import (
+    StockTransaction, Purchase, PurchaseDocument, Sale, SaleDocument, StockCostBalance, StockCountChunk,
+    StockCountEntry, StockCountSession, AuditLog,
+)
+from .ledger import (
+    build_stock_ledger, count_variance, ledger_annotations, ledger_valuation, movement_trend, stock_position,
+)
+from . import audit, count_batches
+from .costing import costing_method
+from .dashboard_cache import cache_stats, get_snapshot
+from .exports import EXPORT_FORMATS, export_response
+from .imports import IMPORT_COLUMNS, import_csv
+from .keepalive import keepalive_stats, record_ping
+from .pagination import InvalidCursor, KeysetPaginator
+from .services import post_purchase_document, post_sale_document, post_stock_count
+from .search import search_filter, search_stock
+from .stock_cache import SEARCH_LIMIT
 from django.core.paginator import Paginator
-from django.db.models import Sum, Max, Q, F, ExpressionWrapper, DecimalField, Value, OuterRef, Subquery
+from django.db.models import Sum, Max, F, ExpressionWrapper, DecimalField, Value, OuterRef, Subquery, Window
+from django.db.models.functions import RowNumber
 from django.db.models.functions import Coalesce
-from datetime import date, timedelta, datetime
+from datetime import date, time, timedelta, datetime
 from django.utils.dateparse import parse_date
+from django.utils import timezone
 from django.utils.timezone import now
+import csv
+import io
+import json
 import logging
 from decimal import Decimal
 import calendar
+from itertools import islice
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import Http404, JsonResponse
+from django.middleware.csrf import get_token
+from django.views.decorators.http import require_GET, require_POST
+from functools import wraps
+from django.core.exceptions import ValidationError
  
 
 @login_required
@@ -23,13 +50,108 @@ def dashboard_view(request):
     return render(request, 'dashboard.html')
 
 
+STOCK_LOOKUP_MAX_LIMIT = 50
+
+
 @login_required
+def stock_lookup(request):
+    """Ranked typeahead suggestions for stock code inputs (see search.py)."""
+    try:
+        limit = min(max(int(request.GET.get('limit', SEARCH_LIMIT)), 1), STOCK_LOOKUP_MAX_LIMIT)
+    except ValueError:
+        limit = SEARCH_LIMIT
+    return JsonResponse({'results': search_stock(request.GET.get('q', ''), limit)})
+
+
 def ping_session(request):
-    # Just touches the session to reset expiry
-    request.session.modified = True
+    """
+    Keep-alive for the session-timeout script.  SessionTimeoutMiddleware has
+    already recorded the activity, so this only answers: no template, no
+    report queries and no messages.  An expired session gets a 401 rather
+    than a redirect to the login page.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'status': 'expired'}, status=401)
+    record_ping(request.GET.get('page'))
     return JsonResponse({'status': 'ok'})
 
 
+@staff_member_required
+def ping_session_stats(request):
+    return JsonResponse(keepalive_stats())
+
+
+def json_login_required(view):
+    """Like login_required, but answers 401 instead of redirecting to the login page."""
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Not logged in.'}, status=401)
+        return view(request, *args, **kwargs)
+    return wrapped
+
+
+COUNT_UPLOAD_ERRORS_SHOWN = 500
+
+
+@json_login_required
+@require_POST
+def count_upload_start(request):
+    """
+    Open a count session for a scanner upload: ``{"date": "YYYY-MM-DD"}``.
+
+    These are session-authenticated POSTs, so like any form they need the
+    CSRF token, sent in the ``X-CSRFToken`` header: the ``csrftoken`` cookie
+    set by the login page for this request, and ``csrf_token`` in the reply
+    for the chunks that follow.
+    """
+    try:
+        count_date = parse_date(json.loads(request.body).get('date') or '')
+    except (ValueError, AttributeError):
+        count_date = None
+    if count_date is None:
+        return JsonResponse({'error': 'Expected {"date": "YYYY-MM-DD"}.'}, status=400)
+    session = StockCountSession.objects.create(date=count_date)
+    return JsonResponse({**count_batches.chunk_status(session), 'csrf_token': get_token(request)}, status=201)
+
+
+@json_login_required
+@require_GET
+def count_upload_status(request, session_id):
+    session = get_object_or_404(StockCountSession, pk=session_id)
+    return JsonResponse(count_batches.chunk_status(session))
+
+
+@json_login_required
+@require_POST
+def count_upload_chunk(request, session_id, chunk_id):
+    """
+    Post one chunk of scanner lines, JSON or CSV (see count_batches.py).
+    Sending the same ``chunk_id`` again is safe and answers ``duplicate``.
+    """
+    if len(chunk_id) > StockCountChunk._meta.get_field('chunk_id').max_length:
+        return JsonResponse({'error': 'Chunk id too long.'}, status=400)
+    try:
+        lines = count_batches.parse_lines(request.body, request.content_type)
+        result = count_batches.post_chunk(session_id, chunk_id, lines)
+    except StockCountSession.DoesNotExist:
+        raise Http404("No such count session.")
+    except ValidationError as e:
+        return JsonResponse({'error': ' '.join(e.messages)}, status=400)
+
+    return JsonResponse({
+        'chunk_id': result.chunk_id,
+        'status': 'duplicate' if result.duplicate else 'posted',
+        'lines_received': result.lines_received,
+        'lines_rejected': result.lines_rejected,
+        'entries_created': result.entries_created,
+        'entries_updated': result.entries_updated,
+        'errors': [
+            {'line': line, 'error': error} for line, error in result.errors[:COUNT_UPLOAD_ERRORS_SHOWN]
+        ],
+    })
+
+
 
 def register_view(request):
     if request.method == 'POST':
@@ -54,31 +176,93 @@ def registration_pending_view(request):
 def landing_view(request):
     return render(request, 'landing.html')
 
+AUDIT_PAGE_SIZE = 100
+AUDIT_MAX_PAGE_SIZE = 500
+AUDIT_ACTIONS = (audit.CREATE, audit.UPDATE, audit.DELETE)
+
+
+def _date_param(request, name):
+    try:
+        return parse_date(request.GET.get(name) or '')
+    except ValueError:
+        return None
+
+
+def audit_log_filters(request):
+    """
+    ``(filters, logs)`` from the audit log's GET parameters.  Each filter is
+    an equality or a timestamp range, so with the (…, timestamp, id) indexes
+    on AuditLog a page is one index range scan however large the table is.
+    Values that do not parse are dropped.
+    """
+    filters = {
+        'user': request.GET.get('user', ''),
+        'action': request.GET.get('action', ''),
+        'model_name': request.GET.get('model_name', ''),
+        'object_id': request.GET.get('object_id', '').strip(),
+        'start_date': _date_param(request, 'start_date'),
+        'end_date': _date_param(request, 'end_date'),
+    }
+
+    logs = AuditLog.objects.select_related('user', 'session')
+    if filters['user'].isdigit():
+        logs = logs.filter(user_id=int(filters['user']))
+    else:
+        filters['user'] = ''
+    if filters['action'] in AUDIT_ACTIONS:
+        logs = logs.filter(action=filters['action'])
+    else:
+        filters['action'] = ''
+    if filters['model_name'] in audit.AUDITED_MODEL_NAMES:
+        logs = logs.filter(model_name=filters['model_name'])
+    else:
+        filters['model_name'] = ''
+    if filters['object_id'].isdigit():
+        logs = logs.filter(object_id=int(filters['object_id']))
+    else:
+        filters['object_id'] = ''
+
+    # Whole local days, as a range on the indexed column rather than __date
+    tz = timezone.get_current_timezone()
+    if filters['start_date']:
+        logs = logs.filter(timestamp__gte=datetime.combine(filters['start_date'], time.min, tzinfo=tz))
+    if filters['end_date']:
+        logs = logs.filter(timestamp__lt=datetime.combine(filters['end_date'] + timedelta(days=1), time.min, tzinfo=tz))
+    return filters, logs
+
+
+@login_required
 def audit_log_view(request):
-    logs = AuditLog.objects.order_by('-timestamp')[:100]  # Limit to recent 100
-    return render(request, 'audit_log.html', {'logs': logs})
+    filters, logs = audit_log_filters(request)
+    try:
+        page_size = min(max(int(request.GET.get('page_size', AUDIT_PAGE_SIZE)), 1), AUDIT_MAX_PAGE_SIZE)
+    except ValueError:
+        page_size = AUDIT_PAGE_SIZE
+
+    paginator = KeysetPaginator(logs, ['-timestamp', '-id'], page_size)
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        page = paginator.page()
+
+    return render(request, 'audit_log.html', {
+        'page': page,
+        'filters': filters,
+        'page_size': page_size,
+        'users': User.objects.order_by('username').values_list('pk', 'username'),
+        'actions': AUDIT_ACTIONS,
+        'model_names': audit.AUDITED_MODEL_NAMES,
+        'active_tab': 'audit',
+    })
 
 
-def generate_document_number():
-    last_sale = Sale.objects.order_by('-id').first()
-    next_id = last_sale.id + 1 if last_sale else 1
-    return f"SAL-{next_id:06d}"
-    
-def get_previous_day(date_input):
-    if isinstance(date_input, str):
-        date_input = date.fromisoformat(date_input)
-    return date_input - timedelta(days=1)
+def line_value_expr():
+    return ExpressionWrapper(F('quantity') * F('price_per_unit'), output_field=DecimalField())
+
 
 def get_net_quantity(movements, types):
     return movements.filter(transaction_type__in=types).aggregate(Sum('transaction_quantity'))['transaction_quantity__sum'] or 0
 
-def get_latest_purchase_price(stock, up_to_date):
-    latest = Purchase.objects.filter(
-        stock_code=stock,
-        transaction_date__lte=up_to_date
-    ).order_by('-transaction_date').first()
-    return latest.price_per_unit if latest and latest.price_per_unit else 0
-
 
 def add_transaction(request):
     if request.method == 'POST':
@@ -105,28 +289,27 @@ def add_purchase(request):
 
         if header_form.is_valid() and formset.is_valid():
             header_data = header_form.cleaned_data
-            document_number = header_data['document_number']  # ✅ Use user input
-
-            
-
-            for form in formset:
-                if form.cleaned_data:
-                    quantity = form.cleaned_data['quantity']
-                    price = form.cleaned_data['price_per_unit']
-                    total_value += quantity * price
-
-                    Purchase.objects.create(
-                        transaction_date=header_data['transaction_date'],
-                        supplier_name=header_data['supplier_name'],
-                        document_number=document_number,
-                        stock_code=form.cleaned_data['stock_code'],
-                        quantity=quantity,
-                        price_per_unit=price
-                    )
-
-            messages.success(request, f"Purchases recorded under document number {document_number}. Total value: {total_value:.2f}")
 
-            return redirect('purchase_invoice', document_number=document_number)
+            lines = [
+                form.cleaned_data for form in formset
+                if form.cleaned_data and not form.cleaned_data.get('DELETE')
+            ]
+
+            try:
+                document = post_purchase_document(
+                    transaction_date=header_data['transaction_date'],
+                    supplier_name=header_data['supplier_name'],
+                    document_number=header_data['document_number'],  # ✅ Use user input, if any
+                    lines=lines,
+                )
+            except ValidationError as e:
+                for error in e.messages:
+                    header_form.add_error(None, error)
+            else:
+                document_number = document.document_number
+                messages.success(request, f"Purchases recorded under document number {document_number}. Total value: {document.total_value:.2f}")
+
+                return redirect('purchase_invoice', document_number=document_number)
     else:
         header_form = PurchaseHeaderForm()
         formset = LineFormSet()
@@ -141,19 +324,14 @@ def add_purchase(request):
 
 
 def purchase_invoice(request, document_number):
-    purchases = Purchase.objects.filter(document_number=document_number)
-    if not purchases.exists():
-        return HttpResponseNotFound("Invoice not found.")
-
-    header = purchases.first()
-    total_qty = sum(p.quantity for p in purchases)
-    total_value = sum(p.quantity * p.price_per_unit for p in purchases)
+    header = get_object_or_404(PurchaseDocument, document_number=document_number)
+    purchases = header.lines.select_related('stock_code').annotate(line_value=line_value_expr()).order_by('id')
 
     return render(request, 'purchase_invoice.html', {
         'purchases': purchases,
         'header': header,
-        'total_qty': total_qty,
-        'total_value': total_value,
+        'total_qty': header.total_quantity,
+        'total_value': header.total_value,
         'active_tab': 'purchases',
     })
 
@@ -173,28 +351,26 @@ def add_sale(request):
 
         if header_form.is_valid() and formset.is_valid():
             header_data = header_form.cleaned_data
-            document_number = generate_document_number()
-
-            total_value = Decimal('0.00')
 
-            for form in formset:
-                if form.cleaned_data:
-                    quantity = form.cleaned_data['quantity']
-                    price = form.cleaned_data['price_per_unit']
-                    total_value += quantity * price
+            lines = [
+                form.cleaned_data for form in formset
+                if form.cleaned_data and not form.cleaned_data.get('DELETE')
+            ]
 
-                    Sale.objects.create(
-                        transaction_date=header_data['transaction_date'],
-                        customer_name=header_data['customer_name'],
-                        document_number=document_number,
-                        stock_code=form.cleaned_data['stock_code'],
-                        quantity=quantity,
-                        price_per_unit=price
-                    )
-
-            messages.success(request, f"Sales recorded under document number {document_number}. Total value: {total_value:.2f}")
+            try:
+                document = post_sale_document(
+                    transaction_date=header_data['transaction_date'],
+                    customer_name=header_data['customer_name'],
+                    lines=lines,
+                )
+            except ValidationError as e:
+                for error in e.messages:
+                    header_form.add_error(None, error)
+            else:
+                document_number = document.document_number
+                messages.success(request, f"Sales recorded under document number {document_number}. Total value: {document.total_value:.2f}")
 
-            return redirect('sale_receipt', document_number=document_number)
+                return redirect('sale_receipt', document_number=document_number)
 
     else:
         header_form = SaleHeaderForm()
@@ -210,39 +386,19 @@ def add_sale(request):
 
 
 def sale_receipt(request, document_number):
-    sales = Sale.objects.filter(document_number=document_number)
-    if not sales.exists():
-        return HttpResponseNotFound("Receipt not found.")
-
-    header = sales.first()
-    total_qty = sum(s.quantity for s in sales)
-    total_value = sum(s.quantity * s.price_per_unit for s in sales)
+    header = get_object_or_404(SaleDocument, document_number=document_number)
+    sales = header.lines.select_related('stock_code').annotate(line_value=line_value_expr()).order_by('id')
 
     return render(request, 'sale_receipt.html', {
         'sales': sales,
         'header': header,
-        'total_qty': total_qty,
-        'total_value': total_value,
+        'total_qty': header.total_quantity,
+        'total_value': header.total_value,
         'active_tab': 'sales',
     })
 
 
 
-def get_stock_on_hand(stock, count_date):
-    previous_day = get_previous_day(count_date)
-
-    purchases = Purchase.objects.filter(
-        stock_code=stock,
-        transaction_date__lte=previous_day
-    ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-
-    sales = Sale.objects.filter(
-        stock_code=stock,
-        transaction_date__lte=previous_day
-    ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-
-    return purchases - sales
-
 def add_stock_count_session(request):
     EntryFormSet = modelformset_factory(StockCountEntry, form=StockCountEntryForm, extra=1, can_delete=True)
 
@@ -251,35 +407,19 @@ def add_stock_count_session(request):
         formset = EntryFormSet(request.POST, queryset=StockCountEntry.objects.none())
 
         if session_form.is_valid() and formset.is_valid():
-            session = session_form.save()
-            count_date = session.date
-
-            for form in formset:
-                if form.cleaned_data:
-                    stock = form.cleaned_data.get('stock_code')
-                    qty = form.cleaned_data.get('quantity_counted')
-
-                    if stock and qty is not None and str(qty).strip() != '':
-                        entry = form.save(commit=False)
-                        entry.session = session
-                        entry.save()
-
-                        # ✅ Always update stock on hand
-                        system_qty = get_stock_on_hand(stock, count_date)
-                        variance = qty - system_qty
-
-                        if variance != 0:
-                            latest_purchase = Purchase.objects.filter(
-                                stock_code=stock,
-                                transaction_date__lte=count_date
-                            ).order_by('-transaction_date').first()
-
-                            price = get_latest_purchase_price(stock, count_date)
-
-
-                            # price = latest_purchase.price_per_unit if latest_purchase and latest_purchase.price_per_unit else 0
-
-            return redirect('add_stock_count_session')
+            entries = [
+                form.cleaned_data for form in formset
+                if form.cleaned_data and not form.cleaned_data.get('DELETE')
+                and form.cleaned_data.get('stock_code') and form.cleaned_data.get('quantity_counted') is not None
+            ]
+
+            try:
+                post_stock_count(session_form.cleaned_data['date'], entries)
+            except ValidationError as e:
+                for error in e.messages:
+                    session_form.add_error(None, error)
+            else:
+                return redirect('add_stock_count_session')
     else:
         session_form = StockCountSessionForm()
         formset = EntryFormSet(queryset=StockCountEntry.objects.none())
@@ -294,7 +434,47 @@ def add_stock_count_session(request):
 
 # Create the list view
 
-def transaction_list(request):
+# (sort key, column heading, annotations ordered on); the "missing" flags
+# keep rows without a count or without movements at the end
+LEDGER_COLUMNS = [
+    ('stock_code', 'Stock Code', []),
+    ('description', 'Description', ['stock_description']),
+    ('opening_quantity', 'Opening Quantity', ['opening_quantity']),
+    ('purchase_quantity', 'Purchase Quantity', ['purchase_quantity']),
+    ('sales_quantity', 'Sales Quantity', ['sales_quantity']),
+    ('variance', 'Variance', ['variance_missing', 'variance']),
+    ('quantity_on_hand', 'Stock on Hand', ['quantity_on_hand']),
+    ('latest_price', 'Latest Purchase Price', ['latest_price']),
+    ('valuation', 'Inventory Valuation', ['valuation']),
+    ('transaction_date', 'Last Transaction Date', ['movement_missing', 'last_movement']),
+]
+LEDGER_PAGE_SIZE = 50
+LEDGER_MAX_PAGE_SIZE = 500
+
+# SKUs or count entries read per round-trip when streaming exports
+EXPORT_CHUNK_SIZE = 500
+
+
+def ledger_ordering(sort, descending, start_date, end_date):
+    """Annotations and keyset ordering for sorting the ledger by ``sort``."""
+    keys = next((keys for key, _, keys in LEDGER_COLUMNS if key == sort), [])
+    available = ledger_annotations(start_date, end_date)
+    annotations = {name: available[name] for name in keys if name in available}
+    sign = '-' if descending else ''
+    ordering = [
+        name if name.endswith('_missing') else sign + name
+        for name in keys
+    ]
+    # stock_code is unique, which makes every row's position distinct
+    return annotations, ordering + [sign + 'stock_code']
+
+
+def ledger_filters(request):
+    """
+    ``(start_date, end_date, search_query, stock_items)`` from the stock
+    ledger's GET parameters.  Dates that are missing or do not parse fall
+    back to the financial year, March to February.
+    """
     today = date.today()
     current_year = today.year
 
@@ -302,187 +482,74 @@ def transaction_list(request):
     default_end = date(current_year + 1, 2, 28)
 
     # --- DATE HANDLING ---
-    start_date_param = request.GET.get('start_date')
-    end_date_param = request.GET.get('end_date')
-    start_date = parse_date(start_date_param) if start_date_param else default_start
-    end_date = parse_date(end_date_param) if end_date_param else default_end
+    start_date = _date_param(request, 'start_date') or default_start
+    end_date = _date_param(request, 'end_date') or default_end
 
     # --- SEARCH HANDLING ---
     search_query = request.GET.get('search')
     if search_query in [None, '', 'None']:
         search_query = None
 
-    transactions = []
-
-    # helper: safely sum qty
-    def qty_sum(qs):
-        return qs.aggregate(total=Sum('quantity'))['total'] or Decimal('0')
-
     stock_items = StockTransaction.objects.all()
     if search_query:
-        stock_items = stock_items.filter(
-            Q(stock_code__icontains=search_query) |
-            Q(stock_description__icontains=search_query)
-        )
-
-    previous_day = start_date - timedelta(days=1)
+        stock_items = stock_items.filter(search_filter(search_query))
+    return start_date, end_date, search_query, stock_items
 
-    total_valuation = Decimal('0.00')
-
-    for stock in stock_items:
-        # --- Opening Quantity (respect last prior count) ---
-        latest_prior_count = StockCountEntry.objects.filter(
-            stock_code=stock,
-            session__date__lt=start_date
-        ).order_by('-session__date').first()
-
-        
-
-
-        if latest_prior_count:
-            count_date = latest_prior_count.session.date
-            opening_quantity = latest_prior_count.quantity_counted
-
-            purchases_after_count = qty_sum(
-                Purchase.objects.filter(
-                    stock_code=stock,
-                    transaction_date__gt=count_date,
-                    transaction_date__lte=previous_day
-                )
-            )
-            sales_after_count = qty_sum(
-                Sale.objects.filter(
-                    stock_code=stock,
-                    transaction_date__gt=count_date,
-                    transaction_date__lte=previous_day
-                )
-            )
-            opening_quantity += purchases_after_count - sales_after_count
-        else:
-            opening_purchases = qty_sum(
-                Purchase.objects.filter(stock_code=stock, transaction_date__lte=previous_day)
-            )
-            opening_sales = qty_sum(
-                Sale.objects.filter(stock_code=stock, transaction_date__lte=previous_day)
-            )
-            opening_quantity = opening_purchases - opening_sales
-
-        # --- Movements in current period ---
-        purchases = qty_sum(
-            Purchase.objects.filter(
-                stock_code=stock,
-                transaction_date__gte=start_date,
-                transaction_date__lte=end_date
-            )
-        )
-        sales = qty_sum(
-            Sale.objects.filter(
-                stock_code=stock,
-                transaction_date__gte=start_date,
-                transaction_date__lte=end_date
-            )
-        )
-
-        # --- Latest purchase price ---
-        latest_purchase = Purchase.objects.filter(
-            stock_code=stock,
-            transaction_date__lte=end_date
-        ).order_by('-transaction_date').first()
-        latest_price = latest_purchase.price_per_unit if latest_purchase else Decimal('0')
-
-        # --- System stock before adjustment ---
-        # --- Default system quantity (before any count adjustment) ---
-        system_quantity = opening_quantity + purchases - sales
-        quantity_on_hand = system_quantity  # will be overwritten if count exists
-
-
-        # --- Variance (only if count exists in this filter window) ---
-        latest_count_entry = StockCountEntry.objects.filter(
-            stock_code=stock,
-            session__date__gte=start_date,
-            session__date__lte=end_date
-        ).order_by('-session__date', '-id').first()
-
-
-        if latest_count_entry:
-            count_date = latest_count_entry.session.date
-            counted_quantity = latest_count_entry.quantity_counted
-
-            # System quantity at the moment of count
-            purchases_to_count = qty_sum(
-                Purchase.objects.filter(
-                    stock_code=stock,
-                    transaction_date__gte=start_date,
-                    transaction_date__lte=count_date
-                )
-            )
-            sales_to_count = qty_sum(
-                Sale.objects.filter(
-                    stock_code=stock,
-                    transaction_date__gte=start_date,
-                    transaction_date__lte=count_date
-                )
-            )
-
-            system_qty_at_count = opening_quantity + purchases_to_count - sales_to_count
-            variance = counted_quantity - system_qty_at_count
-
-            # ✅ Counted quantity becomes new baseline
-            purchases_after_count = qty_sum(
-                Purchase.objects.filter(
-                    stock_code=stock,
-                    transaction_date__gt=count_date,
-                    transaction_date__lte=end_date
-                )
-            )
-            sales_after_count = qty_sum(
-                Sale.objects.filter(
-                    stock_code=stock,
-                    transaction_date__gt=count_date,
-                    transaction_date__lte=end_date
-                )
-            )
 
-            quantity_on_hand = counted_quantity + purchases_after_count - sales_after_count
-        else:
-            counted_quantity = None
-            variance = None
-
-
-
-        valuation = quantity_on_hand * latest_price
-        total_valuation += valuation
-
-        # --- Last movement date ---
-        latest_purchase_date = Purchase.objects.filter(stock_code=stock).aggregate(Max('transaction_date'))['transaction_date__max']
-        latest_sale_date = Sale.objects.filter(stock_code=stock).aggregate(Max('transaction_date'))['transaction_date__max']
-        latest_date = list(filter(None, [latest_purchase_date, latest_sale_date]))
-
-        transactions.append({
-            'stock_code': stock.stock_code,
-            'description': stock.stock_description,
-            'opening_quantity': opening_quantity,
-            'purchase_quantity': purchases,
-            'sales_quantity': sales,
-            'variance': variance,
-            'quantity_on_hand': quantity_on_hand,
-            'latest_price': latest_price,
-            'valuation': valuation,
-            'transaction_date': max(latest_date) if latest_date else None,
-        })
+def transaction_list(request):
+    start_date, end_date, search_query, stock_items = ledger_filters(request)
+
+    # --- SORTING AND PAGING ---
+    sort = request.GET.get('sort')
+    if sort not in {key for key, _, _ in LEDGER_COLUMNS}:
+        sort = 'stock_code'
+    descending = request.GET.get('dir') == 'desc'
+    try:
+        page_size = min(max(int(request.GET.get('page_size', LEDGER_PAGE_SIZE)), 1), LEDGER_MAX_PAGE_SIZE)
+    except ValueError:
+        page_size = LEDGER_PAGE_SIZE
+
+    annotations, ordering = ledger_ordering(sort, descending, start_date, end_date)
+    paginator = KeysetPaginator(stock_items.annotate(**annotations), ordering, page_size)
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        page = paginator.page()
+
+    # Ledger figures only for the SKUs on this page, in page order
+    page_ids = [stock.pk for stock in page]
+    rows, _ = build_stock_ledger(start_date, end_date, StockTransaction.objects.filter(pk__in=page_ids))
+    rows_by_code = {row['stock_code']: row for row in rows}
+    transactions = [rows_by_code[stock.stock_code] for stock in page]
+
+    columns = [
+        {
+            'key': key,
+            'label': label,
+            'active': key == sort,
+            'descending': key == sort and descending,
+            'next_dir': 'asc' if key == sort and descending else ('desc' if key == sort else 'asc'),
+        }
+        for key, label, _ in LEDGER_COLUMNS
+    ]
 
     return render(request, 'transaction_list.html', {
         'transactions': transactions,
+        'page': page,
+        'columns': columns,
+        'sort': sort,
+        'sort_dir': 'desc' if descending else 'asc',
+        'page_size': page_size,
         'search_query': search_query,
         'start_date': start_date,
         'end_date': end_date,
         'active_tab': 'transactions',
-        'total_valuation': total_valuation,
+        'total_valuation': ledger_valuation(end_date, stock_items),
     })
 
 
-def dashboard(request):
-    today = date.today()
+def build_dashboard_snapshot(today):
+    """Dashboard figures for the month containing ``today``."""
     current_month = today.month
     current_year = today.year
 
@@ -496,97 +563,25 @@ def dashboard(request):
     )
 
     # --- Opening Stock ---
-    opening_stock_qty = Decimal('0')
-    opening_value = Decimal('0')
-    stock_items = StockTransaction.objects.all()
-
-    for stock in stock_items:
-        # Get last count before current month
-        last_count = StockCountEntry.objects.filter(
-            stock_code=stock,
-            session__date__lt=first_day_of_month
-        ).order_by('-session__date').first()
-
-        if last_count:
-            count_date = last_count.session.date
-            counted_qty = last_count.quantity_counted
-
-            # Movements since count up to end of previous month
-            purchases_since = Purchase.objects.filter(
-                stock_code=stock,
-                transaction_date__gt=count_date,
-                transaction_date__lte=last_day_prev_month
-            ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-
-            sales_since = Sale.objects.filter(
-                stock_code=stock,
-                transaction_date__gt=count_date,
-                transaction_date__lte=last_day_prev_month
-            ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-
-            adjusted_qty = counted_qty + purchases_since - sales_since
-        else:
-            # Fallback to net movement
-            purchases = Purchase.objects.filter(
-                stock_code=stock,
-                transaction_date__lte=last_day_prev_month
-            ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-
-            sales = Sale.objects.filter(
-                stock_code=stock,
-                transaction_date__lte=last_day_prev_month
-            ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-
-            adjusted_qty = purchases - sales
-
-        latest_price = Purchase.objects.filter(
-            stock_code=stock,
-            transaction_date__lte=last_day_prev_month
-        ).order_by('-transaction_date').values_list('price_per_unit', flat=True).first() or 0
-
-        opening_stock_qty += adjusted_qty
-        opening_value += adjusted_qty * latest_price
-
-    monthly_counts = StockCountEntry.objects.filter(
-    session__date__month=current_month,
-    session__date__year=current_year
-)
+    opening_stock_qty, opening_value = stock_position(last_day_prev_month)
 
     # Variance for the month
-    total_variance_qty = Decimal('0')
-    for count in monthly_counts:
-        stock = count.stock_code
-        count_date = count.session.date
-        counted_qty = count.quantity_counted
-
-        purchases_to_date = Purchase.objects.filter(
-            stock_code=stock,
-            transaction_date__lte=count_date
-        ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-
-        sales_to_date = Sale.objects.filter(
-            stock_code=stock,
-            transaction_date__lte=count_date
-        ).aggregate(Sum('quantity'))['quantity__sum'] or 0
-
-        system_qty = purchases_to_date - sales_to_date
-        variance = counted_qty - system_qty
-        total_variance_qty += variance
+    last_day_of_month = date(current_year, current_month, calendar.monthrange(current_year, current_month)[1])
+    total_variance_qty = count_variance(first_day_of_month, last_day_of_month)
 
 
     # --- This Month Purchases ---
-    purchases_qs = Purchase.objects.filter(transaction_date__month=current_month, transaction_date__year=current_year)
+    purchases_qs = Purchase.objects.filter(transaction_date__range=(first_day_of_month, last_day_of_month))
     purchases_qty = purchases_qs.aggregate(Sum('quantity'))['quantity__sum'] or 0
     purchases_value = purchases_qs.annotate(value=value_expr).aggregate(Sum('value'))['value__sum'] or 0
 
     # --- This Month Sales ---
-    sales_qs = Sale.objects.filter(transaction_date__month=current_month, transaction_date__year=current_year)
+    sales_qs = Sale.objects.filter(transaction_date__range=(first_day_of_month, last_day_of_month))
     sales_qty = sales_qs.aggregate(Sum('quantity'))['quantity__sum'] or 0
     sales_value = sales_qs.annotate(value=value_expr).aggregate(Sum('value'))['value__sum'] or 0
 
     # --- Closing Balance ---
-    closing_balance_qty = opening_stock_qty + purchases_qty - sales_qty
-    closing_balance_value = opening_value + purchases_value - sales_value
+    closing_balance_qty, closing_balance_value = stock_position(last_day_of_month)
 
     # --- Top 5 Sales Items ---
     top_sales_items = (
@@ -603,18 +598,16 @@ def dashboard(request):
     )
 
     # --- Monthly Trend (last 6 months Purchases vs Sales) ---
-    trends = []
-    for i in range(5, -1, -1):  # last 6 months
-        month = (today.month - i - 1) % 12 + 1
-        year = today.year if today.month - i > 0 else today.year - 1
-        label = f"{calendar.month_abbr[month]} {year}"
-
-        m_purchases = Purchase.objects.filter(transaction_date__month=month, transaction_date__year=year).aggregate(Sum('quantity'))['quantity__sum'] or 0
-        m_sales = Sale.objects.filter(transaction_date__month=month, transaction_date__year=year).aggregate(Sum('quantity'))['quantity__sum'] or 0
-
-        trends.append({"month": label, "purchases": m_purchases, "sales": m_sales})
-
-    context = {
+    trends = [
+        {
+            "month": f"{calendar.month_abbr[row['period'].month]} {row['period'].year}",
+            "purchases": row['purchases'],
+            "sales": row['sales'],
+        }
+        for row in movement_trend(today, periods=6, granularity='month')
+    ]
+
+    return {
         'opening_stock': opening_stock_qty,
         'opening_value': opening_value,
         'purchases': purchases_qty,
@@ -624,131 +617,211 @@ def dashboard(request):
         'variance_qty': total_variance_qty,
         'closing_balance': closing_balance_qty,
         'closing_value': closing_balance_value,
-        'top_sales_items': top_sales_items,
-        'top_purchases_items': top_purchases_items,
+        'top_sales_items': list(top_sales_items),
+        'top_purchases_items': list(top_purchases_items),
         'trends': trends,
-        'active_tab': 'dashboard',
     }
+
+
+def dashboard(request):
+    today = date.today()
+    snapshot = get_snapshot(today, lambda: build_dashboard_snapshot(today))
+
+    context = dict(snapshot, active_tab='dashboard')
     return render(request, 'dashboard.html', context)
 
 
-def inventory_summary(request):
-    summary = []
+@staff_member_required
+def dashboard_cache_stats(request):
+    return JsonResponse(cache_stats())
+
 
-    # --- Filters ---
-    start_date_param = request.GET.get('start_date')
-    end_date_param = request.GET.get('end_date')
+def summary_filters(request):
+    """
+    ``(start_date, end_date, search_query, counts)`` from the inventory
+    summary's GET parameters; dates that are missing or do not parse default
+    to the latest count session.
+    """
     search_query = request.GET.get('search')
 
     latest_session_date = StockCountEntry.objects.aggregate(
         latest=Max('session__date')
     )['latest']
 
-    start_date = parse_date(start_date_param) if start_date_param else latest_session_date
-    end_date = parse_date(end_date_param) if end_date_param else latest_session_date
+    start_date = _date_param(request, 'start_date') or latest_session_date
+    end_date = _date_param(request, 'end_date') or latest_session_date
 
-    counts = StockCountEntry.objects.select_related('stock_code', 'session')
+    counts = StockCountEntry.objects.all()
 
     if start_date:
         counts = counts.filter(session__date__gte=start_date)
     if end_date:
         counts = counts.filter(session__date__lte=end_date)
     if search_query:
-        counts = counts.filter(
-            Q(stock_code__stock_code__icontains=search_query) |
-            Q(stock_code__stock_description__icontains=search_query)
-        )
-
-    # --- Helper: sum quantity safely ---
-    def qty_sum(qs):
-        return qs.aggregate(total=Sum('quantity'))['total'] or Decimal('0')
-
-    total_system_qty = Decimal('0')
-    total_counted_qty = Decimal('0')
-    total_variance_qty = Decimal('0')
-    total_variance_value = Decimal('0.00')
-    total_valuation = Decimal('0.00')
-
+        counts = counts.filter(search_filter(search_query, 'stock_code__'))
+    return start_date, end_date, search_query, counts
+
+
+def inventory_summary_rows(counts, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Summary rows for the latest entry per SKU in ``counts``, newest count
+    first, with the variance stored in its StockCountAdjustment and the
+    counted stock valued at its cost on the count date.  Entries are read
+    from the database ``chunk_size`` at a time.
+    """
+    cost_value = Subquery(
+        StockCostBalance.objects.filter(
+            stock_code=OuterRef('stock_code'), method=costing_method().name, date=OuterRef('session__date')
+        ).values('value')[:1]
+    )
     # Only keep latest count per stock_code
-    latest_counts_map = {}
-    for count in counts.order_by('-session__date', '-id'):
-        stock_id = count.stock_code_id
-        if stock_id not in latest_counts_map:
-            latest_counts_map[stock_id] = count
-
-    latest_counts = latest_counts_map.values()
-
-
-
-    for count in latest_counts:
-        stock = count.stock_code
-        count_date = count.session.date
-        counted_qty = count.quantity_counted
-
-        # --- Find prior count ---
-        prior_count = StockCountEntry.objects.filter(
-            stock_code=stock,
-            session__date__lt=count_date
-        ).order_by('-session__date', '-id').first()
-
-        prior_qty = prior_count.quantity_counted if prior_count else Decimal('0')
-        prior_date = prior_count.session.date if prior_count else None
-
-        # --- Movements between prior count and current count ---
-        purchase_filter = Q(stock_code=stock, transaction_date__lte=count_date)
-        sale_filter = Q(stock_code=stock, transaction_date__lte=count_date)
-
-        if prior_date:
-            purchase_filter &= Q(transaction_date__gt=prior_date)
-            sale_filter &= Q(transaction_date__gt=prior_date)
-
-        purchases_since = qty_sum(Purchase.objects.filter(purchase_filter))
-        sales_since = qty_sum(Sale.objects.filter(sale_filter))
-
-        system_qty = prior_qty + purchases_since - sales_since
-        variance = counted_qty - system_qty
-
-        # --- Latest price before count ---
-        latest_price = Purchase.objects.filter(
-            stock_code=stock,
-            transaction_date__lte=count_date
-        ).order_by('-transaction_date').values_list('price_per_unit', flat=True).first() or Decimal('0')
-
-        valuation = counted_qty * latest_price
-        variance_value = variance * latest_price
-
-        # --- Totals ---
-        total_system_qty += system_qty
-        total_counted_qty += counted_qty
-        total_variance_qty += variance
-        total_variance_value += variance_value
-        total_valuation += valuation
+    latest_counts = counts.annotate(
+        count_date=F('session__date'),
+        cost_value=cost_value,
+        rank=Window(
+            RowNumber(),
+            partition_by=[F('stock_code')],
+            order_by=[F('session__date').desc(), F('id').desc()],
+        )
+    ).filter(rank=1).order_by('-session__date', '-id').values_list(
+        'stock_code__stock_code', 'stock_code__stock_description', 'count_date', 'quantity_counted',
+        'adjustment__system_quantity', 'adjustment__variance_quantity', 'adjustment__unit_price',
+        'adjustment__variance_value', 'cost_value',
+    )
 
-        summary.append({
-            'stock_code': stock.stock_code,
-            'description': stock.stock_description,
+    for (stock_code, description, count_date, counted_qty, system_qty, variance, latest_price, variance_value,
+         cost_value) in latest_counts.iterator(chunk_size=chunk_size):
+        yield {
+            'stock_code': stock_code,
+            'description': description,
             'count_date': count_date,
             'system_quantity': system_qty,
             'counted_quantity': counted_qty,
             'variance': variance,
             'latest_price': latest_price,
-            'valuation': valuation,
+            'valuation': cost_value or Decimal('0'),
             'variance_value': variance_value,
-        })
+        }
+
+
+def inventory_summary(request):
+    start_date, end_date, search_query, counts = summary_filters(request)
 
+    summary = list(inventory_summary_rows(counts))
 
     return render(request, 'inventory_summary.html', {
         'summary': summary,
         'search_query': search_query,
         'start_date': start_date,
         'end_date': end_date,
-        'total_system_qty': total_system_qty,
-        'total_counted_qty': total_counted_qty,
-        'total_variance_qty': total_variance_qty,
-        'total_valuation': total_valuation,
-        'total_variance_value': total_variance_value,
+        'total_system_qty': sum((row['system_quantity'] for row in summary), Decimal('0')),
+        'total_counted_qty': sum((row['counted_quantity'] for row in summary), Decimal('0')),
+        'total_variance_qty': sum((row['variance'] for row in summary), Decimal('0')),
+        'total_valuation': sum((row['valuation'] for row in summary), Decimal('0.00')),
+        'total_variance_value': sum((row['variance_value'] for row in summary), Decimal('0.00')),
         'active_tab': 'summary',
     })
 
+
+LEDGER_EXPORT_COLUMNS = [
+    ('stock_code', 'Stock Code'),
+    ('description', 'Description'),
+    ('opening_quantity', 'Opening Quantity'),
+    ('purchase_quantity', 'Purchase Quantity'),
+    ('sales_quantity', 'Sales Quantity'),
+    ('variance', 'Variance'),
+    ('quantity_on_hand', 'Stock on Hand'),
+    ('latest_price', 'Latest Purchase Price'),
+    ('valuation', 'Inventory Valuation'),
+    ('transaction_date', 'Last Transaction Date'),
+]
+
+SUMMARY_EXPORT_COLUMNS = [
+    ('stock_code', 'Stock Code'),
+    ('description', 'Description'),
+    ('count_date', 'Count Date'),
+    ('system_quantity', 'System Qty'),
+    ('counted_quantity', 'Counted Qty'),
+    ('variance', 'Variance'),
+    ('latest_price', 'Price'),
+    ('valuation', 'Valuation'),
+    ('variance_value', 'Variance Value'),
+]
+
+
+def ledger_export_rows(start_date, end_date, stock_items, chunk_size=EXPORT_CHUNK_SIZE):
+    """Ledger rows in stock code order, computed ``chunk_size`` SKUs at a time."""
+    stock_ids = stock_items.order_by('stock_code').values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(stock_ids, chunk_size))
+        if not chunk:
+            return
+        rows, _ = build_stock_ledger(
+            start_date, end_date, StockTransaction.objects.filter(pk__in=chunk).order_by('stock_code')
+        )
+        yield from rows
+
+
+def export_transaction_list(request, file_format):
+    if file_format not in EXPORT_FORMATS:
+        raise Http404(f"Unknown export format: {file_format}")
+    start_date, end_date, search_query, stock_items = ledger_filters(request)
+    rows = ledger_export_rows(start_date, end_date, stock_items)
+    return export_response(
+        file_format,
+        f'stock_ledger_{start_date:%Y%m%d}_{end_date:%Y%m%d}',
+        [label for _, label in LEDGER_EXPORT_COLUMNS],
+        ([row[key] for key, _ in LEDGER_EXPORT_COLUMNS] for row in rows),
+        sheet_name='Stock Ledger',
+    )
+
+
+def export_inventory_summary(request, file_format):
+    if file_format not in EXPORT_FORMATS:
+        raise Http404(f"Unknown export format: {file_format}")
+    start_date, end_date, search_query, counts = summary_filters(request)
+    rows = inventory_summary_rows(counts)
+    return export_response(
+        file_format,
+        f'inventory_summary_{start_date:%Y%m%d}' if start_date else 'inventory_summary',
+        [label for _, label in SUMMARY_EXPORT_COLUMNS],
+        ([row[key] for key, _ in SUMMARY_EXPORT_COLUMNS] for row in rows),
+        sheet_name='Inventory Summary',
+    )
+
+IMPORT_ERRORS_SHOWN = 500
+
+
+@login_required
+def import_data(request):
+    """Upload a stock master, purchase or sale CSV file; see imports.import_csv()."""
+    result = None
+    error = None
+
+    if request.method == 'POST':
+        kind = request.POST.get('kind')
+        upload = request.FILES.get('file')
+        if kind not in IMPORT_COLUMNS:
+            error = "Choose what the file contains."
+        elif upload is None:
+            error = "Choose a CSV file to upload."
+        else:
+            file = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+            try:
+                result = import_csv(kind, file, dry_run=bool(request.POST.get('dry_run')))
+            except (ValidationError, UnicodeDecodeError, csv.Error) as e:
+                error = ' '.join(e.messages) if isinstance(e, ValidationError) else f"Could not read the file: {e}"
+            finally:
+                file.detach()
+
+    return render(request, 'import_data.html', {
+        'columns': IMPORT_COLUMNS,
+        'result': result,
+        'errors_shown': result.errors[:IMPORT_ERRORS_SHOWN] if result else [],
+        'error': error,
+        'active_tab': 'import',
+    })
+
+
 def help_page(request):
     return render(request, 'help.html', {'active_tab': 'help'})
\ No newline at end of file